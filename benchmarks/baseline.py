@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""Baseline results shared by the benchmarks, and their comparison with new results."""
+
+import os
+import json
+from os.path import abspath
+
+
+def compare(results, baseline, tolerance, metrics, higher_is_better=()):
+    """Return the regressions of results against baseline, as messages"""
+    regressions = []
+    for key, result in sorted(results.items()):
+        if 'error' in result:
+            regressions.append(key + ': ' + result['error'])
+            continue
+        if key not in baseline:
+            continue
+        for metric in metrics:
+            reference = baseline[key].get(metric)
+            if not reference:
+                continue
+            change = (result[metric] - reference) / reference
+            if metric in higher_is_better:
+                change = -change
+            if change > tolerance:
+                regressions.append('%s: %s %.2f, baseline %.2f (%+d%%)'
+                                   % (key, metric, result[metric], reference, 100 * change))
+    return regressions
+
+
+def check(results, path, save, tolerance, metrics, higher_is_better=()):
+    """Save results as the baseline at path, or exit with an error if they regress from it"""
+    path = abspath(path)
+    baseline = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            baseline = json.load(f)
+
+    if save:
+        baseline.update(results)
+        with open(path, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print('Baseline saved to ' + path)
+        return
+
+    regressions = compare(results, baseline, tolerance, metrics, higher_is_better)
+    if regressions:
+        print('Regressions:')
+        for regression in regressions:
+            print('  ' + regression)
+        exit(1)
+    print('No regression against ' + path)
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Local stand-ins for the Peertube and Youtube endpoints used by prismedia.
+
+They implement just enough of both APIs to authenticate, list and create playlists
+and receive uploads (legacy multipart and resumable for Peertube, resumable for
+Youtube). Uploaded bytes are read and dropped so the servers cost as little as
+possible to the machine running the benchmark.
+"""
+
+import re
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse
+
+READ_SIZE = 1024 * 1024
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def drain(self):
+        """Read and drop the request body, return its size"""
+        length = int(self.headers.get('Content-Length') or 0)
+        remaining = length
+        while remaining:
+            data = self.rfile.read(min(READ_SIZE, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+        return length
+
+    def send_json(self, status, content=None, headers=None):
+        body = json.dumps(content).encode('utf-8') if content is not None else b''
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def receive_chunk(self, sessions, session_id, complete):
+        """Handle a PUT of a resumable upload, shared by both platforms"""
+        content_range = self.headers.get('Content-Range', '')
+        received = self.drain()
+        total = int(content_range.split('/')[-1]) if '/' in content_range else 0
+        with self.server.lock:
+            if content_range.startswith('bytes */'):
+                offset = sessions.get(session_id, 0)
+            else:
+                start = int(re.match(r'bytes (\d+)-', content_range).group(1))
+                offset = sessions[session_id] = start + received
+        if offset >= total:
+            return self.send_json(200, complete)
+        return self.send_json(308, None, {'Range': 'bytes=0-%d' % (offset - 1)})
+
+
+class PeertubeHandler(StandInHandler):
+
+    def do_POST(self):
+        path = urlparse(self.path).path
+        self.drain()
+        if path == '/api/v1/users/token':
+            return self.send_json(200, {'access_token': 'token', 'refresh_token': 'refresh',
+                                        'token_type': 'Bearer', 'expires_in': 86400})
+        if path == '/api/v1/videos/upload':
+            return self.send_json(200, {'video': {'id': 1, 'uuid': 'standin'}})
+        if path == '/api/v1/videos/upload-resumable':
+            if self.server.legacy:
+                return self.send_json(404, {})
+            with self.server.lock:
+                self.server.next_id += 1
+                upload_id = str(self.server.next_id)
+            return self.send_json(201, None,
+                                  {'Location': '/api/v1/videos/upload-resumable?upload_id=' + upload_id})
+        if path == '/api/v1/video-playlists/':
+            return self.send_json(200, {'videoPlaylist': {'id': 2}})
+        if path == '/api/v1/video-channels/':
+            return self.send_json(200, {'videoChannel': {'id': 3}})
+        if re.match(r'/api/v1/video-playlists/\w+/videos', path):
+            return self.send_json(200, {'videoPlaylistElement': {'id': 4}})
+        return self.send_json(404, {})
+
+    def do_PUT(self):
+        query = urlparse(self.path).query
+        return self.receive_chunk(self.server.sessions, query, {'video': {'id': 1, 'uuid': 'standin'}})
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == '/api/v1/users/me':
+            return self.send_json(200, {'videoChannels': [{'id': 1, 'displayName': 'Default'}]})
+        if re.match(r'/api/v1/accounts/\w+/video-playlists', path):
+            return self.send_json(200, {'total': 1, 'data': [{'id': 2, 'displayName': 'Benchmark'}]})
+        return self.send_json(404, {})
+
+
+class YoutubeHandler(StandInHandler):
+
+    def do_POST(self):
+        path = urlparse(self.path).path
+        self.drain()
+        if '/upload/' in path:
+            with self.server.lock:
+                self.server.next_id += 1
+                upload_id = str(self.server.next_id)
+            location = 'http://%s:%d%s?upload_id=%s' % (self.server.server_address + (path, upload_id))
+            return self.send_json(200, None, {'Location': location})
+        if path.endswith('/playlists'):
+            return self.send_json(200, {'id': 'PLstandin'})
+        if path.endswith('/playlistItems'):
+            return self.send_json(200, {'id': 'item'})
+        return self.send_json(404, {})
+
+    def do_PUT(self):
+        query = urlparse(self.path).query
+        return self.receive_chunk(self.server.sessions, query, {'id': 'standin'})
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path.endswith('/playlists'):
+            return self.send_json(200, {'items': [{'id': 'PLstandin', 'snippet': {'title': 'Benchmark'}}]})
+        return self.send_json(404, {})
+
+
+def start_server(handler, legacy=False):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.lock = threading.Lock()
+    server.sessions = {}
+    server.next_id = 0
+    server.legacy = legacy
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def serve(queue, legacy=False):
+    """Run both servers until the process is terminated, sending their urls on queue"""
+    peertube = start_server(PeertubeHandler, legacy)
+    youtube = start_server(YoutubeHandler)
+    queue.put({
+        'peertube': 'http://127.0.0.1:%d' % peertube.server_address[1],
+        'youtube': 'http://127.0.0.1:%d/' % youtube.server_address[1]
+    })
+    threading.Event().wait()
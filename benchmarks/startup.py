@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+prismedia startup benchmark
+
+Run prismedia command lines that never reach a platform with python -X importtime,
+measure the time spent importing modules on top of the interpreter's own startup,
+and check that no platform module or API client was imported. Run it from the
+repository root with python -m benchmarks.startup
+
+Usage:
+  benchmark [options]
+  benchmark -h | --help
+
+Options:
+  --runs=INT  Number of runs of each command line, the fastest one is kept. [default: 7]
+  --baseline=STRING  Baseline results to compare with. [default: benchmarks/baseline.json]
+  --save-baseline  Record these results as the new baseline instead of comparing them
+  --tolerance=FLOAT  Allowed relative regression against the baseline. [default: 0.25]
+  -h --help  Show this help.
+"""
+
+import os
+import sys
+import subprocess
+import tempfile
+from os.path import dirname, abspath
+
+from docopt import docopt
+
+from . import baseline
+
+# Command lines to measure, by name
+SCENARIOS = {
+    'help': ['-m', 'prismedia', '--help'],
+    'validation': ['-m', 'prismedia', '--file=missing.mp4', '--platform=peertube'],
+}
+
+# None of these should be imported before a platform is actually used
+HEAVY_MODULES = (
+    'prismedia.pt_upload', 'prismedia.yt_upload', 'googleapiclient', 'google_auth_oauthlib',
+    'httplib2', 'requests_oauthlib', 'requests_toolbelt', 'pytz', 'tzlocal'
+)
+
+METRICS = ('import_ms',)
+
+
+def import_times(args, directory):
+    """Return the cumulative import time in microseconds of each top level import of the command line"""
+    env = dict(os.environ)
+    env['PYTHONPATH'] = dirname(dirname(abspath(__file__))) + os.pathsep + env.get('PYTHONPATH', '')
+    process = subprocess.run([sys.executable, '-X', 'importtime'] + args, cwd=directory, env=env,
+                             stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+    times = {}
+    for line in process.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line.split('|')
+        if not name.startswith('  '):
+            times[name.strip()] = int(cumulative)
+        times.setdefault(name.strip(), 0)
+    return times
+
+
+def run_scenario(args, runs, directory):
+    interpreter = import_times(['-c', 'pass'], directory)
+    best = None
+    modules = set()
+    for run in range(runs):
+        times = import_times(args, directory)
+        modules.update(times)
+        total = sum(cumulative for name, cumulative in times.items() if name not in interpreter)
+        best = total if best is None else min(best, total)
+    heavy = [module for module in HEAVY_MODULES if module in modules]
+    if heavy:
+        return {'error': 'imported ' + ', '.join(heavy)}
+    return {'import_ms': best / 1000.0}
+
+
+def main():
+    options = docopt(__doc__)
+    runs = int(options['--runs'])
+    directory = tempfile.mkdtemp(prefix='prismedia-benchmark-')
+    results = {}
+    for name, args in sorted(SCENARIOS.items()):
+        key = 'startup:' + name
+        results[key] = run_scenario(args, runs, directory)
+        if 'error' in results[key]:
+            print('%-24s %s' % (key, results[key]['error']))
+        else:
+            print('%-24s %8.1f ms of imports' % (key, results[key]['import_ms']))
+    baseline.check(results, options['--baseline'], options['--save-baseline'], float(options['--tolerance']),
+                   METRICS)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
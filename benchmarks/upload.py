@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+prismedia upload benchmark
+
+Upload generated files to local stand-ins of Peertube and Youtube and measure
+the cost of prismedia's upload path. Each upload runs in its own process, the
+servers in another one. Run it from the repository root with python -m benchmarks.upload,
+adding a large size to see the upload of a long video: --sizes=10,100,10000
+
+Usage:
+  benchmark [options]
+  benchmark -h | --help
+
+Options:
+  --sizes=STRING  Sizes of the uploaded files in MB, comma separated. [default: 10,100]
+                  Files are sparse, so 10000 (10 GB) does not need the disk space.
+  --platform=STRING  Platforms to benchmark, comma separated. [default: peertube,youtube]
+  --legacy  Make the Peertube stand-in refuse resumable uploads, to benchmark the legacy upload
+  --chunk-size=INT  Size of the chunks of resumable uploads in MB. [default: 8]
+  --baseline=STRING  Baseline results to compare with. [default: benchmarks/baseline.json]
+  --save-baseline  Record these results as the new baseline instead of comparing them
+  --tolerance=FLOAT  Allowed relative regression against the baseline. [default: 0.25]
+  --json=STRING  Also write the results to this file
+  -h --help  Show this help.
+
+Reported metrics:
+  throughput  MB/s of the whole upload, metadata and playlist requests included
+  cpu_per_gb  user + system CPU seconds of the uploading process per GB sent
+  peak_rss    maximum resident memory of the uploading process, in MB
+  syscalls_per_gb  approximate syscalls per GB sent: the read/write syscalls of
+              /proc/self/io plus the socket send/recv calls counted on the socket
+              methods, as /proc/self/io does not see them. Other syscalls are not
+              counted, this is an estimate for machines without strace.
+"""
+
+import os
+import sys
+import json
+import time
+import logging
+import importlib
+import tempfile
+import resource
+import socket
+import multiprocessing
+from queue import Empty
+from os.path import join
+from configparser import RawConfigParser
+
+from docopt import docopt
+
+from . import baseline, servers
+
+logger = logging.getLogger('Prismedia')
+
+# A regression on these metrics is a higher value, except for throughput
+METRICS = ('throughput', 'cpu_per_gb', 'peak_rss', 'syscalls_per_gb')
+
+SOCKET_METHODS = ('send', 'sendall', 'sendfile', 'recv', 'recv_into')
+
+_socket_calls = [0]
+
+
+def counted(method):
+    def wrapper(self, *args, **kwargs):
+        _socket_calls[0] += 1
+        return method(self, *args, **kwargs)
+    return wrapper
+
+
+def count_socket_calls():
+    """Wrap the socket methods used by http.client, requests and httplib2 to count their calls"""
+    for name in SOCKET_METHODS:
+        setattr(socket.socket, name, counted(getattr(socket.socket, name)))
+
+
+def read_syscalls():
+    counts = {}
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                key, value = line.split(':')
+                counts[key] = int(value)
+    except (IOError, OSError):
+        pass
+    return counts.get('syscr', 0) + counts.get('syscw', 0) + _socket_calls[0]
+
+
+def read_cpu():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def create_file(directory, size):
+    path = join(directory, 'benchmark-%dMB.mp4' % size)
+    if not os.path.exists(path):
+        with open(path, 'wb') as f:
+            f.truncate(size * 1000 * 1000)
+    return path
+
+
+def upload_peertube(url, options):
+    from prismedia import pt_upload
+
+    secret = RawConfigParser()
+    secret.add_section('peertube')
+    for key, value in (('peertube_url', url), ('username', 'benchmark'), ('password', 'benchmark'),
+                       ('client_id', 'benchmark'), ('client_secret', 'benchmark'),
+                       ('OAUTHLIB_INSECURE_TRANSPORT', '1')):
+        secret.set('peertube', key, value)
+    os.environ['OAUTHLIB_INSECURE_TRANSPORT'] = '1'
+    oauth = pt_upload.get_authenticated_service(secret)
+    return pt_upload.upload_video(oauth, secret, options)
+
+
+def upload_youtube(url, options):
+    from google.oauth2.credentials import Credentials
+    from googleapiclient import discovery_cache
+    from googleapiclient.discovery import build_from_document
+    from prismedia import yt_upload
+
+    # The bundled discovery document, with every request sent to the stand-in
+    document = json.loads(discovery_cache.get_static_doc(yt_upload.API_SERVICE_NAME, yt_upload.API_VERSION))
+    document['rootUrl'] = document['mtlsRootUrl'] = url
+    # Requests go through the same transport as prismedia, with a token that never expires
+    youtube = build_from_document(document, http=yt_upload.AuthorizedHttp(Credentials('benchmark')))
+    return yt_upload.initialize_upload(youtube, options)
+
+
+UPLOADS = {'peertube': upload_peertube, 'youtube': upload_youtube}
+
+
+def run_case(platform, url, path, chunk_size, results):
+    """Upload path once in a fresh process and put its measures in results"""
+    # Import time is not part of the upload. Importing prismedia also sets up its log
+    # handler, only keep warnings and errors
+    for module in ('prismedia.pt_upload', 'prismedia.yt_upload'):
+        importlib.import_module(module)
+    logger.setLevel(logging.WARNING)
+    os.chdir(tempfile.mkdtemp(prefix='prismedia-benchmark-'))
+    count_socket_calls()
+    options = {
+        '--file': path,
+        '--name': 'Benchmark',
+        '--privacy': 'private',
+        '--nsfw': False,
+        '--playlist': 'Benchmark',
+        '--chunk-size': chunk_size,
+    }
+    size = os.path.getsize(path)
+
+    syscalls = read_syscalls()
+    cpu = read_cpu()
+    start = time.time()
+    try:
+        url = UPLOADS[platform](url, options)
+    except (SystemExit, Exception) as e:
+        logger.critical("Benchmark: " + platform + " upload failed: " + repr(e))
+        url = None
+    elapsed = time.time() - start
+    if not url:
+        results.put({'error': 'upload failed'})
+        return
+    gigabytes = size / 1e9
+    results.put({
+        'throughput': size / 1e6 / elapsed,
+        'cpu_per_gb': (read_cpu() - cpu) / gigabytes,
+        'peak_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+        'syscalls_per_gb': (read_syscalls() - syscalls) / gigabytes,
+    })
+
+
+def wait_result(process, queue):
+    while True:
+        try:
+            return queue.get(timeout=1)
+        except Empty:
+            if not process.is_alive():
+                return {'error': 'process exited with code %s' % process.exitcode}
+
+
+def run_benchmark(platforms, sizes, legacy, chunk_size):
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    server = context.Process(target=servers.serve, args=(queue, legacy))
+    server.daemon = True
+    server.start()
+    urls = queue.get()
+
+    results = {}
+    directory = tempfile.mkdtemp(prefix='prismedia-benchmark-files-')
+    try:
+        for size in sizes:
+            path = create_file(directory, size)
+            for platform in platforms:
+                name = platform
+                if platform == 'peertube' and legacy:
+                    name = 'peertube-legacy'
+                key = '%s:%dMB' % (name, size)
+                process = context.Process(target=run_case,
+                                          args=(platform, urls[platform], path, chunk_size, queue))
+                process.start()
+                results[key] = wait_result(process, queue)
+                process.join()
+                print_result(key, results[key])
+            os.remove(path)
+    finally:
+        os.rmdir(directory)
+        server.terminate()
+    return results
+
+
+def print_result(key, result):
+    if 'error' in result:
+        print('%-24s %s' % (key, result['error']))
+        return
+    print('%-24s %8.1f MB/s %8.2f cpu s/GB %8.1f MB rss %10d syscalls/GB (approx.)'
+          % (key, result['throughput'], result['cpu_per_gb'], result['peak_rss'], result['syscalls_per_gb']))
+
+
+def main():
+    options = docopt(__doc__)
+    platforms = options['--platform'].split(',')
+    for platform in platforms:
+        if platform not in UPLOADS:
+            print('Unknown platform: ' + platform)
+            exit(1)
+    sizes = [int(size) for size in options['--sizes'].split(',')]
+    results = run_benchmark(platforms, sizes, options['--legacy'], int(options['--chunk-size']))
+
+    if options['--json']:
+        with open(options['--json'], 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    baseline.check(results, options['--baseline'], options['--save-baseline'], float(options['--tolerance']),
+                   METRICS, higher_is_better=('throughput',))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,5 +1,7 @@
-from future import standard_library
-standard_library.install_aliases()
+import sys
+if sys.version_info[0] < 3:
+    from future import standard_library
+    standard_library.install_aliases()
 
 from . import upload
 from . import genconfig
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import os
+import json
+import logging
+import threading
+from os.path import exists
+
+logger = logging.getLogger('Prismedia')
+
+# Access tokens, refresh tokens and expiry of every platform are kept in this file
+CREDENTIALS_STORE_PATH = ".prismedia_credentials.json"
+
+# Tokens are refreshed this many seconds before they expire
+REFRESH_MARGIN = 300
+
+
+class CredentialStore(object):
+    """Credentials of all platforms in a single json file, shared by every upload of the process.
+
+    The lock is reentrant and also serializes token refreshes, so concurrent workers
+    never refresh the same token twice.
+    """
+
+    def __init__(self, path=CREDENTIALS_STORE_PATH):
+        self.path = path
+        self.lock = threading.RLock()
+
+    def _load(self):
+        if not exists(self.path):
+            return {}
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except ValueError:
+            logger.warning("Prismedia: " + self.path + " is corrupted, credentials need to be fetched again.")
+            return {}
+
+    def _save(self, credentials):
+        # Credentials are secrets, keep the file readable by the owner only
+        fd = os.open(self.path + ".tmp", os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(credentials, f)
+        os.replace(self.path + ".tmp", self.path)
+
+    def get(self, key):
+        with self.lock:
+            return self._load().get(key)
+
+    def set(self, key, value):
+        with self.lock:
+            credentials = self._load()
+            credentials[key] = value
+            self._save(credentials)
+
+    def delete(self, key):
+        with self.lock:
+            credentials = self._load()
+            if credentials.pop(key, None) is not None:
+                self._save(credentials)
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = CredentialStore()
+        return _store
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import os
+import json
+import time
+import logging
+import threading
+from os.path import exists
+
+logger = logging.getLogger('Prismedia')
+
+# Channels and playlists of every account, indexed by display name
+CACHE_PATH = ".prismedia_cache.json"
+
+# Seconds before a remote index is fetched again
+DEFAULT_TTL = 3600
+
+
+class ResourceCache(object):
+    """Remote channels and playlists per account, kept in a json file with a TTL.
+
+    Each index is a list of [name, id] in the order given by the platform, built by a
+    fetch function reading every page. Concurrent lookups of the same index wait
+    for a single fetch. A name missing from a cached index is checked against the
+    platform once per process, in case it was created elsewhere.
+    """
+
+    def __init__(self, path=CACHE_PATH, ttl=DEFAULT_TTL):
+        self.path = path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._index_locks = {}
+        self._fetched = set()
+        self._indexes = self._load()
+
+    def _load(self):
+        if not exists(self.path):
+            return {}
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except ValueError:
+            logger.warning("Prismedia: " + self.path + " is corrupted, ignoring cache.")
+            return {}
+
+    def _save(self):
+        with open(self.path + ".tmp", 'w') as f:
+            json.dump(self._indexes, f)
+        os.replace(self.path + ".tmp", self.path)
+
+    def _index_lock(self, key):
+        with self._lock:
+            return self._index_locks.setdefault(key, threading.Lock())
+
+    def _refresh(self, account, kind, fetch):
+        items = fetch()
+        logger.debug("Prismedia: Cached " + str(len(items)) + " " + kind + " for " + account)
+        with self._lock:
+            self._indexes.setdefault(account, {})[kind] = {"fetched": time.time(), "items": items}
+            self._fetched.add((account, kind))
+            self._save()
+        return items
+
+    def get_index(self, account, kind, fetch):
+        with self._index_lock((account, kind)):
+            with self._lock:
+                index = self._indexes.get(account, {}).get(kind)
+            if index is None or index["fetched"] + self.ttl < time.time():
+                return self._refresh(account, kind, fetch)
+            return index["items"]
+
+    def count(self, account, kind):
+        """Return the number of items of the index, expired or not, or None if it was never fetched"""
+        with self._lock:
+            index = self._indexes.get(account, {}).get(kind)
+        return None if index is None else len(index["items"])
+
+    def lookup(self, account, kind, name, fetch):
+        for item_name, item_id in self.get_index(account, kind, fetch):
+            if item_name == name:
+                return item_id
+        with self._index_lock((account, kind)):
+            if (account, kind) in self._fetched:
+                return None
+            items = self._refresh(account, kind, fetch)
+        for item_name, item_id in items:
+            if item_name == name:
+                return item_id
+
+    def add(self, account, kind, name, item_id):
+        with self._lock:
+            index = self._indexes.setdefault(account, {}).get(kind)
+            if index is None:
+                # Nothing cached yet, the next lookup will fetch the whole index anyway
+                return
+            index["items"].append([name, item_id])
+            self._save()
+
+    def clear(self):
+        with self._lock:
+            self._indexes = {}
+            self._fetched = set()
+            self._save()
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = ResourceCache()
+        return _cache
+
+
+def configure(ttl=None, refresh=False):
+    resource_cache = get_cache()
+    if ttl is not None:
+        resource_cache.ttl = ttl
+    if refresh:
+        logger.info("Prismedia: Refreshing channels and playlists cache.")
+        resource_cache.clear()
@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import os
+import json
+import mmap
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+
+logger = logging.getLogger('Prismedia')
+
+# Fingerprints of uploaded videos and their url on each platform
+LEDGER_PATH = ".prismedia_ledger.sqlite"
+
+# fast hashes the size and a few sampled blocks, full hashes the whole content
+HASH_MODES = ("fast", "full")
+DEFAULT_HASH_MODE = "fast"
+
+SAMPLE_COUNT = 16
+SAMPLE_SIZE = 64 * 1024
+
+# Bytes given at once to the hash function in full mode
+HASH_BLOCK_SIZE = 8 * 1024 * 1024
+
+# Steps of an upload job, in order. A job stopped by an error resumes after its last step done
+JOB_STEPS = ("authenticated", "resolved", "uploaded", "thumbnail", "playlist")
+
+
+def fast_fingerprint(path, size):
+    """Hash the size and SAMPLE_COUNT blocks spread over the file, first and last ones included"""
+    digest = hashlib.sha256(str(size).encode('utf-8'))
+    last = max(0, size - SAMPLE_SIZE)
+    with open(path, 'rb') as f:
+        for offset in sorted(set(last * i // (SAMPLE_COUNT - 1) for i in range(SAMPLE_COUNT))):
+            f.seek(offset)
+            digest.update(f.read(SAMPLE_SIZE))
+    return digest.hexdigest()
+
+
+def full_fingerprint(path, size):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        if size == 0:
+            return digest.hexdigest()
+        try:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError):
+            # Some filesystems can not be mapped, read the file instead
+            for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+                digest.update(block)
+            return digest.hexdigest()
+        with mapped:
+            view = memoryview(mapped)
+            try:
+                for offset in range(0, size, HASH_BLOCK_SIZE):
+                    digest.update(view[offset:offset + HASH_BLOCK_SIZE])
+            finally:
+                view.release()
+    return digest.hexdigest()
+
+
+class Job(object):
+    """Steps done to upload a video to a platform, saved as soon as each one is done.
+
+    Values learnt by a step, such as the video id, are saved with it so the next
+    steps can run again on a new run without the steps before.
+    """
+
+    def __init__(self, ledger, fingerprint, platform, steps=(), values=None):
+        self.ledger = ledger
+        self.fingerprint = fingerprint
+        self.platform = platform
+        self.steps = set(steps)
+        self.values = values or {}
+
+    def done(self, step):
+        return step in self.steps
+
+    def get(self, key, default=None):
+        return self.values.get(key, default)
+
+    def last(self):
+        """Return the last step done, steps not needed by the upload being skipped"""
+        done = [step for step in JOB_STEPS if step in self.steps]
+        return done[-1] if done else None
+
+    def complete(self, step, **values):
+        self.steps.add(step)
+        self.values.update(values)
+        self.ledger.save_job(self)
+
+
+class Ledger(object):
+    """Uploads already done, per video content and platform, in a sqlite database.
+
+    Videos are identified by a fingerprint of their content, so a renamed or moved
+    video is still recognized. Fingerprints are kept with the size and modification
+    time of the file they were computed from, and only computed again when the
+    file changes.
+    """
+
+    def __init__(self, path=LEDGER_PATH, mode=DEFAULT_HASH_MODE):
+        self.mode = mode
+        self.force = False
+        self._lock = threading.Lock()
+        self._path_locks = {}
+        # Batch workers share the connection, every access is done under the lock
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        # Jobs are saved after each step, a write-ahead log makes these small commits cheap
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        with self._db:
+            self._db.execute("CREATE TABLE IF NOT EXISTS files ("
+                             "path TEXT, mode TEXT, size INTEGER, mtime INTEGER, fingerprint TEXT, "
+                             "PRIMARY KEY (path, mode))")
+            self._db.execute("CREATE TABLE IF NOT EXISTS uploads ("
+                             "fingerprint TEXT, platform TEXT, url TEXT, uploaded_at REAL, "
+                             "PRIMARY KEY (fingerprint, platform))")
+            self._db.execute("CREATE TABLE IF NOT EXISTS jobs ("
+                             "fingerprint TEXT, platform TEXT, steps TEXT, data TEXT, updated_at REAL, "
+                             "PRIMARY KEY (fingerprint, platform))")
+
+    def _path_lock(self, path):
+        with self._lock:
+            return self._path_locks.setdefault(path, threading.Lock())
+
+    def fingerprint(self, path, mode=None):
+        mode = mode or self.mode
+        path = os.path.abspath(path)
+        # Platforms uploading the same video at the same time wait for a single computation
+        with self._path_lock(path):
+            stat = os.stat(path)
+            with self._lock:
+                row = self._db.execute("SELECT size, mtime, fingerprint FROM files WHERE path = ? AND mode = ?",
+                                       (path, mode)).fetchone()
+            if row is not None and row[0] == stat.st_size and row[1] == stat.st_mtime_ns:
+                return row[2]
+
+            start = time.time()
+            if mode == "full":
+                fingerprint = "full:" + full_fingerprint(path, stat.st_size)
+            else:
+                fingerprint = "fast:" + fast_fingerprint(path, stat.st_size)
+            logger.debug("Prismedia: Fingerprint of %s computed in %.1f seconds" % (path, time.time() - start))
+            with self._lock, self._db:
+                self._db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)",
+                                 (path, mode, stat.st_size, stat.st_mtime_ns, fingerprint))
+            return fingerprint
+
+    def fingerprints(self, path):
+        """Yield the fingerprints path may be recorded with, in the current mode then in fast mode"""
+        fingerprint = self.fingerprint(path)
+        yield fingerprint
+        # Uploads and jobs are also recorded with the fast fingerprint, whatever the mode they were done in
+        if self.mode != "fast":
+            yield self.fingerprint(path, "fast")
+
+    def lookup(self, path, platform):
+        """Return the url of path on platform if it was already uploaded there, unless forced"""
+        if self.force:
+            return None
+        for fingerprint in self.fingerprints(path):
+            with self._lock:
+                row = self._db.execute("SELECT url FROM uploads WHERE fingerprint = ? AND platform = ?",
+                                       (fingerprint, platform)).fetchone()
+            if row:
+                return row[0]
+        return None
+
+    def record(self, path, platform, url):
+        # Also record the fast fingerprint in full mode, so the upload is still known in fast mode
+        for mode in set((self.mode, "fast")):
+            fingerprint = self.fingerprint(path, mode)
+            with self._lock, self._db:
+                self._db.execute("INSERT OR REPLACE INTO uploads VALUES (?, ?, ?, ?)",
+                                 (fingerprint, platform, url, time.time()))
+
+    def job(self, path, platform):
+        """Return the job uploading path to platform, resumed where a previous run stopped unless forced"""
+        fingerprint = self.fingerprint(path)
+        if self.force:
+            fingerprints = set(self.fingerprints(path))
+            with self._lock, self._db:
+                for known in fingerprints:
+                    self._db.execute("DELETE FROM jobs WHERE fingerprint = ? AND platform = ?",
+                                     (known, platform))
+            return Job(self, fingerprint, platform)
+        for known in self.fingerprints(path):
+            with self._lock:
+                row = self._db.execute("SELECT steps, data FROM jobs WHERE fingerprint = ? AND platform = ?",
+                                       (known, platform)).fetchone()
+            if row is not None:
+                # A job started in another mode goes on with its own fingerprint
+                return Job(self, known, platform, [step for step in row[0].split(',') if step], json.loads(row[1]))
+        return Job(self, fingerprint, platform)
+
+    def save_job(self, job):
+        with self._lock, self._db:
+            self._db.execute("INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?)",
+                             (job.fingerprint, job.platform, ','.join(sorted(job.steps)), json.dumps(job.values),
+                              time.time()))
+
+    def finish(self, job, path, url):
+        """Record the upload of path done by job, which is forgotten"""
+        self.record(path, job.platform, url)
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM jobs WHERE fingerprint = ? AND platform = ?",
+                             (job.fingerprint, job.platform))
+
+
+_ledger = None
+_ledger_lock = threading.Lock()
+
+
+def get_ledger():
+    global _ledger
+    with _ledger_lock:
+        if _ledger is None:
+            _ledger = Ledger()
+        return _ledger
+
+
+def configure(mode=None, force=False):
+    uploads = get_ledger()
+    if mode is not None:
+        uploads.mode = mode
+    uploads.force = force
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import csv
+import json
+
+from . import utils
+
+
+def get_fields(row):
+    """Return the fields of a row by option name, as strings like in a NFO, empty fields being left out"""
+    fields = {}
+    for key, value in row.items():
+        if key is None or value is None or value == '':
+            continue
+        if isinstance(value, list):
+            value = ','.join(str(item) for item in value)
+        fields[utils.getOptionName(key)] = str(value)
+    return fields
+
+
+def read_csv(f):
+    reader = csv.DictReader(f)
+    for row in reader:
+        yield reader.line_num, get_fields(row)
+
+
+def read_json_lines(f):
+    for number, line in enumerate(f, 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError as e:
+            yield number, ValueError("invalid json: " + str(e))
+            continue
+        if not isinstance(row, dict):
+            yield number, ValueError("a row should be a json object")
+            continue
+        yield number, get_fields(row)
+
+
+def read(path):
+    """Yield the line number and fields of each row of a csv or json lines manifest, one row at a time.
+
+    Rows which can not be read are given as a ValueError instead of their fields.
+    """
+    with open(path, encoding='utf-8', newline='') as f:
+        if path.lower().endswith('.csv'):
+            rows = read_csv(f)
+        else:
+            rows = read_json_lines(f)
+        for number, fields in rows:
+            yield number, fields
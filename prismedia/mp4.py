@@ -0,0 +1,318 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import os
+import time
+import bisect
+import struct
+import hashlib
+import logging
+import tempfile
+import threading
+
+logger = logging.getLogger('Prismedia')
+
+# Boxes holding other boxes, to reach the track headers and sample descriptions
+CONTAINER_BOXES = (b'moov', b'trak', b'mdia', b'minf', b'stbl')
+
+# The movie box of very long videos is a few tens of MB, anything bigger is not a movie box
+MAX_MOOV_SIZE = 256 * 1024 * 1024
+
+# Faststart copies of the videos being uploaded are written in this directory of the temporary
+# directory (TMPDIR), each in a directory named after the video path, size and modification time
+# so the copy keeps the name of the video
+FASTSTART_DIRECTORY = "prismedia_faststart"
+
+# Media data is streamed to the faststart copy through a buffer of this size
+COPY_BLOCK_SIZE = 1024 * 1024
+
+
+class MP4Error(Exception):
+    pass
+
+
+def read_header(f, offset, end):
+    """Return the type, header size and total size of the box at offset"""
+    f.seek(offset)
+    header = f.read(16)
+    if len(header) < 8:
+        raise MP4Error("truncated box header at byte %d" % offset)
+    size, box_type = struct.unpack('>I4s', header[:8])
+    header_size = 8
+    if size == 1:
+        if len(header) < 16:
+            raise MP4Error("truncated box header at byte %d" % offset)
+        size = struct.unpack('>Q', header[8:16])[0]
+        header_size = 16
+    elif size == 0:
+        # The last box may extend to the end of the file
+        size = end - offset
+    if size < header_size or offset + size > end:
+        raise MP4Error("invalid size for box %r at byte %d" % (box_type, offset))
+    return box_type, header_size, size
+
+
+def iter_boxes(data, start=0, end=None):
+    """Yield the type, payload start and end of the boxes in data, a movie box read in memory"""
+    end = len(data) if end is None else end
+    offset = start
+    while offset + 8 <= end:
+        size, box_type = struct.unpack_from('>I4s', data, offset)
+        header_size = 8
+        if size == 1:
+            size = struct.unpack_from('>Q', data, offset + 8)[0]
+            header_size = 16
+        elif size == 0:
+            size = end - offset
+        if size < header_size or offset + size > end:
+            raise MP4Error("invalid size for box %r in the movie box" % box_type)
+        yield box_type, offset + header_size, offset + size
+        offset += size
+
+
+def parse_mvhd(data, start, facts):
+    version = data[start]
+    if version == 1:
+        timescale, duration = struct.unpack_from('>IQ', data, start + 20)
+    else:
+        timescale, duration = struct.unpack_from('>II', data, start + 12)
+    if timescale:
+        facts['duration'] = float(duration) / timescale
+
+
+def parse_trak(data, start, end, facts):
+    width = height = handler = codec = None
+    # Walk the track down to its header, handler and first sample description
+    pending = [(start, end)]
+    while pending:
+        box_start, box_end = pending.pop()
+        for box_type, payload, payload_end in iter_boxes(data, box_start, box_end):
+            if box_type in CONTAINER_BOXES:
+                pending.append((payload, payload_end))
+            elif box_type == b'tkhd':
+                # Width and height are 16.16 fixed point numbers ending the box
+                width, height = struct.unpack_from('>II', data, payload_end - 8)
+                width, height = width >> 16, height >> 16
+            elif box_type == b'hdlr':
+                handler = bytes(data[payload + 8:payload + 12])
+            elif box_type == b'stsd':
+                if struct.unpack_from('>I', data, payload + 4)[0]:
+                    codec = bytes(data[payload + 12:payload + 16]).decode('ascii', 'replace').strip()
+
+    if handler == b'vide' and 'video_codec' not in facts:
+        facts['width'], facts['height'] = width, height
+        facts['video_codec'] = codec
+    elif handler == b'soun' and 'audio_codec' not in facts:
+        facts['audio_codec'] = codec
+
+
+def parse_moov(data, facts):
+    for box_type, payload, payload_end in iter_boxes(data):
+        if box_type == b'mvhd':
+            parse_mvhd(data, payload, facts)
+        elif box_type == b'trak':
+            parse_trak(data, payload, payload_end, facts)
+
+
+def probe(path):
+    """Read the container structure of an mp4 file and return what it tells about the video.
+
+    Only box headers and the movie box are read. The returned dict holds the size,
+    brand, top level boxes as (type, offset, size), whether the movie box comes
+    before the media data (faststart), and when found the duration in seconds,
+    bitrate in bits per second, width, height, video_codec and audio_codec.
+    Raise MP4Error if the file is not an mp4 video.
+    """
+    size = os.path.getsize(path)
+    facts = {'size': size, 'boxes': []}
+    with open(path, 'rb') as f:
+        if f.read(8)[4:] != b'ftyp':
+            raise MP4Error("no ftyp box, this is not an mp4 file")
+        offset = 0
+        moov = None
+        while offset < size:
+            box_type, header_size, box_size = read_header(f, offset, size)
+            if offset == 0:
+                f.seek(header_size)
+                facts['brand'] = f.read(4).decode('ascii', 'replace').strip()
+            facts['boxes'].append((box_type.decode('ascii', 'replace'), offset, box_size))
+            if box_type == b'moov':
+                if box_size > MAX_MOOV_SIZE:
+                    raise MP4Error("movie box of %d bytes is too big" % box_size)
+                f.seek(offset + header_size)
+                moov = f.read(box_size - header_size)
+            offset += box_size
+
+    types = [box[0] for box in facts['boxes']]
+    if 'moov' not in types:
+        raise MP4Error("no moov box, the file is incomplete or not a video")
+    if 'mdat' not in types:
+        raise MP4Error("no mdat box, the file holds no media data")
+    facts['faststart'] = types.index('moov') < types.index('mdat')
+
+    try:
+        parse_moov(memoryview(moov), facts)
+    except (struct.error, IndexError):
+        raise MP4Error("movie box is corrupted")
+    if facts.get('duration'):
+        facts['bitrate'] = int(size * 8 / facts['duration'])
+    return facts
+
+
+_facts = {}
+_facts_lock = threading.Lock()
+
+
+def get_facts(path):
+    """Same as probe, but computed once per file as long as it is not modified"""
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    with _facts_lock:
+        cached = _facts.get(path)
+    if cached is not None and cached[0] == (stat.st_size, stat.st_mtime_ns):
+        return cached[1]
+    facts = probe(path)
+    with _facts_lock:
+        _facts[path] = ((stat.st_size, stat.st_mtime_ns), facts)
+    return facts
+
+
+def patch_chunk_offsets(moov, moves):
+    """Add to each chunk offset of the stco and co64 boxes of moov the shift of the box it points to.
+
+    moves holds the (start, end, shift) of the boxes, sorted by start.
+    """
+    starts = [move[0] for move in moves]
+    pending = [(8, len(moov))]
+    while pending:
+        box_start, box_end = pending.pop()
+        for box_type, payload, payload_end in iter_boxes(moov, box_start, box_end):
+            if box_type in CONTAINER_BOXES:
+                pending.append((payload, payload_end))
+            elif box_type in (b'stco', b'co64'):
+                entry = '>%dI' if box_type == b'stco' else '>%dQ'
+                count = struct.unpack_from('>I', moov, payload + 4)[0]
+                offsets = struct.unpack_from(entry % count, moov, payload + 8)
+                patched = []
+                for offset in offsets:
+                    start, end, shift = moves[max(0, bisect.bisect_right(starts, offset) - 1)]
+                    if not start <= offset < end:
+                        raise MP4Error("chunk offset %d is outside of the file boxes" % offset)
+                    patched.append(offset + shift)
+                if box_type == b'stco' and patched and max(patched) > 0xFFFFFFFF:
+                    raise MP4Error("chunk offsets would not fit in the stco box anymore")
+                struct.pack_into(entry % count, moov, payload + 8, *patched)
+
+
+def copy_range(source, destination, offset, size, buffer):
+    source.seek(offset)
+    view = memoryview(buffer)
+    while size > 0:
+        read = source.readinto(view[:min(size, len(buffer))])
+        if not read:
+            raise MP4Error("file was truncated while being copied")
+        destination.write(view[:read])
+        size -= read
+
+
+def write_faststart(path, destination, facts):
+    """Write to destination a copy of path with its movie box moved before the media data.
+
+    Only the movie box is held in memory, its chunk offsets are updated for the new
+    place of the media data. Other boxes are copied as they are.
+    """
+    boxes = facts['boxes']
+    types = [box[0] for box in boxes]
+    if 'moof' in types:
+        raise MP4Error("fragmented mp4 files are not supported")
+    moov_offset, moov_size = [(box[1], box[2]) for box in boxes if box[0] == 'moov'][0]
+    with open(path, 'rb') as f:
+        box_type, header_size, box_size = read_header(f, moov_offset, facts['size'])
+        f.seek(moov_offset + header_size)
+        # The movie box may have a 64 bits or open ended size, written again as a plain size
+        payload = f.read(box_size - header_size)
+    moov = bytearray(struct.pack('>I4s', 8 + len(payload), b'moov') + payload)
+
+    first_mdat = types.index('mdat')
+    order = [box for box in boxes[:first_mdat] if box[0] != 'moov'] + [('moov', moov_offset, moov_size)] + \
+            [box for box in boxes[first_mdat:] if box[0] != 'moov']
+    moves = []
+    offset = 0
+    for box in order:
+        moves.append((box[1], box[1] + box[2], offset - box[1]))
+        offset += len(moov) if box[0] == 'moov' else box[2]
+    try:
+        patch_chunk_offsets(moov, sorted(moves))
+    except (struct.error, IndexError):
+        raise MP4Error("movie box is corrupted")
+
+    buffer = bytearray(COPY_BLOCK_SIZE)
+    with open(path, 'rb') as source, open(destination, 'wb') as output:
+        for box in order:
+            if box[0] == 'moov':
+                output.write(moov)
+            else:
+                copy_range(source, output, box[1], box[2], buffer)
+
+
+def get_faststart_path(path):
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    key = hashlib.sha1(("%s:%d:%d" % (path, stat.st_size, stat.st_mtime_ns)).encode('utf-8')).hexdigest()[:16]
+    return os.path.join(tempfile.gettempdir(), FASTSTART_DIRECTORY, key, os.path.basename(path))
+
+
+_faststart_locks = {}
+# Held while creating or removing the directories of the copies
+_directories_lock = threading.Lock()
+
+
+def get_faststart_copy(path):
+    """Return the path of a faststart copy of path, written once, or path itself when it does not need one"""
+    try:
+        facts = get_facts(path)
+        if facts['faststart']:
+            return path
+        copy = get_faststart_path(path)
+    except (MP4Error, IOError, OSError) as e:
+        logger.warning("Prismedia: Could not check the layout of " + path + ", uploading it as is: " + str(e))
+        return path
+    with _facts_lock:
+        lock = _faststart_locks.setdefault(copy, threading.Lock())
+    # Platforms uploading the same video at the same time wait for a single copy
+    with lock:
+        if os.path.exists(copy):
+            return copy
+        start = time.time()
+        partial = copy + ".part"
+        try:
+            with _directories_lock:
+                os.makedirs(os.path.dirname(copy), exist_ok=True)
+            write_faststart(path, partial, facts)
+            os.replace(partial, copy)
+        except (MP4Error, IOError, OSError) as e:
+            logger.warning("Prismedia: Could not write a faststart copy of " + path + ", uploading it as is: " + str(e))
+            if os.path.exists(partial):
+                os.remove(partial)
+            return path
+        elapsed = time.time() - start
+        logger.info("Prismedia: Moved the movie box of %s before its media data in %.1f seconds (%.0f MB/s)" % (
+            path, elapsed, facts['size'] / 1e6 / max(elapsed, 0.001)))
+        return copy
+
+
+def remove_faststart_copy(path):
+    """Remove the faststart copy of path, if one was written"""
+    try:
+        copy = get_faststart_path(path)
+    except OSError:
+        return
+    if os.path.exists(copy):
+        os.remove(copy)
+        # Remove the directories left empty, other copies may still be in progress
+        with _directories_lock:
+            try:
+                os.rmdir(os.path.dirname(copy))
+                os.rmdir(os.path.dirname(os.path.dirname(copy)))
+            except OSError:
+                pass
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import os
+import re
+import io
+import time
+import atexit
+import logging
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger('Prismedia')
+
+# Frames kept for each traced allocation, allocations are grouped by the line making them
+TRACEMALLOC_FRAMES = 1
+
+# Lines of the allocation and CPU reports written for each phase
+TOP_ALLOCATIONS = 15
+TOP_FUNCTIONS = 20
+
+# Allocations made by imports are left out of the reports, as well as the profiling ones
+IGNORED_FILES = ("<frozen importlib._bootstrap>", "<frozen importlib._bootstrap_external>", "<unknown>")
+
+thread_time = getattr(time, 'thread_time', time.process_time)
+
+_directory = None
+_lock = threading.Lock()
+_local = threading.local()
+_stats = {}
+# Peak traced memory of each running phase, updated whenever a phase starts or ends
+_peaks = {}
+
+
+def configure(directory):
+    """Profile the run and write the CPU and allocation reports of each phase to directory"""
+    global _directory
+    if not directory:
+        return
+    # Profilers are only imported when used, they would slow down the start of every run
+    import tracemalloc
+    os.makedirs(directory, exist_ok=True)
+    _directory = directory
+    tracemalloc.start(TRACEMALLOC_FRAMES)
+    # Time spent outside of the phases is reported as the main phase
+    main = Phase("main", None, None)
+    main.start()
+    atexit.register(main.stop)
+    logger.info("Prismedia: Profiling the run, reports are written to " + directory)
+
+
+def get_stack():
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+
+def get_key(name, platform):
+    key = name if not platform else name + "-" + platform
+    return re.sub(r'[^a-z0-9_.-]+', '_', key.lower())
+
+
+def update_peaks():
+    import tracemalloc
+    # Traced memory peaks are process wide, the peak since the last update is given to every running phase
+    peak = tracemalloc.get_traced_memory()[1]
+    for phase in _peaks:
+        _peaks[phase] = max(_peaks[phase], peak)
+    if hasattr(tracemalloc, 'reset_peak'):
+        tracemalloc.reset_peak()
+
+
+def take_snapshot():
+    import tracemalloc
+    return tracemalloc.take_snapshot()
+
+
+def is_ignored(stat):
+    import pstats
+    import tracemalloc
+    # Grouped statistics are filtered, filtering the traces of a snapshot takes seconds
+    return stat.traceback[0].filename in IGNORED_FILES + (tracemalloc.__file__, pstats.__file__, __file__)
+
+
+class Phase(object):
+    """CPU profile, allocations and peak memory of one occurrence of a phase.
+
+    Phases only profile the CPU time of their own thread, time spent in a nested
+    phase is left to the nested phase. Python 3.12+ only runs one profiler at a time,
+    a phase starting while another thread is profiled gets no CPU report.
+    """
+
+    def __init__(self, name, platform, path):
+        import cProfile
+        self.name = name
+        self.platform = platform
+        self.path = path
+        self.key = get_key(name, platform)
+        self.profile = cProfile.Profile()
+        self.profiled = False
+
+    def start(self):
+        import tracemalloc
+        stack = get_stack()
+        if stack and stack[-1].profiled:
+            stack[-1].profile.disable()
+        stack.append(self)
+        with _lock:
+            update_peaks()
+            _peaks[self] = tracemalloc.get_traced_memory()[0]
+        self.snapshot = take_snapshot()
+        self.wall = time.time()
+        self.cpu = thread_time()
+        try:
+            self.profile.enable()
+            self.profiled = True
+        except ValueError as e:
+            logger.debug("Prismedia: Not profiling the CPU of " + self.key + ": " + str(e))
+
+    def stop(self):
+        if self.profiled:
+            self.profile.disable()
+        wall = time.time() - self.wall
+        cpu = thread_time() - self.cpu
+        with _lock:
+            update_peaks()
+            peak = _peaks.pop(self)
+        allocations = take_snapshot().compare_to(self.snapshot, 'lineno')
+        self.snapshot = None
+        stack = get_stack()
+        if stack and stack[-1] is self:
+            stack.pop()
+        self.write(wall, cpu, peak, allocations)
+        if stack and stack[-1].profiled:
+            try:
+                stack[-1].profile.enable()
+            except ValueError:
+                stack[-1].profiled = False
+
+    def write(self, wall, cpu, peak, allocations):
+        import pstats
+        summary = io.StringIO()
+        summary.write("%s%s%s: %.3f s wall, %.3f s CPU in its thread, %.1f MB peak traced memory\n" % (
+            self.name, " (" + self.platform + ")" if self.platform else "", " of " + self.path if self.path else "",
+            wall, cpu, peak / 1e6))
+        summary.write("\nTop allocations still held at the end of the phase, by line:\n")
+        for stat in [stat for stat in allocations if stat.size_diff > 0 and not is_ignored(stat)][:TOP_ALLOCATIONS]:
+            frame = stat.traceback[0]
+            summary.write("  %s:%d: %+.1f KB in %+d blocks\n" % (frame.filename, frame.lineno,
+                                                                 stat.size_diff / 1024.0, stat.count_diff))
+        with _lock:
+            if self.profiled:
+                stats = _stats.get(self.key)
+                if stats is None:
+                    stats = _stats[self.key] = pstats.Stats(self.profile, stream=summary)
+                else:
+                    stats.add(self.profile)
+                stats.dump_stats(os.path.join(_directory, self.key + ".pstats"))
+                summary.write("\nTop functions by own CPU time, all occurrences of the phase:\n")
+                stats.stream = summary
+                stats.sort_stats('tottime').print_stats(TOP_FUNCTIONS)
+            else:
+                summary.write("\nCPU not profiled, another phase was profiled at the same time.\n")
+            with open(os.path.join(_directory, self.key + ".txt"), 'a') as f:
+                f.write(summary.getvalue() + "\n" + "-" * 80 + "\n\n")
+
+
+@contextmanager
+def profile_phase(name, platform, path):
+    phase = Phase(name, platform, path)
+    phase.start()
+    try:
+        yield
+    finally:
+        phase.stop()
+
+
+@contextmanager
+def no_phase():
+    yield
+
+
+def phase(name, platform=None, path=None):
+    """Profile the with block it is used in as an occurrence of the phase name of platform, when profiling"""
+    if _directory is None:
+        return no_phase()
+    return profile_phase(name, platform, path)
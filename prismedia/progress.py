@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import os
+import json
+import time
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from . import profiling
+from . import trace
+
+logger = logging.getLogger('Prismedia')
+
+# Minimum seconds between two progress reports of the same upload
+REPORT_INTERVAL = 2
+
+_events = None
+_events_lock = threading.Lock()
+
+
+def configure(destination):
+    """Also write progress events as json lines to destination, a file path or a file descriptor number"""
+    global _events
+    if not destination:
+        return
+    if destination.isdigit():
+        _events = os.fdopen(int(destination), 'w')
+    else:
+        _events = open(destination, 'a')
+
+
+def write_event(event):
+    if _events is None:
+        return
+    event["time"] = time.time()
+    line = json.dumps(event) + "\n"
+    with _events_lock:
+        _events.write(line)
+        _events.flush()
+
+
+def format_size(size):
+    return "%.1f MB" % (size / 1000000.0)
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return "%dh%02dm%02ds" % (hours, minutes, seconds)
+    return "%dm%02ds" % (minutes, seconds)
+
+
+class Progress(object):
+    """Bytes sent, throughput and ETA of one upload, and the time spent in each of its phases.
+
+    update() is called from the send loop, so it only does a time comparison unless
+    a report is due.
+    """
+
+    def __init__(self, platform, path):
+        self.platform = platform
+        self.path = path
+        self.phases = OrderedDict()
+        self.total = 0
+        self.sent = 0
+        self.throttled = 0
+        self._start = None
+        self._initial = 0
+        self._last_time = None
+        self._last_sent = 0
+
+    @contextmanager
+    def phase(self, name):
+        start = time.time()
+        try:
+            with trace.span(name, platform=self.platform, file=self.path), \
+                    profiling.phase(name, self.platform, self.path):
+                yield
+        finally:
+            elapsed = time.time() - start
+            self.phases[name] = self.phases.get(name, 0) + elapsed
+            write_event({"event": "phase", "platform": self.platform, "file": self.path,
+                         "phase": name, "seconds": elapsed})
+
+    def start(self, total, sent=0):
+        self.total = total
+        self.sent = sent
+        # Bytes sent by a previous run are not part of the throughput
+        self._initial = sent
+        self._start = self._last_time = time.time()
+        self._last_sent = sent
+
+    def add_throttled(self, seconds):
+        self.throttled += seconds
+
+    def update(self, sent):
+        self.sent = sent
+        now = time.time()
+        # The end of the upload is always reported, once
+        if now - self._last_time < REPORT_INTERVAL and (sent < self.total or self._last_sent == sent):
+            return
+        self.report(now)
+
+    def report(self, now):
+        speed = (self.sent - self._last_sent) / max(now - self._last_time, 0.001)
+        average = (self.sent - self._initial) / max(now - self._start, 0.001)
+        eta = None
+        if average > 0:
+            eta = (self.total - self.sent) / average
+        self._last_time = now
+        self._last_sent = self.sent
+
+        percent = 100.0 * self.sent / self.total if self.total else 100.0
+        throttled = ""
+        if self.throttled:
+            throttled = ", throttled " + format_duration(self.throttled)
+        logger.info("%s: %s/%s (%d%%), %.1f MB/s (average %.1f MB/s), ETA %s%s"
+                    % (self.platform, format_size(self.sent), format_size(self.total), percent,
+                       speed / 1000000.0, average / 1000000.0,
+                       format_duration(eta) if eta is not None else "unknown", throttled))
+        write_event({"event": "progress", "platform": self.platform, "file": self.path,
+                     "sent": self.sent, "total": self.total, "speed": speed, "average": average, "eta": eta,
+                     "throttled": self.throttled})
+
+    def finish(self):
+        if not self.phases:
+            return
+        timings = ", ".join("%s %.1fs" % (name, seconds) for name, seconds in self.phases.items())
+        if self.throttled:
+            timings += " (throttled %.1fs)" % self.throttled
+        logger.info(self.platform + ": Timings: " + timings)
+        write_event({"event": "summary", "platform": self.platform, "file": self.path,
+                     "sent": self.sent, "total": self.total, "phases": self.phases, "throttled": self.throttled})
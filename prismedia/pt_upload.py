@@ -7,42 +7,173 @@ import json
 import logging
 import sys
 import datetime
+import time
+import threading
+from uuid import uuid4
+from concurrent.futures import ThreadPoolExecutor
 import pytz
-from os.path import splitext, basename, abspath
+from os.path import splitext, basename, abspath, getsize
 from tzlocal import get_localzone
 
 from configparser import RawConfigParser
+from requests.compat import urljoin, urlparse
+from requests.exceptions import ConnectionError, Timeout, ChunkedEncodingError
 from requests_oauthlib import OAuth2Session
 from oauthlib.oauth2 import LegacyApplicationClient
 from requests_toolbelt.multipart.encoder import MultipartEncoder
 
+from . import auth
+from . import cache
+from . import ledger
+from . import mp4
+from . import progress
+from . import retry
+from . import sender
+from . import throttle
+from . import thumbnail
+from . import trace
+from . import transport
 from . import utils
 logger = logging.getLogger('Prismedia')
 
 PEERTUBE_SECRETS_FILE = 'peertube_secret'
+# Section of peertube_secret used before several instances were supported, displayed as plain "Peertube"
+DEFAULT_INSTANCE = 'peertube'
 PEERTUBE_PRIVACY = {
     "public": 1,
     "unlisted": 2,
     "private": 3
 }
 
+# Size in MB of the chunks sent with the resumable upload
+DEFAULT_CHUNK_SIZE = 8
+
+# Maximum number of times to retry a request before giving up.
+MAX_RETRIES = 10
+
+RETRIABLE_EXCEPTIONS = (
+    ConnectionError,
+    Timeout,
+    ChunkedEncodingError,
+)
+
+RETRY_POLICY = retry.RetryPolicy("Peertube", RETRIABLE_EXCEPTIONS, max_attempts=MAX_RETRIES)
+
+# Token requests give up quickly, so an unreachable instance fails in seconds and the others carry on
+AUTH_RETRY_POLICY = retry.RetryPolicy("Peertube", RETRIABLE_EXCEPTIONS, max_attempts=3, max_delay=4, budget=30)
+
+# Requests creating something are only sent again when they never reached the instance, or were rate limited
+UNSENT_RETRY_POLICY = retry.RetryPolicy("Peertube", retriable_status_codes=(429,), max_attempts=MAX_RETRIES,
+                                        is_retriable=transport.is_unsent)
+
+# Methods which may be sent again without changing the result, other requests are not retried by default
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+
+PLAYLISTS_PAGE_SIZE = 100
+
+
+class PeertubeSession(OAuth2Session):
+    """OAuth2 session keeping its token in the credential store.
+
+    The token is refreshed shortly before it expires and once more if the instance answers 401,
+    the password is only used when no refresh token is usable.
+    """
+
+    def __init__(self, secret, store):
+        self.peertube_url = str(secret.get('peertube', 'peertube_url')).rstrip("/")
+        self.token_url = str(self.peertube_url + '/api/v1/users/token')
+        # lower as peertube does not store uppercase for pseudo
+        self.username = str(secret.get('peertube', 'username').lower())
+        self.password = str(secret.get('peertube', 'password'))
+        self.client_secret = str(secret.get('peertube', 'client_secret'))
+        self.store = store
+        self.store_key = "peertube:" + self.peertube_url + ":" + self.username
+        client_id = str(secret.get('peertube', 'client_id'))
+        super(PeertubeSession, self).__init__(client=LegacyApplicationClient(client_id=client_id),
+                                              token=store.get(self.store_key))
+        # Requests of every instance go through the connection pools of the transport
+        transport.mount(self)
+
+    def update_token(self, token):
+        self.token = token
+        self.store.set(self.store_key, token)
+
+    def fetch_password_token(self):
+        token = self.fetch_token(
+            token_url=self.token_url,
+            username=self.username,
+            password=self.password,
+            client_id=self.client_id,
+            client_secret=self.client_secret
+        )
+        self.update_token(token)
+
+    def refresh(self, stale_token=None):
+        with self.store.lock:
+            # Another worker may have refreshed the token while we were waiting
+            if stale_token is not None and self.access_token != stale_token:
+                return
+            try:
+                if not self.token.get('refresh_token'):
+                    raise ValueError("no refresh token")
+                logger.debug("Peertube: Refreshing access token.")
+                token = self.refresh_token(self.token_url,
+                                           refresh_token=self.token['refresh_token'],
+                                           client_id=self.client_id,
+                                           client_secret=self.client_secret)
+                self.update_token(token)
+            except Exception as e:
+                logger.debug("Peertube: Refresh failed (" + str(e) + "), authenticating with password.")
+                self.fetch_password_token()
+
+    def ensure_token(self):
+        if not self.token:
+            with self.store.lock:
+                if not self.token:
+                    self.fetch_password_token()
+        elif self.token.get('expires_at', float('inf')) - auth.REFRESH_MARGIN < time.time():
+            self.refresh(self.access_token)
+
+    def send_request(self, method, url, data, headers, retry, **kwargs):
+        if retry is None:
+            # A POST failing after the server committed it would create a duplicate if sent again
+            retry = method.upper() in IDEMPOTENT_METHODS
+
+        def send():
+            return super(PeertubeSession, self).request(method, url, data=data, headers=headers, **kwargs)
+        with trace.span(method + " " + urlparse(url).path, platform="peertube", url=self.peertube_url) as span:
+            # Streamed bodies can not be sent twice, their callers handle retries
+            if hasattr(data, 'read'):
+                response = send()
+            else:
+                if url == self.token_url:
+                    policy = AUTH_RETRY_POLICY if retry else UNSENT_RETRY_POLICY
+                else:
+                    policy = RETRY_POLICY if retry else UNSENT_RETRY_POLICY
+                response = policy.call(send, host=urlparse(url).netloc)
+            span.set('status', response.status_code)
+            return response
+
+    # Only idempotent requests are retried by default, retry=False disables retries for requests whose callers
+    # handle them and retry=True retries any request
+    def request(self, method, url, data=None, headers=None, retry=None, **kwargs):
+        if url == self.token_url:
+            # Asking for a token again only gives another token
+            return self.send_request(method, url, data, headers, True if retry is None else retry, **kwargs)
+        self.ensure_token()
+        stale_token = self.access_token
+        response = self.send_request(method, url, data, headers, retry, **kwargs)
+        # Token may have been revoked before its expiry, streamed bodies can not be sent twice though
+        if response.status_code == 401 and not hasattr(data, 'read'):
+            self.refresh(stale_token)
+            response = self.send_request(method, url, data, headers, retry, **kwargs)
+        return response
 
-def get_authenticated_service(secret):
-    peertube_url = str(secret.get('peertube', 'peertube_url')).rstrip("/")
 
-    oauth_client = LegacyApplicationClient(
-        client_id=str(secret.get('peertube', 'client_id'))
-    )
+def get_authenticated_service(secret):
     try:
-        oauth = OAuth2Session(client=oauth_client)
-        oauth.fetch_token(
-            token_url=str(peertube_url + '/api/v1/users/token'),
-            # lower as peertube does not store uppercase for pseudo
-            username=str(secret.get('peertube', 'username').lower()),
-            password=str(secret.get('peertube', 'password')),
-            client_id=str(secret.get('peertube', 'client_id')),
-            client_secret=str(secret.get('peertube', 'client_secret'))
-        )
+        oauth = PeertubeSession(secret, auth.get_store())
+        oauth.ensure_token()
     except Exception as e:
         if hasattr(e, 'message'):
             logger.critical("Peertube: " + str(e.message))
@@ -53,14 +184,44 @@ def get_authenticated_service(secret):
     return oauth
 
 
-def get_default_channel(user_info):
-    return user_info['videoChannels'][0]['id']
+def get_label(instance):
+    if instance == DEFAULT_INSTANCE:
+        return "Peertube"
+    return "Peertube " + instance
+
+
+def get_account(secret):
+    return "peertube:" + str(secret.get('peertube', 'peertube_url')).rstrip('/') + ":" + \
+           str(secret.get('peertube', 'username').lower())
+
+
+def get_channels(oauth, url):
+    user_info = json.loads(oauth.get(url + "/api/v1/users/me").content)
+    return [[channel['displayName'], channel['id']] for channel in user_info['videoChannels']]
 
 
-def get_channel_by_name(user_info, options):
-    for channel in user_info["videoChannels"]:
-        if channel['displayName'] == options.get('--channel'):
-            return channel['id']
+def get_playlists(oauth, url, username):
+    playlists = []
+    start = 0
+    while True:
+        response = json.loads(oauth.get(url + "/api/v1/accounts/" + username + "/video-playlists",
+                                        params={'start': start, 'count': PLAYLISTS_PAGE_SIZE}).content)
+        playlists.extend([playlist['displayName'], playlist['id']] for playlist in response['data'])
+        start += len(response['data'])
+        if not response['data'] or start >= response['total']:
+            return playlists
+
+
+def get_default_channel(oauth, secret):
+    url = str(secret.get('peertube', 'peertube_url')).rstrip('/')
+    channels = cache.get_cache().get_index(get_account(secret), 'channels', lambda: get_channels(oauth, url))
+    return channels[0][1]
+
+
+def get_channel_by_name(oauth, secret, options):
+    url = str(secret.get('peertube', 'peertube_url')).rstrip('/')
+    return cache.get_cache().lookup(get_account(secret), 'channels', options.get('--channel'),
+                                    lambda: get_channels(oauth, url))
 
 
 def create_channel(oauth, url, options):
@@ -104,14 +265,11 @@ def create_channel(oauth, url, options):
             exit(1)
 
 
-def get_default_playlist(user_info):
-    return user_info['videoChannels'][0]['id']
-
-
-def get_playlist_by_name(user_playlists, options):
-    for playlist in user_playlists["data"]:
-        if playlist['displayName'] == options.get('--playlist'):
-            return playlist['id']
+def get_playlist_by_name(oauth, secret, options):
+    url = str(secret.get('peertube', 'peertube_url')).rstrip('/')
+    username = str(secret.get('peertube', 'username').lower())
+    return cache.get_cache().lookup(get_account(secret), 'playlists', options.get('--playlist'),
+                                    lambda: get_playlists(oauth, url, username))
 
 
 def create_playlist(oauth, url, options, channel):
@@ -151,6 +309,7 @@ def set_playlist(oauth, url, video_id, playlist_id):
     headers = {
         'Content-Type': "application/json"
     }
+    response = None
     try:
         response = oauth.post(url + "/api/v1/video-playlists/"+str(playlist_id)+"/videos",
                               data=data,
@@ -160,32 +319,113 @@ def set_playlist(oauth, url, video_id, playlist_id):
             logger.error("Peertube: " + str(e.message))
         else:
             logger.error("Peertube: " + str(e))
-    if response is not None:
-        if response.status_code == 200:
-            logger.info('Peertube: Video is successfully added to the playlist.')
-        else:
-            logger.critical(('Peertube: Configuring the playlist failed with an unexpected response: '
-                           '%s') % response)
-            exit(1)
+    if response is not None and response.status_code == 200:
+        logger.info('Peertube: Video is successfully added to the playlist.')
+    else:
+        logger.critical(('Peertube: Configuring the playlist failed with an unexpected response: '
+                         '%s') % response)
+        exit(1)
 
 
-def upload_video(oauth, secret, options):
+# Return the multipart body before and after the content of the file field, which is sent separately
+def get_multipart_frame(fields, name, filename, mimetype, boundary):
+    tail = ('\r\n--' + boundary + '--\r\n').encode('utf-8')
+    body = MultipartEncoder(fields + [(name, (filename, b'', mimetype))], boundary).to_string()
+    return body[:-len(tail)], tail
 
-    def get_userinfo():
-        return json.loads(oauth.get(url+"/api/v1/users/me").content)
 
-    def get_file(path):
-        mimetypes.init()
-        return (basename(path), open(abspath(path), 'rb'),
-                mimetypes.types_map[splitext(path)[1]])
+# Return the first byte the server has not received yet, from a "Range: bytes=0-N" header
+def get_resumable_offset(response):
+    received = response.headers.get('Range')
+    if not received:
+        return 0
+    return int(received.split('-')[-1]) + 1
 
-    def get_playlist(username):
-        return json.loads(oauth.get(url+"/api/v1/accounts/"+username+"/video-playlists").content)
 
+# Upload the video with the resumable protocol available since Peertube 3.3.
+# Return None if the instance does not support it so we may fallback on the legacy upload
+def upload_resumable(oauth, url, path, fields, chunk_size, upload_progress):
+    size = getsize(path)
+    mimetype = mimetypes.guess_type(path)[0] or 'video/mp4'
+    # Initialize the upload session with the same fields as the legacy upload, but the video.
+    # The boundary is fixed so the multipart body may be built again on retries
+    boundary = uuid4().hex
+    headers = {
+        'Content-Type': 'multipart/form-data; boundary=' + boundary,
+        'X-Upload-Content-Length': str(size),
+        'X-Upload-Content-Type': mimetype
+    }
+    response = RETRY_POLICY.call(lambda: oauth.post(url + "/api/v1/videos/upload-resumable",
+                                                    data=MultipartEncoder(fields + [("filename", basename(path))], boundary),
+                                                    headers=headers,
+                                                    retry=False),
+                                 host=urlparse(url).netloc)
+    if response.status_code in (404, 405):
+        return None
+    if response.status_code != 201:
+        return response
+    upload_url = urljoin(url + "/", response.headers['Location'])
+
+    state = {"offset": 0, "query": False}
+    upload_progress.start(size)
+
+    def send_chunk():
+        if state["query"]:
+            # Ask the server what it really received before sending anything again
+            headers = {
+                'Content-Range': 'bytes */%d' % size,
+                'Content-Length': '0'
+            }
+            return oauth.put(upload_url, headers=headers, retry=False)
+        length = min(chunk_size, size - state["offset"])
+        headers = {
+            'Content-Type': 'application/octet-stream',
+            'Content-Range': 'bytes %d-%d/%d' % (state["offset"], state["offset"] + length - 1, size)
+        }
+        # The chunk is read from the file while it is sent, at the rate allowed for Peertube
+        return oauth.put(upload_url, data=sender.FileBody(video, state["offset"], length), headers=headers,
+                         retry=False)
+
+    def query_offset():
+        state["query"] = True
+
+    with open(abspath(path), 'rb') as f:
+        video = throttle.wrap(f, "peertube", upload_progress)
+        while True:
+            response = RETRY_POLICY.call(send_chunk, host=urlparse(upload_url).netloc, on_retry=query_offset)
+            # 308 Resume Incomplete, the server acknowledged the bytes it received so far
+            if response.status_code != 308:
+                if response.status_code == 200:
+                    upload_progress.update(size)
+                return response
+            state["offset"] = get_resumable_offset(response)
+            state["query"] = False
+            upload_progress.update(state["offset"])
+
+
+def upload_video(oauth, secret, options, upload_progress=None, instance=DEFAULT_INSTANCE):
     path = options.get('--file')
     url = str(secret.get('peertube', 'peertube_url')).rstrip('/')
-    user_info = get_userinfo()
-    user_playlists = get_playlist(str(secret.get('peertube', 'username').lower()))
+    label = get_label(instance)
+    if upload_progress is None:
+        upload_progress = progress.Progress(label, path)
+
+    # The ledger lookup and the job share the fingerprint of the video, computed once
+    with upload_progress.phase('fingerprint'):
+        uploaded_url = ledger.get_ledger().lookup(path, "peertube:" + url)
+        job = None if uploaded_url else ledger.get_ledger().job(path, "peertube:" + url)
+    if uploaded_url:
+        logger.info(label + ": " + path + " was already uploaded at " + uploaded_url +
+                    ", skipping. Use --force to upload it again.")
+        if options.get('--url-only'):
+            logging.getLogger('stdoutlogs').info(uploaded_url)
+        elif options.get('--batch'):
+            logging.getLogger('stdoutlogs').info(label + ": " + uploaded_url)
+        return uploaded_url
+
+    if job.steps:
+        logger.info(label + ": Resuming the upload of " + path + " after step " + job.last())
+    job.complete('authenticated')
 
     # We need to transform fields into tuple to deal with tags as
     # MultipartEncoder does not support list refer
@@ -195,8 +435,7 @@ def upload_video(oauth, secret, options):
         ("name", options.get('--name') or splitext(basename(options.get('--file')))[0]),
         ("licence", "1"),
         ("description", options.get('--description')  or "default description"),
-        ("nsfw", str(int(options.get('--nsfw')) or "0")),
-        ("videofile", get_file(path))
+        ("nsfw", str(int(options.get('--nsfw')) or "0"))
     ]
 
     if options.get('--tags'):
@@ -250,81 +489,230 @@ def upload_video(oauth, secret, options):
     else:
         fields.append(("privacy", str(PEERTUBE_PRIVACY[privacy or "private"])))
 
-    if options.get('--thumbnail'):
-        fields.append(("thumbnailfile", get_file(options.get('--thumbnail'))))
-        fields.append(("previewfile", get_file(options.get('--thumbnail'))))
-
-    if options.get('--channel'):
-        channel_id = get_channel_by_name(user_info, options)
-        if not channel_id and options.get('--channelCreate'):
-            channel_id = create_channel(oauth, url, options)
-        elif not channel_id:
-            logger.warning("Peertube: Channel `" + options.get('--channel') + "` is unknown, using default channel.")
-            channel_id = get_default_channel(user_info)
+    if options.get('--thumbnail') and not job.done('uploaded'):
+        with upload_progress.phase('thumbnail'):
+            # Read and resized once, then shared by both fields and every attempt
+            image = (basename(options.get('--thumbnail')),
+                     thumbnail.get_thumbnail(options.get('--thumbnail')), 'image/jpeg')
+        fields.append(("thumbnailfile", image))
+        fields.append(("previewfile", image))
+
+    if job.done('resolved') and job.get('channel') == options.get('--channel') and \
+            job.get('playlist') == options.get('--playlist'):
+        channel_id, playlist_id = job.get('channel_id'), job.get('playlist_id')
     else:
-        channel_id = get_default_channel(user_info)
+        channel_id = resolve_channel(oauth, secret, options, upload_progress)
+        playlist_id = resolve_playlist(oauth, secret, options, channel_id, upload_progress)
+        job.complete('resolved', channel=options.get('--channel'), channel_id=channel_id,
+                     playlist=options.get('--playlist'), playlist_id=playlist_id)
 
     fields.append(("channelId", str(channel_id)))
 
-    if options.get('--playlist'):
-        playlist_id = get_playlist_by_name(user_playlists, options)
-        if not playlist_id and options.get('--playlistCreate'):
-            playlist_id = create_playlist(oauth, url, options, channel_id)
-        elif not playlist_id:
-            logger.critical("Peertube: Playlist `" + options.get('--playlist') + "` does not exist, please set --playlistCreate"
-                            " if you want to create it")
-            exit(1)
-
     logger_stdout = None
     if options.get('--url-only') or options.get('--batch'):
         logger_stdout = logging.getLogger('stdoutlogs')
 
-    multipart_data = MultipartEncoder(fields)
-
-    headers = {
-        'Content-Type': multipart_data.content_type
-    }
-    response = oauth.post(url + "/api/v1/videos/upload",
-                          data=multipart_data,
-                          headers=headers)
-    if response is not None:
-        if response.status_code == 200:
-            jresponse = response.json()
-            jresponse = jresponse['video']
-            uuid = jresponse['uuid']
-            video_id = str(jresponse['id'])
-            logger.info('Peertube : Video was successfully uploaded.')
-            template = 'Peertube: Watch it at %s/videos/watch/%s.'
-            logger.info(template % (url, uuid))
-            template_stdout = '%s/videos/watch/%s'
-            if options.get('--url-only'):
-                logger_stdout.info(template_stdout % (url, uuid))
-            elif options.get('--batch'):
-                logger_stdout.info("Peertube: " + template_stdout % (url, uuid))
-            # Upload is successful we may set playlist
-            if options.get('--playlist'):
-                set_playlist(oauth, url, video_id, playlist_id)
-        else:
+    template_stdout = '%s/videos/watch/%s'
+    if job.done('uploaded'):
+        video_id, watch_url = job.get('video_id'), job.get('url')
+        logger.info(label + ": " + path + " was already sent at " + watch_url + ", skipping the upload.")
+    else:
+        source = path
+        if options.get('--faststart'):
+            with upload_progress.phase('faststart'):
+                source = mp4.get_faststart_copy(path)
+        chunk_size = int(options.get('--chunk-size') or DEFAULT_CHUNK_SIZE) * 1024 * 1024
+        with upload_progress.phase('transfer'):
+            response = upload_resumable(oauth, url, source, fields, chunk_size, upload_progress)
+            if response is None:
+                logger.info('Peertube: Resumable upload is not supported by this instance, using legacy upload.')
+                boundary = uuid4().hex
+                headers = {
+                    'Content-Type': 'multipart/form-data; boundary=' + boundary
+                }
+
+                mimetype = mimetypes.guess_type(path)[0] or 'video/mp4'
+
+                # Build the multipart body again with a new file handle on each attempt. The video would be
+                # published twice if a request the instance received was sent again, only retry those which
+                # never reached it. The ledger uploads the others again on the next run.
+                def post_video():
+                    with open(abspath(source), 'rb') as video:
+                        size = getsize(abspath(source))
+                        head, tail = get_multipart_frame(fields, "videofile", basename(path), mimetype, boundary)
+                        upload_progress.start(size)
+                        multipart_data = sender.FileBody(throttle.wrap(video, "peertube", upload_progress), 0, size,
+                                                         head, tail, upload_progress.update)
+                        return oauth.post(url + "/api/v1/videos/upload",
+                                          data=multipart_data,
+                                          headers=headers,
+                                          retry=False)
+                response = UNSENT_RETRY_POLICY.call(post_video, host=urlparse(url).netloc)
+        if response.status_code != 200:
             logger.critical(('Peertube: The upload failed with an unexpected response: '
-                           '%s') % response)
+                             '%s') % response)
             exit(1)
+        jresponse = response.json()
+        jresponse = jresponse['video']
+        uuid = jresponse['uuid']
+        video_id = str(jresponse['id'])
+        watch_url = template_stdout % (url, uuid)
+        # Save the upload before anything else may fail, so a new run does not upload it twice
+        job.complete('uploaded', video_id=video_id, url=watch_url)
+        logger.info('Peertube : Video was successfully uploaded.')
+        logger.info('Peertube: Watch it at %s.' % watch_url)
+    if options.get('--url-only'):
+        logger_stdout.info(watch_url)
+    elif options.get('--batch'):
+        logger_stdout.info(label + ": " + watch_url)
+
+    # Upload is successful we may set playlist
+    if playlist_id and not job.done('playlist'):
+        with upload_progress.phase('playlist'):
+            set_playlist(oauth, url, video_id, playlist_id)
+        job.complete('playlist')
+    ledger.get_ledger().finish(job, path, watch_url)
+    return watch_url
+
+
+def resolve_channel(oauth, secret, options, upload_progress):
+    url = str(secret.get('peertube', 'peertube_url')).rstrip('/')
+    if options.get('--channel'):
+        with upload_progress.phase('lookup'):
+            channel_id = get_channel_by_name(oauth, secret, options)
+        if not channel_id and options.get('--channelCreate'):
+            with upload_progress.phase('create'):
+                channel_id = create_channel(oauth, url, options)
+            cache.get_cache().add(get_account(secret), 'channels', options.get('--channel'), channel_id)
+        elif not channel_id:
+            logger.warning("Peertube: Channel `" + options.get('--channel') + "` is unknown, using default channel.")
+            with upload_progress.phase('lookup'):
+                channel_id = get_default_channel(oauth, secret)
+    else:
+        with upload_progress.phase('lookup'):
+            channel_id = get_default_channel(oauth, secret)
+    return channel_id
+
+
+def resolve_playlist(oauth, secret, options, channel_id, upload_progress):
+    url = str(secret.get('peertube', 'peertube_url')).rstrip('/')
+    if not options.get('--playlist'):
+        return None
+    with upload_progress.phase('lookup'):
+        playlist_id = get_playlist_by_name(oauth, secret, options)
+    if not playlist_id and options.get('--playlistCreate'):
+        with upload_progress.phase('create'):
+            playlist_id = create_playlist(oauth, url, options, channel_id)
+        cache.get_cache().add(get_account(secret), 'playlists', options.get('--playlist'), playlist_id)
+    elif not playlist_id:
+        logger.critical("Peertube: Playlist `" + options.get('--playlist') + "` does not exist, please set --playlistCreate"
+                        " if you want to create it")
+        exit(1)
+    return playlist_id
 
 
-def run(options):
+def load_secret():
     secret = RawConfigParser()
     try:
         secret.read(PEERTUBE_SECRETS_FILE)
     except Exception as e:
         logger.critical("Peertube: Error loading " + str(PEERTUBE_SECRETS_FILE) + ": " + str(e))
         exit(1)
-    insecure_transport = secret.get('peertube', 'OAUTHLIB_INSECURE_TRANSPORT')
-    os.environ['OAUTHLIB_INSECURE_TRANSPORT'] = insecure_transport
-    oauth = get_authenticated_service(secret)
-    try:
-        logger.info('Peertube: Uploading video...')
-        upload_video(oauth, secret, options)
-    except Exception as e:
-        if hasattr(e, 'message'):
-            logger.error("Peertube: " + str(e.message))
-        else:
-            logger.error("Peertube: " + str(e))
+    # The environment is shared by all instances, the default one decides if it is set in several
+    for section in sorted(secret.sections(), key=lambda section: section != DEFAULT_INSTANCE):
+        if secret.has_option(section, 'OAUTHLIB_INSECURE_TRANSPORT'):
+            os.environ['OAUTHLIB_INSECURE_TRANSPORT'] = secret.get(section, 'OAUTHLIB_INSECURE_TRANSPORT')
+            break
+    return secret
+
+
+def get_instances(secret, selection=None):
+    """Return the sections of the instances to upload to, every instance when selection is empty or all"""
+    instances = [section for section in secret.sections() if secret.has_option(section, 'peertube_url')]
+    if not instances:
+        logger.critical("Peertube: No instance found in " + PEERTUBE_SECRETS_FILE)
+        exit(1)
+    if not selection or selection.strip() == 'all':
+        return instances
+    selected = []
+    for instance in selection.split(','):
+        instance = instance.strip()
+        if instance not in instances:
+            logger.critical("Peertube: Instance " + instance + " not found in " + PEERTUBE_SECRETS_FILE +
+                            ", available instances are " + ", ".join(instances))
+            exit(1)
+        if instance not in selected:
+            selected.append(instance)
+    return selected
+
+
+def get_instance_secret(secret, instance):
+    """Return the secret of instance as a [peertube] section, as read by the rest of this module"""
+    instance_secret = RawConfigParser()
+    instance_secret.add_section('peertube')
+    for key, value in secret.items(instance):
+        instance_secret.set('peertube', key, value)
+    return instance_secret
+
+
+class InstanceSessions(object):
+    """Authenticate each instance once, on first use, and share its session between uploads"""
+
+    def __init__(self, secret=None):
+        self.secret = secret or load_secret()
+        self._lock = threading.Lock()
+        self._locks = {}
+        self._sessions = {}
+
+    def get(self, instance):
+        # One lock per instance so an unreachable instance does not block the others
+        with self._lock:
+            lock = self._locks.setdefault(instance, threading.Lock())
+        with lock:
+            if instance not in self._sessions:
+                instance_secret = get_instance_secret(self.secret, instance)
+                self._sessions[instance] = instance_secret, get_authenticated_service(instance_secret)
+            return self._sessions[instance]
+
+
+def get_session():
+    return InstanceSessions()
+
+
+def run_instance(options, sessions, instance):
+    label = get_label(instance)
+    upload_progress = progress.Progress(label, options.get('--file'))
+    with trace.span("instance", platform=label, instance=instance) as span:
+        try:
+            with upload_progress.phase('auth'):
+                secret, oauth = sessions.get(instance)
+            logger.info(label + ': Uploading video...')
+            return upload_video(oauth, secret, options, upload_progress, instance)
+        except Exception as e:
+            span.set('error', e.__class__.__name__ + ": " + str(e))
+            if hasattr(e, 'message'):
+                logger.error(label + ": " + str(e.message))
+            else:
+                logger.error(label + ": " + str(e))
+        finally:
+            upload_progress.finish()
+
+
+def run(options, session=None):
+    """Upload to the selected instances, return the url, or the url of each instance when there are several"""
+    sessions = session or InstanceSessions()
+    instances = get_instances(sessions.secret, options.get('--peertube-instances'))
+    if len(instances) == 1:
+        return run_instance(options, sessions, instances[0])
+
+    with ThreadPoolExecutor(max_workers=len(instances)) as executor:
+        futures = [(instance, executor.submit(trace.bind(run_instance), options, sessions, instance))
+                   for instance in instances]
+    results = {}
+    # Instances exit on fatal errors, which should only stop the upload to that instance
+    for instance, future in futures:
+        try:
+            results[instance] = future.result()
+        except SystemExit:
+            results[instance] = None
+    return results
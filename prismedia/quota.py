@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import os
+import json
+import time
+import logging
+import datetime
+import threading
+from contextlib import contextmanager
+from os.path import exists
+
+logger = logging.getLogger('Prismedia')
+
+# Units used today by each Google Cloud project, indexed by project
+QUOTA_PATH = ".prismedia_quota.json"
+
+# Units a project may use each day, the default allocation of the Youtube Data API
+DEFAULT_LIMIT = 10000
+
+# Quotas reset at midnight Pacific time
+QUOTA_TIMEZONE = 'America/Los_Angeles'
+
+_timezone = None
+_local = threading.local()
+# Reset time of the videos deferred to the next quota window, by path
+_deferred = {}
+_deferred_lock = threading.Lock()
+
+
+class QuotaExceeded(Exception):
+    """Raised when a job needs more units than left in the current quota window"""
+
+    def __init__(self, project, cost, remaining, reset):
+        self.cost = cost
+        self.remaining = remaining
+        self.reset = reset
+        super(QuotaExceeded, self).__init__(
+            "%d quota units needed but %d left for %s, the quota resets at %s" % (
+                cost, remaining, project, format_time(reset)))
+
+
+def get_timezone():
+    global _timezone
+    if _timezone is None:
+        try:
+            from zoneinfo import ZoneInfo
+            _timezone = ZoneInfo(QUOTA_TIMEZONE)
+        except (ImportError, KeyError):
+            # Python < 3.9, or no time zone database as on Windows without tzdata. pytz takes longer to load
+            import pytz
+            _timezone = pytz.timezone(QUOTA_TIMEZONE)
+    return _timezone
+
+
+def get_window(now=None):
+    """Return the Pacific day of now, and the timestamp of the next Pacific midnight when it ends"""
+    timezone = get_timezone()
+    now = time.time() if now is None else now
+    day = datetime.datetime.fromtimestamp(now, timezone).date()
+    midnight = datetime.datetime.combine(day + datetime.timedelta(days=1), datetime.time())
+    if hasattr(timezone, 'localize'):
+        midnight = timezone.localize(midnight)
+    else:
+        midnight = midnight.replace(tzinfo=timezone)
+    return day.isoformat(), midnight.timestamp()
+
+
+def format_time(timestamp):
+    return datetime.datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M')
+
+
+class Reservation(object):
+    """Units set aside for a job, which its calls use before those left to other jobs"""
+
+    def __init__(self, project, cost):
+        self.project = project
+        self.left = cost
+
+
+class QuotaCounter(object):
+    """Quota units used by each project in the current window, kept in a json file.
+
+    Every call adds its cost to the counter of its project, which starts from zero each
+    Pacific day. Jobs reserve their whole cost before making their first call, so
+    concurrent workers do not start more jobs than the remaining units allow. The file
+    is read again before each update, in case another run used the same project.
+    """
+
+    def __init__(self, path=QUOTA_PATH, limit=DEFAULT_LIMIT):
+        self.path = path
+        self.limit = limit
+        self._lock = threading.Lock()
+        self._reserved = {}
+
+    def _load(self):
+        if not exists(self.path):
+            return {}
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except ValueError:
+            logger.warning("Prismedia: " + self.path + " is corrupted, counting quota from zero.")
+            return {}
+
+    def _save(self, counters):
+        with open(self.path + ".tmp", 'w') as f:
+            json.dump(counters, f)
+        os.replace(self.path + ".tmp", self.path)
+
+    def _used(self, counters, project, window):
+        counter = counters.get(project)
+        if counter is None or counter["window"] != window:
+            return 0
+        return counter["used"]
+
+    def _add(self, project, units):
+        window = get_window()[0]
+        counters = self._load()
+        used = self._used(counters, project, window) + units
+        counters[project] = {"window": window, "used": used}
+        self._save(counters)
+        return used
+
+    @contextmanager
+    def reserve(self, project, cost):
+        """Set aside cost units for the calls of the with block, raise QuotaExceeded if too few are left"""
+        with self._lock:
+            window, reset = get_window()
+            used = self._used(self._load(), project, window)
+            remaining = max(0, self.limit - used - self._reserved.get(project, 0))
+            if cost > remaining:
+                raise QuotaExceeded(project, cost, remaining, reset)
+            self._reserved[project] = self._reserved.get(project, 0) + cost
+        reservation = _local.reservation = Reservation(project, cost)
+        try:
+            yield reservation
+        finally:
+            _local.reservation = None
+            with self._lock:
+                self._reserved[project] -= reservation.left
+
+    def spend(self, project, cost):
+        """Count a call of cost units, taken from the reservation of the job of this thread if any"""
+        with self._lock:
+            reservation = getattr(_local, 'reservation', None)
+            if reservation is not None and reservation.project == project:
+                taken = min(cost, reservation.left)
+                reservation.left -= taken
+                self._reserved[project] -= taken
+            used = self._add(project, cost)
+        logger.debug("Prismedia: %d quota units used today by %s" % (used, project))
+
+    def exhaust(self, project):
+        """Count the whole quota as used, when the platform says it is exceeded"""
+        with self._lock:
+            used = self._used(self._load(), project, get_window()[0])
+            if used < self.limit:
+                self._add(project, self.limit - used)
+
+
+_counter = None
+_counter_lock = threading.Lock()
+
+
+def get_counter():
+    global _counter
+    with _counter_lock:
+        if _counter is None:
+            _counter = QuotaCounter()
+        return _counter
+
+
+def configure(limit=None):
+    if limit is not None:
+        get_counter().limit = limit
+
+
+def defer(path, reset):
+    """Remember that the upload of path waits for the quota to reset"""
+    with _deferred_lock:
+        _deferred[path] = reset
+
+
+def pop_deferred(path):
+    """Return the time at which the deferred upload of path may start again, or None if it was not deferred"""
+    with _deferred_lock:
+        return _deferred.pop(path, None)
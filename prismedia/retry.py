@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import time
+import random
+import logging
+import threading
+from email.utils import parsedate_tz, mktime_tz
+
+from . import trace
+
+logger = logging.getLogger('Prismedia')
+
+# 429 is sent by servers asking to slow down, usually with a Retry-After header
+RETRIABLE_STATUS_CODES = (429, 500, 502, 503, 504)
+
+# Consecutive failures before a host is considered down, and seconds before trying it again
+CIRCUIT_FAILURE_THRESHOLD = 5
+CIRCUIT_COOLDOWN = 60
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker(object):
+    """Stop sending requests to a host after too many consecutive failures.
+
+    Once open, requests are allowed again after the cooldown; a single failure then
+    opens the circuit again, a success closes it.
+    """
+
+    def __init__(self, host, threshold=CIRCUIT_FAILURE_THRESHOLD, cooldown=CIRCUIT_COOLDOWN):
+        self.host = host
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def wait_time(self):
+        with self._lock:
+            if self.opened_at is None:
+                return 0
+            return max(0, self.opened_at + self.cooldown - time.time())
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.opened_at is not None or self.failures >= self.threshold:
+                if self.opened_at is None:
+                    logger.warning("Prismedia: Too many failures on " + self.host + ", pausing requests to this host.")
+                self.opened_at = time.time()
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(host):
+    with _breakers_lock:
+        if host not in _breakers:
+            _breakers[host] = CircuitBreaker(host)
+        return _breakers[host]
+
+
+# Work on requests responses and exceptions as well as googleapiclient HttpError
+def get_status(outcome):
+    if hasattr(outcome, 'status_code'):
+        return outcome.status_code
+    return getattr(getattr(outcome, 'resp', None), 'status', None)
+
+
+def get_retry_after(outcome):
+    headers = getattr(outcome, 'headers', None)
+    if headers is None:
+        headers = getattr(outcome, 'resp', None)
+    if not hasattr(headers, 'get'):
+        return None
+    value = headers.get('Retry-After') or headers.get('retry-after')
+    if not value:
+        return None
+    try:
+        return max(0, int(value))
+    except ValueError:
+        date = parsedate_tz(value)
+        if date is None:
+            return None
+        return max(0, mktime_tz(date) - time.time())
+
+
+class RetryPolicy(object):
+    """Exponential backoff with full jitter, bounded by a number of attempts and a time budget.
+
+    A call is retried when it raises one of the retriable exceptions, or an error
+    is_retriable accepts, or when its response or error carries a retriable status
+    code. Failures are reported to the circuit breaker of the host, if any.
+    """
+
+    def __init__(self, name, retriable_exceptions=(), retriable_status_codes=RETRIABLE_STATUS_CODES,
+                 max_attempts=10, base_delay=1, max_delay=64, budget=900, is_retriable=None):
+        self.name = name
+        self.retriable_exceptions = tuple(retriable_exceptions)
+        self.is_retriable = is_retriable
+        self.retriable_status_codes = retriable_status_codes
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget = budget
+
+    def delay(self, attempt, retry_after=None):
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+    def call(self, func, host=None, on_retry=None):
+        """Call func until it succeeds or is not retriable.
+
+        On exhaustion the last response is returned, or the last error raised, so
+        callers handle them as if there had been no retry at all.
+        on_retry is called before each new attempt.
+        """
+        breaker = get_breaker(host) if host else None
+        deadline = time.time() + self.budget
+        attempt = 0
+        while True:
+            if breaker:
+                wait = breaker.wait_time()
+                if wait > deadline - time.time():
+                    raise CircuitOpenError(self.name + ": " + host + " is failing, giving up.")
+                if wait:
+                    logger.info("%s: Waiting %.1f seconds before trying %s again..." % (self.name, wait, host))
+                    time.sleep(wait)
+
+            attempt += 1
+            error = None
+            try:
+                result = func()
+            except Exception as e:
+                trace.annotate(status=get_status(e), retries=attempt - 1)
+                if not isinstance(e, self.retriable_exceptions) and \
+                        get_status(e) not in self.retriable_status_codes and \
+                        not (self.is_retriable is not None and self.is_retriable(e)):
+                    raise
+                error = e
+                outcome = e
+            else:
+                trace.annotate(status=get_status(result), retries=attempt - 1)
+                if get_status(result) not in self.retriable_status_codes:
+                    if breaker:
+                        breaker.record_success()
+                    return result
+                outcome = result
+
+            if breaker:
+                breaker.record_failure()
+            delay = self.delay(attempt, get_retry_after(outcome))
+            if attempt >= self.max_attempts or time.time() + delay > deadline:
+                logger.error(self.name + ": No longer attempting to retry.")
+                if error is not None:
+                    raise error
+                return result
+
+            if error is not None:
+                description = str(error) or error.__class__.__name__
+            else:
+                description = "HTTP error %d" % get_status(result)
+            logger.warning("%s: A retriable error occurred: %s. Retrying in %.1f seconds (attempt %d/%d)..."
+                           % (self.name, description, delay, attempt, self.max_attempts))
+            time.sleep(delay)
+            if on_retry is not None:
+                on_retry()
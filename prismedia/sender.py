@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import os
+import logging
+import threading
+
+from requests.adapters import HTTPAdapter
+from urllib3 import HTTPConnectionPool
+from urllib3.connection import HTTPConnection
+
+from . import throttle
+
+logger = logging.getLogger('Prismedia')
+
+# Video bytes are read and sent in blocks of this size, reads being aligned on it
+BLOCK_SIZE = 1024 * 1024
+
+# Bytes handed to each sendfile call, so the progress of the upload is still reported
+SENDFILE_BLOCK_SIZE = 16 * 1024 * 1024
+
+_buffers = threading.local()
+
+
+def get_buffer():
+    # Each thread reuses the same buffer for every block it sends
+    buffer = getattr(_buffers, 'buffer', None)
+    if buffer is None:
+        buffer = _buffers.buffer = bytearray(BLOCK_SIZE)
+    return buffer
+
+
+class FileSegment(object):
+    """Part of a FileBody sent with sendfile by SendfileHTTPConnection"""
+
+    def __init__(self, body):
+        self.body = body
+
+    def sendfile(self, sock):
+        body = self.body
+        sent = 0
+        while sent < body.length:
+            count = min(SENDFILE_BLOCK_SIZE, body.length - sent)
+            written = sock.sendfile(body.file, body.offset + sent, count)
+            if not written:
+                raise IOError("file was truncated while being sent")
+            sent += written
+            body.report(sent)
+
+
+class FileBody(object):
+    """Request body made of length bytes of f starting at offset, between an optional head and tail.
+
+    Iterating it yields the head, the bytes of the file and the tail. The file is read
+    in blocks of BLOCK_SIZE into a reused buffer, each block being sent with one call
+    instead of the 8 KB reads and sends http.client makes on files. On plain HTTP,
+    SendfileHTTPConnection sends the file with sendfile, without copying it through
+    Python. Files throttled by the throttle module are read through their buckets.
+    The body may be sent again, on_progress being called with the bytes of the file sent.
+    """
+
+    def __init__(self, f, offset, length, head=b'', tail=b'', on_progress=None):
+        self.file = f
+        self.offset = offset
+        self.length = length
+        self.head = head
+        self.tail = tail
+        self.on_progress = on_progress
+
+    def __len__(self):
+        return len(self.head) + self.length + len(self.tail)
+
+    def report(self, sent):
+        if self.on_progress is not None:
+            self.on_progress(sent)
+
+    def can_sendfile(self):
+        if not hasattr(os, 'sendfile') or isinstance(self.file, throttle.ThrottledFile):
+            return False
+        try:
+            self.file.fileno()
+        except (AttributeError, IOError, OSError):
+            return False
+        return True
+
+    def segments(self):
+        """Same as iterating the body, with the bytes of the file as one FileSegment"""
+        if self.head:
+            yield self.head
+        if self.length:
+            yield FileSegment(self)
+        if self.tail:
+            yield self.tail
+
+    def read_blocks(self):
+        self.file.seek(self.offset)
+        sent = 0
+        if isinstance(self.file, throttle.ThrottledFile):
+            # Small blocks keep throttled uploads steady
+            while sent < self.length:
+                block = self.file.read(min(throttle.BLOCK_SIZE, self.length - sent))
+                if not block:
+                    raise IOError("file was truncated while being sent")
+                yield block
+                sent += len(block)
+                self.report(sent)
+            return
+        view = memoryview(get_buffer())
+        while sent < self.length:
+            # The first block ends on a block boundary so the next reads are aligned
+            size = min(BLOCK_SIZE - (self.offset + sent) % BLOCK_SIZE, self.length - sent)
+            read = self.file.readinto(view[:size])
+            if not read:
+                raise IOError("file was truncated while being sent")
+            yield view[:read]
+            sent += read
+            self.report(sent)
+
+    def __iter__(self):
+        if self.head:
+            yield self.head
+        for block in self.read_blocks():
+            yield block
+        if self.tail:
+            yield self.tail
+
+
+class SendfileHTTPConnection(HTTPConnection):
+    """Plain HTTP connection sending the file of FileBody bodies with sendfile"""
+
+    def request(self, method, url, body=None, headers=None, **kwargs):
+        if isinstance(body, FileBody) and body.can_sendfile():
+            body = body.segments()
+        return super(SendfileHTTPConnection, self).request(method, url, body=body, headers=headers, **kwargs)
+
+    def send(self, data):
+        if isinstance(data, FileSegment):
+            if self.sock is None:
+                self.connect()
+            data.sendfile(self.sock)
+            return
+        super(SendfileHTTPConnection, self).send(data)
+
+
+class SendfileHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = SendfileHTTPConnection
+
+
+class SendfileAdapter(HTTPAdapter):
+    """Transport adapter using SendfileHTTPConnection for plain HTTP, HTTPS bodies being sent in large blocks.
+
+    Connections are opened with socket_options, and requests sent without a timeout use the given one.
+    """
+
+    __attrs__ = HTTPAdapter.__attrs__ + ['socket_options', 'timeout']
+
+    def __init__(self, socket_options=None, timeout=None, **kwargs):
+        # Set before the parent constructor, which creates the pool manager
+        self.socket_options = socket_options
+        self.timeout = timeout
+        super(SendfileAdapter, self).__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        if self.socket_options is not None:
+            kwargs['socket_options'] = self.socket_options
+        super(SendfileAdapter, self).init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = dict(self.poolmanager.pool_classes_by_scheme,
+                                                       http=SendfileHTTPConnectionPool)
+
+    def send(self, request, timeout=None, **kwargs):
+        if timeout is None:
+            timeout = self.timeout
+        return super(SendfileAdapter, self).send(request, timeout=timeout, **kwargs)
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import re
+import time
+import logging
+import threading
+
+logger = logging.getLogger('Prismedia')
+
+# Throttled reads are split in blocks of this size, so bytes are sent steadily instead of in bursts
+BLOCK_SIZE = 64 * 1024
+
+# Shorter waits are not worth a sleep, they are added to the next one
+MIN_SLEEP = 0.005
+
+RATE_UNITS = {'': 1, 'K': 1000, 'M': 1000 ** 2, 'G': 1000 ** 3}
+
+
+def parse_rate(rate):
+    """Return the number of bytes per second of a rate such as 500K or 2M"""
+    match = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([KMG]?)B?\s*$', str(rate).upper())
+    if not match or float(match.group(1)) <= 0:
+        raise ValueError("invalid rate " + str(rate))
+    return int(float(match.group(1)) * RATE_UNITS[match.group(2)])
+
+
+class TokenBucket(object):
+    """Limit the bytes read by every upload sharing the bucket to rate bytes per second.
+
+    Readers take tokens before reading and wait when the bucket is in debt, so
+    concurrent uploads share the rate. The bucket only holds a short burst of tokens
+    to keep the throughput smooth after an idle time.
+    """
+
+    def __init__(self, name, rate):
+        self.name = name
+        self.rate = rate
+        self.burst = max(BLOCK_SIZE, rate // 20)
+        self.tokens = self.burst
+        self._last = time.time()
+        self._lock = threading.Lock()
+
+    def consume(self, size):
+        """Take size tokens, wait until they are available and return the time waited"""
+        with self._lock:
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens + (now - self._last) * self.rate)
+            self._last = now
+            self.tokens -= size
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait < MIN_SLEEP:
+            return 0
+        time.sleep(wait)
+        return wait
+
+
+class ThrottledFile(object):
+    """File object whose reads take their size from each of the buckets first.
+
+    Everything but read() is left to the wrapped file. Time spent waiting for the
+    buckets is added to the progress of the upload.
+    """
+
+    def __init__(self, f, buckets, upload_progress=None):
+        self._file = f
+        self._buckets = buckets
+        self._progress = upload_progress
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = BLOCK_SIZE
+            blocks = []
+            while True:
+                block = self.read(size)
+                if not block:
+                    return b''.join(blocks)
+                blocks.append(block)
+        blocks = []
+        while size > 0:
+            length = min(size, BLOCK_SIZE)
+            waited = 0
+            for bucket in self._buckets:
+                waited += bucket.consume(length)
+            if waited and self._progress is not None:
+                self._progress.add_throttled(waited)
+            block = self._file.read(length)
+            if not block:
+                break
+            blocks.append(block)
+            size -= len(block)
+        if len(blocks) == 1:
+            return blocks[0]
+        return b''.join(blocks)
+
+
+_global_bucket = None
+_platform_buckets = {}
+
+
+def configure(max_rate=None, platform_rates=None):
+    """Set the rate shared by all uploads, and the rate shared by the uploads of each platform"""
+    global _global_bucket
+    if max_rate:
+        _global_bucket = TokenBucket("all uploads", max_rate)
+        logger.info("Prismedia: Uploads are limited to %.1f MB/s." % (max_rate / 1000000.0))
+    for platform, rate in (platform_rates or {}).items():
+        if rate:
+            _platform_buckets[platform] = TokenBucket(platform, rate)
+            logger.info("Prismedia: %s uploads are limited to %.1f MB/s." % (platform, rate / 1000000.0))
+
+
+def get_buckets(platform):
+    return [bucket for bucket in (_platform_buckets.get(platform), _global_bucket) if bucket is not None]
+
+
+def wrap(f, platform, upload_progress=None):
+    """Return f throttled by the limits applying to platform, or f itself when there are none"""
+    buckets = get_buckets(platform)
+    if not buckets:
+        return f
+    return ThrottledFile(f, buckets, upload_progress)
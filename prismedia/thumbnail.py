@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import os
+import io
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger('Prismedia')
+
+# Biggest thumbnail worth sending, as (width, height, bytes). Youtube refuses files over 2 MB and
+# Peertube scales its previews down to 850x480, so the same image is sent to both platforms
+LIMITS = (1280, 720, 2 * 1024 * 1024)
+
+# Qualities tried in turn until the image fits in the size limit
+JPEG_QUALITIES = (90, 80, 70, 60, 50)
+
+# Thumbnails prepared for the last videos, a batch uploads each of them to every platform
+CACHE_SIZE = 16
+
+
+def fits(image, data, limits):
+    width, height, max_bytes = limits
+    return image.size[0] <= width and image.size[1] <= height and len(data) <= max_bytes
+
+
+def encode(image, limits):
+    width, height, max_bytes = limits
+    from PIL import Image
+    image = image.copy()
+    image.thumbnail((width, height), Image.LANCZOS)
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    for quality in JPEG_QUALITIES:
+        output = io.BytesIO()
+        image.save(output, 'JPEG', quality=quality, optimize=True)
+        if output.tell() <= max_bytes:
+            break
+    return output.getvalue()
+
+
+def prepare(path):
+    """Read the image at path once and return its jpeg content fitting LIMITS.
+
+    Images already fitting are sent as they are. Others are decoded once, at the
+    smallest scale the jpeg decoder allows for the limits, and scaled down. Without
+    Pillow, the image is always sent as it is.
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    try:
+        from PIL import Image
+    except ImportError:
+        if len(data) > LIMITS[2]:
+            logger.warning("Prismedia: Thumbnail " + path + " is bigger than what platforms accept, "
+                           "install Pillow to let prismedia resize it")
+        return data
+
+    image = Image.open(io.BytesIO(data))
+    if fits(image, data, LIMITS):
+        return data
+    image.draft('RGB', LIMITS[:2])
+    image.load()
+    thumbnail = encode(image, LIMITS)
+    logger.debug("Prismedia: Thumbnail %s resized from %d to %d KB to fit %dx%d" % (
+        path, len(data) // 1024, len(thumbnail) // 1024, LIMITS[0], LIMITS[1]))
+    return thumbnail
+
+
+_thumbnails = OrderedDict()
+_path_locks = {}
+_lock = threading.Lock()
+
+
+def get_thumbnail(path):
+    """Return the jpeg content of the thumbnail at path to send to the platforms, prepared once per file"""
+    path = os.path.abspath(path)
+    with _lock:
+        path_lock = _path_locks.setdefault(path, threading.Lock())
+    # Platforms uploading the same video at the same time wait for a single preparation
+    with path_lock:
+        stat = os.stat(path)
+        key = (path, stat.st_size, stat.st_mtime_ns)
+        with _lock:
+            thumbnail = _thumbnails.get(key)
+            if thumbnail is not None:
+                _thumbnails.move_to_end(key)
+        if thumbnail is None:
+            thumbnail = prepare(path)
+            with _lock:
+                _thumbnails[key] = thumbnail
+                while len(_thumbnails) > CACHE_SIZE:
+                    _thumbnails.popitem(last=False)
+    return thumbnail
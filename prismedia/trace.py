@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import os
+import json
+import time
+import atexit
+import logging
+import itertools
+import threading
+from functools import wraps
+
+logger = logging.getLogger('Prismedia')
+
+_exporter = None
+_local = threading.local()
+_ids = itertools.count(1)
+
+
+class Span(object):
+    """A timed operation with attributes, nested in the span active when it starts in the same thread"""
+
+    __slots__ = ('name', 'id', 'parent', 'attributes', 'start', 'end', 'thread')
+
+    def __init__(self, name, attributes):
+        self.name = name
+        self.id = next(_ids)
+        self.parent = None
+        self.attributes = attributes
+        self.start = self.end = None
+        self.thread = threading.current_thread().name
+
+    def set(self, key, value):
+        self.attributes[key] = value
+
+    def __enter__(self):
+        stack = get_stack()
+        if stack:
+            self.parent = stack[-1].id
+        stack.append(self)
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.end = time.time()
+        if exc_type is not None and exc_type is not GeneratorExit:
+            self.attributes['error'] = exc_type.__name__ + ": " + str(exc_value)
+        stack = get_stack()
+        if stack and stack[-1] is self:
+            stack.pop()
+        exporter = _exporter
+        if exporter is not None:
+            exporter.export(self)
+        return False
+
+
+class NoSpan(object):
+    """Span given when tracing is off, doing nothing"""
+
+    def set(self, key, value):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+NO_SPAN = NoSpan()
+
+
+class JsonLinesExporter(object):
+    """Write each span as a json object on its own line"""
+
+    def __init__(self, f):
+        self.file = f
+        self.lock = threading.Lock()
+
+    def export(self, span):
+        line = json.dumps({"name": span.name, "id": span.id, "parent": span.parent, "thread": span.thread,
+                           "start": span.start, "end": span.end, "duration": span.end - span.start,
+                           "attributes": span.attributes}, default=str) + "\n"
+        with self.lock:
+            self.file.write(line)
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class ChromeExporter(JsonLinesExporter):
+    """Write spans as complete events of the Chrome trace event format, for chrome://tracing or Perfetto.
+
+    Events are written as they end, the closing bracket being optional in this format,
+    so the file can be loaded even if prismedia was killed.
+    """
+
+    def __init__(self, f):
+        super(ChromeExporter, self).__init__(f)
+        self.pid = os.getpid()
+        self.threads = {}
+        self.file.write("[\n")
+
+    def export(self, span):
+        args = dict(span.attributes, id=span.id, parent=span.parent)
+        with self.lock:
+            tid = self.threads.setdefault(span.thread, len(self.threads) + 1)
+            event = {"name": span.name, "cat": str(span.attributes.get('platform', "prismedia")), "ph": "X",
+                     "pid": self.pid, "tid": tid, "ts": int(span.start * 1e6),
+                     "dur": int((span.end - span.start) * 1e6), "args": args}
+            self.file.write(json.dumps(event, default=str) + ",\n")
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            for thread, tid in sorted(self.threads.items(), key=lambda item: item[1]):
+                self.file.write(json.dumps({"name": "thread_name", "ph": "M", "pid": self.pid, "tid": tid,
+                                            "args": {"name": thread}}) + ",\n")
+            self.file.write(json.dumps({"name": "process_name", "ph": "M", "pid": self.pid,
+                                        "args": {"name": "prismedia"}}) + "\n]\n")
+            self.file.close()
+
+
+def configure(destination):
+    """Write the spans to destination, in the Chrome trace event format if it ends with .json, else as json lines"""
+    global _exporter
+    if not destination:
+        return
+    f = open(destination, 'w')
+    if destination.lower().endswith('.json'):
+        _exporter = ChromeExporter(f)
+    else:
+        _exporter = JsonLinesExporter(f)
+    atexit.register(close)
+    logger.debug("Prismedia: Writing traces to " + destination)
+
+
+def close():
+    global _exporter
+    exporter = _exporter
+    _exporter = None
+    if exporter is not None:
+        exporter.close()
+
+
+def get_stack():
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+
+def enabled():
+    """Tell if spans are written, for attributes costly to compute"""
+    return _exporter is not None
+
+
+def span(name, **attributes):
+    """Return a span timing the with block it is used in, or a span doing nothing when tracing is off"""
+    if _exporter is None:
+        return NO_SPAN
+    return Span(name, attributes)
+
+
+def annotate(**attributes):
+    """Set attributes on the active span of the thread, attributes set to None are left out"""
+    if _exporter is None:
+        return
+    stack = get_stack()
+    if stack:
+        for key, value in attributes.items():
+            if value is not None:
+                stack[-1].attributes[key] = value
+
+
+def bind(func):
+    """Return func running with the active span of the calling thread as parent, for use in other threads"""
+    if _exporter is None:
+        return func
+    stack = get_stack()
+    parent = stack[-1] if stack else None
+
+    @wraps(func)
+    def bound(*args, **kwargs):
+        previous = getattr(_local, 'stack', None)
+        _local.stack = [parent] if parent is not None else []
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _local.stack = previous
+    return bound
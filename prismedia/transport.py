@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import sys
+import socket
+import logging
+import threading
+
+logger = logging.getLogger('Prismedia')
+
+# Hosts whose connections are kept, Youtube alone uses three of them (API, uploads and tokens)
+POOL_HOSTS = 10
+
+# Connections kept alive to each host, one per upload running at the same time
+DEFAULT_POOL_SIZE = 1
+
+# TCP_NOTSENT_LOWAT from <netinet/tcp.h>, not exported by the socket module before Python 3.12
+TCP_NOTSENT_LOWAT = getattr(socket, 'TCP_NOTSENT_LOWAT', {'linux': 25, 'darwin': 0x201}.get(sys.platform))
+
+_settings = {
+    "pool_size": DEFAULT_POOL_SIZE,
+    "timeout": None,
+    "send_buffer": None,
+    "notsent_lowat": None,
+}
+_adapter = None
+_lock = threading.Lock()
+
+
+def configure(timeout=None, send_buffer=None, notsent_lowat=None):
+    """Set the timeout in seconds of every request, and the send buffer and unsent bytes limit of sockets in bytes"""
+    if notsent_lowat and TCP_NOTSENT_LOWAT is None:
+        logger.warning("Prismedia: TCP_NOTSENT_LOWAT is not supported on this system, ignoring --notsent-lowat")
+        notsent_lowat = None
+    _settings.update(timeout=timeout, send_buffer=send_buffer, notsent_lowat=notsent_lowat)
+
+
+def set_pool_size(size):
+    """Keep size connections alive to each host, for as many uploads running at the same time"""
+    _settings["pool_size"] = max(DEFAULT_POOL_SIZE, size)
+
+
+def get_socket_options():
+    from urllib3.connection import HTTPConnection
+    # urllib3 already disables Nagle's algorithm (TCP_NODELAY) on its connections
+    options = list(HTTPConnection.default_socket_options)
+    if _settings["send_buffer"]:
+        options.append((socket.SOL_SOCKET, socket.SO_SNDBUF, _settings["send_buffer"]))
+    if _settings["notsent_lowat"]:
+        options.append((socket.IPPROTO_TCP, TCP_NOTSENT_LOWAT, _settings["notsent_lowat"]))
+    return options
+
+
+def get_adapter():
+    """Return the transport adapter whose connection pools are shared by every session of both platforms"""
+    global _adapter
+    # requests is only imported when used, it would slow down the start of every run
+    from . import sender
+    with _lock:
+        if _adapter is None:
+            _adapter = sender.SendfileAdapter(socket_options=get_socket_options(), timeout=_settings["timeout"],
+                                              pool_connections=POOL_HOSTS, pool_maxsize=_settings["pool_size"])
+        return _adapter
+
+
+def is_unsent(error):
+    """Tell if error was raised before the request was sent, so sending it again can not do anything twice"""
+    from requests.exceptions import ConnectTimeout, ConnectionError
+    from urllib3.exceptions import MaxRetryError, NewConnectionError
+    if isinstance(error, ConnectTimeout):
+        return True
+    if not isinstance(error, ConnectionError) or not error.args:
+        return False
+    # Connections refused or whose host is unknown are given by urllib3 as the reason of a MaxRetryError
+    reason = error.args[0]
+    if isinstance(reason, MaxRetryError):
+        reason = reason.reason
+    return isinstance(reason, NewConnectionError)
+
+
+def mount(session):
+    """Make session send its requests through the shared connection pools, and return it"""
+    adapter = get_adapter()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
@@ -7,6 +7,9 @@ prismedia - tool to upload videos to Peertube and Youtube
 Usage:
   prismedia --file=<FILE> [options]
   prismedia -f <FILE> --tags=STRING [options]
+  prismedia --dir=<DIR> [options]
+  prismedia --manifest=<FILE> [options]
+  prismedia watch <DIR> [options]
   prismedia -h | --help
   prismedia --version
 
@@ -37,6 +40,11 @@ Options:
   --thumbnail=STRING    Path to a file to use as a thumbnail for the video.
                         Supported types are jpg and jpeg.
                         By default, prismedia search for an image based on video name followed by .jpg or .jpeg
+                        Thumbnails bigger than 1280x720 or 2 MB are resized once before being sent to the platforms
+                        when Pillow is installed.
+  --peertube-instances=STRING  Peertube instances to upload to, comma separated names of peertube_secret sections.
+                               Instances are uploaded to at the same time, a failure on one instance does not
+                               stop the others. (default: every instance of peertube_secret)
   --channel=STRING Set the channel to use for the video (Peertube only)
                     If the channel is not found, spawn an error except if --channelCreate is set.
   --channelCreate  Create the channel if not exists. (Peertube only, default do not create)
@@ -45,6 +53,63 @@ Options:
                     If the playlist is not found, spawn an error except if --playlistCreate is set.
   --playlistCreate  Create the playlist if not exists. (default do not create)
                     Only relevant if --playlist is set.
+  --dir=STRING  Upload every mp4 video found in the given directory, instead of a single --file.
+                Each video uses its own NFO and thumbnail, other options apply to all videos.
+                Authentication is done once and shared by all uploads.
+  --workers=INT  Number of videos uploaded at the same time with --dir, --manifest or watch. (default: 2)
+  --manifest=STRING  Upload the videos listed in a json lines (one json object per line) or csv file.
+                     Each row gives the options of a video with the same names as in NFO, the file being
+                     mandatory, eg: {"file": "video.mp4", "name": "My video", "playlist": "Travels"}.
+                     Paths are relative to the manifest directory. Options given on the command line apply to
+                     every video and take precedence over the rows, which take precedence over NFO.
+                     Every row is validated before the first upload, invalid rows are listed and skipped.
+  --stable-time=INT  Seconds during which a video found by watch, and the NFO and thumbnail files
+                     of its directory, should not change before it is uploaded. (default: 10)
+  --poll  Make watch scan the directory every few seconds instead of using inotify,
+          eg: for network filesystems. Polling is also used when inotify is not available.
+  --concurrent-platforms  Upload to Peertube and Youtube at the same time instead of one after the other.
+                          A failure on one platform does not stop the other one.
+  --faststart  Upload a copy of the video with its index (moov box) moved before the media data when it is after,
+               so platforms can start processing it without reading the whole file. The copy is written in
+               the temporary directory (TMPDIR) without ffmpeg, and removed once the video is uploaded.
+  --chunk-size=INT  Size in MB of the chunks sent by resumable uploads. On network errors, the upload
+                    resumes from the last chunk received by the server. (default: 8)
+                    Youtube sessions are saved after each chunk so an interrupted upload resumes on the next run.
+  --cache-ttl=INT  Seconds during which remote channels and playlists are kept in cache. (default: 3600)
+  --refresh-cache  Forget cached channels and playlists and fetch them again.
+  --progress-json=STRING  Also write upload progress and phase timings as json lines to the given file,
+                          or file descriptor if a number is given (eg: 3 for fd 3).
+  --trace=STRING  Write a trace of the run to the given file: nested spans for the validation and NFO stages,
+                  upload phases and every network call, with their duration, platform, file size,
+                  HTTP status and retries. Files ending in .json use the Chrome trace event format,
+                  to be opened in chrome://tracing or https://ui.perfetto.dev, others get one json span per line.
+  --profile=STRING  Profile the run and write reports to the given directory: for each phase (option validation,
+                    NFO parsing, authentication, lookups, transfer of each platform...) a pstats file of the
+                    CPU profile, to be read with python -m pstats, and a text summary of the top functions,
+                    the allocations still held at the end of the phase and the peak traced memory.
+                    Profiling slows the run down.
+  --force  Upload the video even if it was already uploaded to the platform.
+           By default, uploads are recorded in .prismedia_ledger.sqlite with a fingerprint of the video
+           and a video already uploaded to a platform is skipped, its url being displayed instead.
+           An upload stopped by an error resumes after its last successful step on the next run
+           (eg: the thumbnail or playlist is set without sending the video again), --force starts it over.
+  --hash=STRING  How videos are fingerprinted, between fast (size and sampled blocks)
+                 and full (whole content, slower on big files). (default: fast)
+  --max-rate=STRING  Limit the upload bandwidth used by prismedia, in bytes per second with an optional
+                     K, M or G suffix (eg: 2M for 2 MB/s). Concurrent uploads share this rate. (default: no limit)
+  --peertube-max-rate=STRING
+  --youtube-max-rate=STRING  Limit the upload bandwidth used for the corresponding platform, in addition to --max-rate
+  --youtube-quota=INT  Daily quota of the Google Cloud project of youtube_secret.json, in units. Prismedia counts
+                       the units used by each Youtube call in .prismedia_quota.json, until the quota resets at
+                       midnight Pacific time. A video whose upload, thumbnail and playlist do not fit in the units
+                       left is deferred to the next quota window instead of failing halfway. (default: 10000)
+  --timeout=INT  Seconds to wait for a server to accept a connection or to answer, before the request
+                 is retried. (default: no timeout)
+  --send-buffer=STRING  Size of the TCP send buffer of each connection, in bytes with an optional K or M suffix
+                        (eg: 4M for fast links with a high latency). (default: tuned by the system)
+  --notsent-lowat=STRING  Bytes written to a connection but not yet sent above which prismedia waits
+                          (TCP_NOTSENT_LOWAT, eg: 128K), so the send buffer does not delay other requests.
+                          Linux and macOS only. (default: no limit)
   -h --help  Show this help.
   --version  Show version.
 
@@ -56,6 +121,13 @@ Logging options
                     Be careful --batch and --url-only are mutually exclusives.
   --debug           (Deprecated) Alias for --log=debug. Ignored if --log is set
 
+Watch mode:
+  prismedia watch <DIR> keeps running and uploads each mp4 video written to DIR, with its NFO and thumbnail,
+  once it is completely written. Videos already in DIR are uploaded when the watch starts, videos already
+  uploaded being skipped (see --force). Authentication and caches are kept from one video to the next.
+  SIGTERM or Ctrl+C stops the watch: uploads in progress are finished, videos not started yet are left
+  for the next run.
+
 Strict options:
   Strict options allow you to force some option to be present when uploading a video. It's useful to be sure you do not
   forget something when uploading a video, for example if you use multiples NFO. You may force the presence of description,
@@ -97,8 +169,14 @@ if sys.version_info[0] < 3:
     raise Exception("Python 3 or a more recent version is required.")
 
 import os
+import time
+import collections
+import importlib
 import datetime
 import logging
+import signal
+import threading
+from concurrent.futures import ThreadPoolExecutor
 logger = logging.getLogger('Prismedia')
 logger.setLevel(logging.INFO)
 ch = logging.StreamHandler()
@@ -109,9 +187,18 @@ logger.addHandler(ch)
 
 from docopt import docopt
 
-from . import yt_upload
-from . import pt_upload
+from . import cache
+from . import ledger
+from . import manifest
+from . import mp4
+from . import profiling
+from . import progress
+from . import quota
+from . import throttle
+from . import trace
+from . import transport
 from . import utils
+from . import watch
 
 try:
     # noinspection PyUnresolvedReferences
@@ -132,6 +219,13 @@ except ImportError:
 
 VERSION = "prismedia v0.10.1"
 
+# Platform modules pull in their API clients, they are only imported when used
+PLATFORMS = {
+    "peertube": "pt_upload",
+    "youtube": "yt_upload"
+}
+DEFAULT_WORKERS = 2
+
 VALID_PRIVACY_STATUSES = ('public', 'private', 'unlisted')
 VALID_CATEGORIES = (
     "music", "films", "vehicles",
@@ -148,16 +242,15 @@ VALID_LANGUAGES = ('arabic', 'english', 'french',
 
 
 def validateVideo(path):
-    supported_types = ['video/mp4']
-    detected_type = magic.from_file(path, mime=True)
-    if detected_type not in supported_types:
-        print("File", path, "detected type is", detected_type, "which is not one of", supported_types)
-
-        force_file = ['y', 'yes']
-        is_forcing = input("Are you sure you selected the correct file? (y/N)")
-        if is_forcing.lower() not in force_file:
-            return False
-
+    try:
+        facts = mp4.get_facts(path)
+    except (mp4.MP4Error, IOError, OSError) as e:
+        logger.error("Prismedia: " + path + " is not a valid mp4 video: " + str(e))
+        return False
+    logger.debug("Prismedia: %s: %s, %sx%s, %s, %s bits/s" % (
+        path, facts.get('video_codec'), facts.get('width'), facts.get('height'),
+        progress.format_duration(facts['duration']) if facts.get('duration') else "unknown duration",
+        facts.get('bitrate')))
     return path
 
 
@@ -221,8 +314,7 @@ def _optionnalOrStrict(key, scope, error):
     option = key.replace('-', '')
     option = option[0].upper() + option[1:]
     if scope["--with" + option] is True and scope[key] is None:
-        logger.critical("Prismedia: you have required the strict presence of " + key + " but none is found")
-        exit(1)
+        raise SchemaError("Prismedia: you have required the strict presence of " + key + " but none is found")
     return True
 
 
@@ -259,147 +351,582 @@ def configureStdoutLogs():
     ch_stdout.setFormatter(formatter_stdout)
     logger_stdout.addHandler(ch_stdout)
 
-def main():
-    options = docopt(__doc__, version=VERSION)
 
-    earlyoptionSchema = Schema({
-        Optional('--log'): Or(None, And(
-                                str,
-                                Use(str.upper),
-                                validateLogLevel,
-                                error="Log level not recognized")
+earlyoptionSchema = Schema({
+    Optional('--log'): Or(None, And(
+                            str,
+                            Use(str.upper),
+                            validateLogLevel,
+                            error="Log level not recognized")
+                          ),
+    Optional('--quiet', default=False): bool,
+    Optional('--debug'): bool,
+    Optional('--url-only', default=False): bool,
+    Optional('--batch', default=False): bool,
+    Optional('--withNFO', default=False): bool,
+    Optional('--withThumbnail', default=False): bool,
+    Optional('--withName', default=False): bool,
+    Optional('--withDescription', default=False): bool,
+    Optional('--withTags', default=False): bool,
+    Optional('--withPlaylist', default=False): bool,
+    Optional('--withPublishAt', default=False): bool,
+    Optional('--withPlatform', default=False): bool,
+    Optional('--withCategory', default=False): bool,
+    Optional('--withLanguage', default=False): bool,
+    Optional('--withChannel', default=False): bool,
+    Optional('--cache-ttl'): Or(None, And(
+                                Use(int),
+                                lambda x: x >= 0,
+                                error="Cache TTL should be a number of seconds")
+                                ),
+    Optional('--refresh-cache', default=False): bool,
+    Optional('--force', default=False): bool,
+    Optional('--max-rate'): Or(None, And(
+                                Use(throttle.parse_rate),
+                                error="Rate should be a number of bytes per second, eg: 500K or 2M")
+                               ),
+    Optional('--peertube-max-rate'): Or(None, And(
+                                Use(throttle.parse_rate),
+                                error="Rate should be a number of bytes per second, eg: 500K or 2M")
+                                        ),
+    Optional('--youtube-max-rate'): Or(None, And(
+                                Use(throttle.parse_rate),
+                                error="Rate should be a number of bytes per second, eg: 500K or 2M")
+                                       ),
+    Optional('--youtube-quota'): Or(None, And(
+                                Use(int),
+                                lambda x: x > 0,
+                                error="Youtube quota should be a positive number of units")
+                                    ),
+    Optional('--timeout'): Or(None, And(
+                                Use(int),
+                                lambda x: x > 0,
+                                error="Timeout should be a positive number of seconds")
                               ),
-        Optional('--quiet', default=False): bool,
-        Optional('--debug'): bool,
-        Optional('--url-only', default=False): bool,
-        Optional('--batch', default=False): bool,
-        Optional('--withNFO', default=False): bool,
-        Optional('--withThumbnail', default=False): bool,
-        Optional('--withName', default=False): bool,
-        Optional('--withDescription', default=False): bool,
-        Optional('--withTags', default=False): bool,
-        Optional('--withPlaylist', default=False): bool,
-        Optional('--withPublishAt', default=False): bool,
-        Optional('--withPlatform', default=False): bool,
-        Optional('--withCategory', default=False): bool,
-        Optional('--withLanguage', default=False): bool,
-        Optional('--withChannel', default=False): bool,
-        # This allow to return all other options for further use: https://github.com/keleshev/schema#extra-keys
-        object: object
-    })
-
-    schema = Schema({
-        '--file': And(str, os.path.exists, validateVideo, error='file is not supported, please use mp4'),
-        # Strict option checks - at the moment Schema needs to check Hook and Optional separately #
-        Hook('--name', handler=_optionnalOrStrict): object,
-        Hook('--description', handler=_optionnalOrStrict): object,
-        Hook('--tags', handler=_optionnalOrStrict): object,
-        Hook('--category', handler=_optionnalOrStrict): object,
-        Hook('--language', handler=_optionnalOrStrict): object,
-        Hook('--platform', handler=_optionnalOrStrict): object,
-        Hook('--publishAt', handler=_optionnalOrStrict): object,
-        Hook('--thumbnail', handler=_optionnalOrStrict): object,
-        Hook('--channel', handler=_optionnalOrStrict): object,
-        Hook('--playlist', handler=_optionnalOrStrict): object,
-        # Validate checks #
-        Optional('--name'): Or(None, And(
+    Optional('--send-buffer'): Or(None, And(
+                                Use(throttle.parse_rate),
+                                error="Send buffer should be a number of bytes, eg: 512K or 4M")
+                                  ),
+    Optional('--notsent-lowat'): Or(None, And(
+                                Use(throttle.parse_rate),
+                                error="Not sent low water mark should be a number of bytes, eg: 128K")
+                                    ),
+    Optional('--hash'): Or(None, And(
+                            str,
+                            lambda x: x in ledger.HASH_MODES,
+                            error="Hash mode should be fast or full")
+                           ),
+    # This allow to return all other options for further use: https://github.com/keleshev/schema#extra-keys
+    object: object
+})
+
+schema = Schema({
+    '--file': And(str, os.path.exists, validateVideo, error='file is not supported, please use mp4'),
+    # Strict option checks - at the moment Schema needs to check Hook and Optional separately #
+    Hook('--name', handler=_optionnalOrStrict): object,
+    Hook('--description', handler=_optionnalOrStrict): object,
+    Hook('--tags', handler=_optionnalOrStrict): object,
+    Hook('--category', handler=_optionnalOrStrict): object,
+    Hook('--language', handler=_optionnalOrStrict): object,
+    Hook('--platform', handler=_optionnalOrStrict): object,
+    Hook('--publishAt', handler=_optionnalOrStrict): object,
+    Hook('--thumbnail', handler=_optionnalOrStrict): object,
+    Hook('--channel', handler=_optionnalOrStrict): object,
+    Hook('--playlist', handler=_optionnalOrStrict): object,
+    # Validate checks #
+    Optional('--name'): Or(None, And(
+                            str,
+                            lambda x: not x.isdigit(),
+                            error="The video name should be a string")
+                           ),
+    Optional('--description'): Or(None, And(
+                                    str,
+                                    lambda x: not x.isdigit(),
+                                    error="The video description should be a string")
+                                  ),
+    Optional('--tags'): Or(None, And(
                                 str,
                                 lambda x: not x.isdigit(),
-                                error="The video name should be a string")
+                                error="Tags should be a string")
+                           ),
+    Optional('--category'): Or(None, And(
+                                str,
+                                validateCategory,
+                                error="Category not recognized, please see --help")
                                ),
-        Optional('--description'): Or(None, And(
-                                        str,
-                                        lambda x: not x.isdigit(),
-                                        error="The video description should be a string")
-                                      ),
-        Optional('--tags'): Or(None, And(
-                                    str,
-                                    lambda x: not x.isdigit(),
-                                    error="Tags should be a string")
+    Optional('--language'): Or(None, And(
+                                str,
+                                validateLanguage,
+                                error="Language not recognized, please see --help")
                                ),
-        Optional('--category'): Or(None, And(
-                                    str,
-                                    validateCategory,
-                                    error="Category not recognized, please see --help")
-                                   ),
-        Optional('--language'): Or(None, And(
-                                    str,
-                                    validateLanguage,
-                                    error="Language not recognized, please see --help")
-                                   ),
-        Optional('--privacy'): Or(None, And(
-                                    str,
-                                    validatePrivacy,
-                                    error="Please use recognized privacy between public, unlisted or private")
+    Optional('--privacy'): Or(None, And(
+                                str,
+                                validatePrivacy,
+                                error="Please use recognized privacy between public, unlisted or private")
+                              ),
+    Optional('--nfo'): Or(None, str),
+    Optional('--platform'): Or(None, And(str, validatePlatform, error="Sorry, upload platform not supported")),
+    Optional('--publishAt'): Or(None, And(
+                                str,
+                                validatePublish,
+                                error="DATE should be the form YYYY-MM-DDThh:mm:ss and has to be in the future")
+                                ),
+    Optional('--peertubeAt'): Or(None, And(
+                                str,
+                                validatePublish,
+                                error="DATE should be the form YYYY-MM-DDThh:mm:ss and has to be in the future")
+                                ),
+    Optional('--youtubeAt'): Or(None, And(
+                                str,
+                                validatePublish,
+                                error="DATE should be the form YYYY-MM-DDThh:mm:ss and has to be in the future")
+                                ),
+    Optional('--cca'): bool,
+    Optional('--disable-comments'): bool,
+    Optional('--nsfw'): bool,
+    Optional('--thumbnail'): Or(None, And(
+                                str, validateThumbnail, error='thumbnail is not supported, please use jpg/jpeg'),
+                                ),
+    Optional('--peertube-instances'): Or(None, str),
+    Optional('--channel'): Or(None, str),
+    Optional('--channelCreate'): bool,
+    Optional('--faststart'): bool,
+    Optional('--chunk-size'): Or(None, And(
+                                Use(int),
+                                lambda x: x > 0,
+                                error="Chunk size should be a positive number of MB")
+                                 ),
+    Optional('--playlist'): Or(None, str),
+    Optional('--playlistCreate'): bool,
+    '--help': bool,
+    '--version': bool,
+    # This allow to return all other options for further use: https://github.com/keleshev/schema#extra-keys
+    object: object
+})
+
+batchSchema = Schema({
+    Optional('--workers'): Or(None, And(
+                                Use(int),
+                                lambda x: x > 0,
+                                error="Workers should be a positive integer")
+                              ),
+    Optional('--stable-time'): Or(None, And(
+                                Use(int),
+                                lambda x: x >= 0,
+                                error="Stable time should be a number of seconds")
                                   ),
-        Optional('--nfo'): Or(None, str),
-        Optional('--platform'): Or(None, And(str, validatePlatform, error="Sorry, upload platform not supported")),
-        Optional('--publishAt'): Or(None, And(
-                                    str,
-                                    validatePublish,
-                                    error="DATE should be the form YYYY-MM-DDThh:mm:ss and has to be in the future")
-                                    ),
-        Optional('--peertubeAt'): Or(None, And(
-                                    str,
-                                    validatePublish,
-                                    error="DATE should be the form YYYY-MM-DDThh:mm:ss and has to be in the future")
-                                    ),
-        Optional('--youtubeAt'): Or(None, And(
-                                    str,
-                                    validatePublish,
-                                    error="DATE should be the form YYYY-MM-DDThh:mm:ss and has to be in the future")
-                                    ),
-        Optional('--cca'): bool,
-        Optional('--disable-comments'): bool,
-        Optional('--nsfw'): bool,
-        Optional('--thumbnail'): Or(None, And(
-                                    str, validateThumbnail, error='thumbnail is not supported, please use jpg/jpeg'),
-                                    ),
-        Optional('--channel'): Or(None, str),
-        Optional('--channelCreate'): bool,
-        Optional('--playlist'): Or(None, str),
-        Optional('--playlistCreate'): bool,
-        '--help': bool,
-        '--version': bool,
-        # This allow to return all other options for further use: https://github.com/keleshev/schema#extra-keys
-        object: object
-    })
-    # We need to validate early options first as withNFO and logs options should be prioritized
+    object: object
+})
+
+
+# Early options may also be set by NFO, they are validated again with the other options in one pass
+videoSchema = Schema(dict(list(earlyoptionSchema.schema.items()) + list(schema.schema.items())))
+
+
+# Return the options of a video completed by its NFO and thumbnail, raise SchemaError or ValueError if invalid
+def checkOptions(options):
+    path = options.get('--file')
+    with trace.span("nfo", file=path), profiling.phase("nfo", path=path):
+        options = utils.parseNFO(options)
+    if not options.get('--thumbnail'):
+        with trace.span("search thumbnail", file=path), profiling.phase("search thumbnail", path=path):
+            options = utils.searchThumbnail(options)
+    with trace.span("validate", file=path), profiling.phase("validate", path=path):
+        return videoSchema.validate(options)
+
+
+def loadOptions(options):
     try:
-        options = earlyoptionSchema.validate(options)
-        configureLogs(options)
+        return checkOptions(options)
+    except (SchemaError, ValueError) as e:
+        logger.critical(e)
+        exit(1)
+
+
+def getPlatforms(options):
+    platforms = []
+    if options.get('--platform') is None or "peertube" in options.get('--platform'):
+        platforms.append("peertube")
+    if options.get('--platform') is None or "youtube" in options.get('--platform'):
+        platforms.append("youtube")
+    return platforms
+
+
+def getPlatformModule(platform):
+    return importlib.import_module("." + PLATFORMS[platform], __package__)
+
+
+class BatchSessions(object):
+    """Authenticate each platform once, on first use, and share the session between batch workers"""
+
+    def __init__(self):
+        self._locks = dict((platform, threading.Lock()) for platform in PLATFORMS)
+        self._sessions = {}
+
+    def get(self, platform):
+        # One lock per platform so a slow Youtube console authentication does not block Peertube
+        with self._locks[platform]:
+            if platform not in self._sessions:
+                self._sessions[platform] = getPlatformModule(platform).get_session()
+            return self._sessions[platform]
+
+
+def runPlatform(platform, options, sessions=None):
+    # Platforms exit on fatal errors, which should only stop the current platform here
+    start = time.time()
+    with trace.span("upload", platform=platform, file=options.get('--file')) as span:
+        try:
+            if trace.enabled():
+                span.set('size', os.path.getsize(options.get('--file')))
+            session = sessions.get(platform) if sessions else None
+            result = getPlatformModule(platform).run(options, session)
+        except SystemExit:
+            result = None
+        except Exception as e:
+            logger.error("Prismedia: " + platform + ": " + str(e))
+            result = None
+        span.set('success', bool(result))
+    elapsed = time.time() - start
+    # Uploading to several Peertube instances gives the url of each instance
+    if isinstance(result, dict):
+        results = dict((platform + ":" + instance, url) for instance, url in result.items())
+    else:
+        results = {platform: result}
+    for name, url in sorted(results.items()):
+        if url:
+            logger.info("Prismedia: %s upload of %s done in %.1f seconds" % (name, options.get('--file'), elapsed))
+        else:
+            logger.error("Prismedia: %s upload of %s failed after %.1f seconds" % (name, options.get('--file'), elapsed))
+    return dict((name, (url, elapsed)) for name, url in results.items())
+
+
+def uploadPlatforms(options, sessions=None):
+    platforms = getPlatforms(options)
+    results = {}
+    if not options.get('--concurrent-platforms') or len(platforms) < 2:
+        for platform in platforms:
+            results.update(runPlatform(platform, options, sessions))
+        return results
+
+    with ThreadPoolExecutor(max_workers=len(platforms)) as executor:
+        futures = [executor.submit(trace.bind(runPlatform), platform, options, sessions) for platform in platforms]
+    for future in futures:
+        results.update(future.result())
+    return results
+
+
+def uploadBatchVideo(options, video, sessions, validated=False):
+    """Upload video with options, completed by its NFO and validated unless they already are"""
+    with trace.span("video", file=video):
+        options = dict(options)
+        options['--file'] = video
+        try:
+            if not validated:
+                options = loadOptions(options)
+        except SystemExit:
+            logger.error("Prismedia: Skipping " + video)
+            return {}
+        except Exception as e:
+            logger.error("Prismedia: Skipping " + video + ": " + str(e))
+            return {}
+        logger.info("Prismedia: Uploading " + video)
+        try:
+            return uploadPlatforms(options, sessions)
+        finally:
+            if options.get('--faststart'):
+                mp4.remove_faststart_copy(video)
+
+
+def uploadBatch(options):
+    directory = options.get('--dir')
+    if not os.path.isdir(directory):
+        logger.critical("Prismedia: " + directory + " is not a directory.")
+        exit(1)
+    videos = utils.searchVideos(directory)
+    if not videos:
+        logger.critical("Prismedia: No video found in " + directory)
+        exit(1)
+
+    try:
+        workers = batchSchema.validate(options).get('--workers') or DEFAULT_WORKERS
     except SchemaError as e:
         logger.critical(e)
         exit(1)
 
-    if options.get('--url-only') or options.get('--batch'):
-        configureStdoutLogs()
+    logger.info("Prismedia: Uploading " + str(len(videos)) + " videos with " + str(workers) + " workers")
+    transport.set_pool_size(workers)
+    sessions = BatchSessions()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [(video, executor.submit(uploadBatchVideo, options, video, sessions)) for video in videos]
+        results = [(video, future.result()) for video, future in futures]
+
+    counts = {"uploaded": 0, "deferred": 0, "failed": 0}
+    for video, result in results:
+        counts[logSummary(options, video, result, quota.pop_deferred(video))] += 1
+    logger.info("Prismedia: %(uploaded)d videos uploaded, %(deferred)d deferred to the next quota window, "
+                "%(failed)d failed" % counts)
+    # Deferred videos are uploaded by the next run, which should be told this one did not finish
+    if counts["failed"] or counts["deferred"]:
+        exit(1)
+
 
-    options = utils.parseNFO(options)
+# Label of each result of logSummary
+SUMMARY_LABELS = {"uploaded": "OK", "deferred": "DEFERRED", "failed": "FAILED"}
 
-    # Once NFO are loaded, we need to revalidate strict options in case some were in NFO
+
+def logSummary(options, video, result, reset=None):
+    """Display the result of each platform for video, and return whether it was uploaded, deferred or failed.
+
+    reset is the time the Youtube quota resets, when the Youtube upload of video was deferred.
+    """
+    statuses = {}
+    for platform, (url, elapsed) in result.items():
+        if url:
+            statuses[platform] = url
+        elif reset is not None and platform == 'youtube':
+            statuses[platform] = "deferred until " + quota.format_time(reset)
+        else:
+            statuses[platform] = "failed"
+    if not result or "failed" in statuses.values():
+        summary = "failed"
+    elif all(url for url, elapsed in result.values()):
+        summary = "uploaded"
+    else:
+        summary = "deferred"
+    details = ", ".join("%s: %s (%.1fs)" % (platform, statuses[platform], elapsed)
+                        for platform, (url, elapsed) in sorted(result.items()))
+    line = "%s %s %s" % (SUMMARY_LABELS[summary], video, details or "not uploaded")
+    if options.get('--batch'):
+        logging.getLogger('stdoutlogs').info("Summary: " + line)
+    else:
+        logger.info("Prismedia: " + line)
+    return summary
+
+
+# Fields of a manifest row holding a path, relative to the manifest directory
+MANIFEST_PATHS = ('file', 'nfo', 'thumbnail')
+
+# Validated options of this many manifest rows are kept for their upload, the next rows are
+# validated again when uploaded so memory does not grow with the manifest
+MANIFEST_VALIDATED_ROWS = 10000
+
+
+def getManifestOptions(options, fields, directory):
+    """Return the options of the video of a manifest row, raise ValueError if the row can not be used"""
+    if isinstance(fields, ValueError):
+        raise fields
+    names = set(utils.getOptionName(key) for key in options if key.startswith('--'))
+    unknown = sorted(set(fields) - names)
+    if unknown:
+        raise ValueError("unknown fields " + ", ".join(unknown))
+    if not fields.get('file'):
+        raise ValueError("no file given")
+    fields = dict(fields)
+    for name in MANIFEST_PATHS:
+        if name in fields:
+            fields[name] = os.path.join(directory, fields[name])
+    return utils.fillOptions(dict(options), [fields])
+
+
+def validateManifest(options, path):
+    """Validate every row of the manifest.
+
+    Return the line numbers of the invalid rows, and the validated options of the first
+    MANIFEST_VALIDATED_ROWS valid rows by line number.
+    """
+    directory = os.path.dirname(path)
+    invalid = set()
+    validated = {}
+    valid = 0
+    for number, fields in manifest.read(path):
+        try:
+            video_options = checkOptions(getManifestOptions(options, fields, directory))
+            if len(validated) < MANIFEST_VALIDATED_ROWS:
+                validated[number] = video_options
+            valid += 1
+        except (SchemaError, ValueError, IOError, OSError) as e:
+            invalid.add(number)
+            logger.critical("Prismedia: %s line %d: %s" % (path, number, e))
+    logger.info("Prismedia: %d valid and %d invalid videos in %s" % (valid, len(invalid), path))
+    return invalid, validated
+
+
+def uploadManifest(options):
+    path = options.get('--manifest')
+    if not os.path.isfile(path):
+        logger.critical("Prismedia: " + path + " is not a file.")
+        exit(1)
     try:
-        options = earlyoptionSchema.validate(options)
+        workers = batchSchema.validate(options).get('--workers') or DEFAULT_WORKERS
     except SchemaError as e:
         logger.critical(e)
         exit(1)
 
-    if not options.get('--thumbnail'):
-        options = utils.searchThumbnail(options)
+    transport.set_pool_size(workers)
+    invalid, validated = validateManifest(options, path)
+
+    # Rows are read again and given to the workers a few at a time, so memory does not grow with the manifest
+    directory = os.path.dirname(path)
+    sessions = BatchSessions()
+    pending = collections.deque()
+    counts = {"uploaded": 0, "deferred": 0, "failed": 0}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        rows = ((number, fields) for number, fields in manifest.read(path) if number not in invalid)
+        while True:
+            row = next(rows, None)
+            if row is not None:
+                number, fields = row
+                checked = number in validated
+                if checked:
+                    video_options = validated.pop(number)
+                else:
+                    video_options = getManifestOptions(options, fields, directory)
+                video = video_options['--file']
+                pending.append((video, executor.submit(uploadBatchVideo, video_options, video, sessions, checked)))
+            if pending and (row is None or len(pending) >= 2 * workers):
+                video, future = pending.popleft()
+                counts[logSummary(options, video, future.result(), quota.pop_deferred(video))] += 1
+            elif row is None:
+                break
+    logger.info("Prismedia: %(uploaded)d videos uploaded, %(deferred)d deferred to the next quota window, "
+                "%(failed)d failed, " % counts + str(len(invalid)) + " invalid")
+    if counts["failed"] or counts["deferred"] or invalid:
+        exit(1)
+
+
+def watchDirectory(options):
+    directory = options.get('<DIR>')
+    if not os.path.isdir(directory):
+        logger.critical("Prismedia: " + directory + " is not a directory.")
+        exit(1)
 
     try:
-        options = schema.validate(options)
+        options = batchSchema.validate(options)
     except SchemaError as e:
         logger.critical(e)
         exit(1)
+    workers = options.get('--workers') or DEFAULT_WORKERS
+    transport.set_pool_size(workers)
+    stable_time = options.get('--stable-time')
+    if stable_time is None:
+        stable_time = watch.DEFAULT_STABLE_TIME
+
+    stopping = threading.Event()
+
+    def stop(signum, frame):
+        logger.info("Prismedia: Stopping the watch, waiting for uploads in progress...")
+        stopping.set()
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    watcher = watch.Watcher(directory, stable_time, options.get('--poll'))
+    sessions = BatchSessions()
+    ready = []
+    running = {}
+    # Videos deferred to the next Youtube quota window, with the time the quota resets
+    deferred = {}
+    failed = False
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            while not stopping.is_set():
+                try:
+                    changed = watcher.wait(1)
+                except OSError as e:
+                    # The directory was removed or can not be read anymore, finish the uploads in progress
+                    logger.critical("Prismedia: Can not watch " + directory + " anymore: " + str(e))
+                    failed = True
+                    stopping.set()
+                    continue
+                ready.extend(video for video in changed if video not in ready)
+                for video, future in list(running.items()):
+                    if future.done():
+                        del running[video]
+                        reset = quota.pop_deferred(video)
+                        logSummary(options, video, future.result(), reset)
+                        if reset is not None:
+                            deferred[video] = reset
+                            logger.info("Prismedia: " + video + " will be uploaded again when the quota resets.")
+                # Platforms already done are skipped by the ledger when a deferred video is uploaded again
+                for video, reset in list(deferred.items()):
+                    if time.time() >= reset and video not in ready:
+                        del deferred[video]
+                        ready.append(video)
+                # Videos are only given to idle workers, so stopping does not wait for queued ones
+                for video in list(ready):
+                    if len(running) >= workers:
+                        break
+                    if video not in running:
+                        ready.remove(video)
+                        running[video] = executor.submit(uploadBatchVideo, options, video, sessions)
+    finally:
+        watcher.close()
+    for video, future in running.items():
+        logSummary(options, video, future.result(), quota.pop_deferred(video))
+    ready.extend(deferred)
+    if ready:
+        logger.info("Prismedia: " + str(len(ready)) + " videos were not uploaded: " + ", ".join(ready))
+    if failed:
+        exit(1)
+
+
+def main():
+    options = docopt(__doc__, version=VERSION)
+
+    # We need to validate early options first as withNFO and logs options should be prioritized
+    try:
+        options = earlyoptionSchema.validate(options)
+        configureLogs(options)
+    except SchemaError as e:
+        logger.critical(e)
+        exit(1)
+
+    if options.get('--url-only') or options.get('--batch'):
+        configureStdoutLogs()
+
+    cache.configure(options.get('--cache-ttl'), options.get('--refresh-cache'))
+    ledger.configure(options.get('--hash'), options.get('--force'))
+    throttle.configure(options.get('--max-rate'), {"peertube": options.get('--peertube-max-rate'),
+                                                   "youtube": options.get('--youtube-max-rate')})
+    progress.configure(options.get('--progress-json'))
+    trace.configure(options.get('--trace'))
+    profiling.configure(options.get('--profile'))
+    transport.configure(options.get('--timeout'), options.get('--send-buffer'), options.get('--notsent-lowat'))
+    quota.configure(options.get('--youtube-quota'))
 
     logger.debug("Python " + sys.version)
-    logger.debug(options)
 
-    if options.get('--platform') is None or "peertube" in options.get('--platform'):
-        pt_upload.run(options)
-    if options.get('--platform') is None or "youtube" in options.get('--platform'):
-        yt_upload.run(options)
+    if options.get('--dir'):
+        uploadBatch(options)
+        return
+
+    if options.get('--manifest'):
+        uploadManifest(options)
+        return
+
+    if options.get('watch'):
+        watchDirectory(options)
+        return
+
+    with trace.span("video", file=options.get('--file')):
+        options = loadOptions(options)
+
+        logger.debug(options)
+
+        try:
+            if options.get('--concurrent-platforms'):
+                results = uploadPlatforms(options)
+                if not all(url for url, elapsed in results.values()):
+                    exit(1)
+                return
+
+            for platform in getPlatforms(options):
+                with trace.span("upload", platform=platform, file=options.get('--file')) as span:
+                    if trace.enabled():
+                        span.set('size', os.path.getsize(options.get('--file')))
+                    getPlatformModule(platform).run(options)
+        finally:
+            if options.get('--faststart'):
+                mp4.remove_faststart_copy(options.get('--file'))
 
 
 if __name__ == '__main__':
@@ -1,14 +1,17 @@
 #!/usr/bin/python
 # coding: utf-8
 
-from configparser import RawConfigParser, NoOptionError, NoSectionError
-from os.path import dirname, splitext, basename, isfile
+from configparser import RawConfigParser
+from os.path import dirname, splitext, basename, isfile, join, abspath
 import re
-from os import devnull
+import threading
+from os import devnull, scandir, stat
 from subprocess import check_call, CalledProcessError, STDOUT
 import unidecode
 import logging
 
+from . import trace
+
 logger = logging.getLogger('Prismedia')
 
 ### CATEGORIES ###
@@ -110,105 +113,140 @@ def remove_empty_kwargs(**kwargs):
     return good_kwargs
 
 
+VIDEO_EXTENSIONS = ('.mp4',)
+THUMBNAIL_EXTENSIONS = ('.jpg', '.jpeg')
+
+# Files of each directory and parsed NFO, with the mtime they were read at. They are
+# shared by all the videos of a batch, which would otherwise stat and parse the same
+# files again for every video.
+_directories = {}
+_nfos = {}
+_cache_lock = threading.Lock()
+
+
+def getDirectoryIndex(directory):
+    """Return the names of the files in directory, listed again only when the directory changes"""
+    directory = directory or "."
+    mtime = stat(directory).st_mtime_ns
+    with _cache_lock:
+        cached = _directories.get(directory)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    files = frozenset(entry.name for entry in scandir(directory) if entry.is_file())
+    with _cache_lock:
+        _directories[directory] = (mtime, files)
+    return files
+
+
+def searchVideos(directory):
+    files = getDirectoryIndex(directory)
+    return [join(directory, filename) for filename in sorted(files)
+            if splitext(filename)[1].lower() in VIDEO_EXTENSIONS]
+
+
 def searchThumbnail(options):
-    video_directory = dirname(options.get('--file')) + "/"
-    # First, check for thumbnail based on videoname
+    video_directory = dirname(options.get('--file'))
+    files = getDirectoryIndex(video_directory)
+    # First, check for thumbnail based on videoname, then based on videofile name
+    names = [splitext(basename(options.get('--file')))[0]]
     if options.get('--name'):
-        if isfile(video_directory + options.get('--name') + ".jpg"):
-            options['--thumbnail'] = video_directory + options.get('--name') + ".jpg"
-        elif isfile(video_directory + options.get('--name') + ".jpeg"):
-            options['--thumbnail'] = video_directory + options.get('--name') + ".jpeg"
-    # Then, if we still not have thumbnail, check for thumbnail based on videofile name
-    if not options.get('--thumbnail'):
-        video_file = splitext(basename(options.get('--file')))[0]
-        if isfile(video_directory + video_file + ".jpg"):
-            options['--thumbnail'] = video_directory + video_file + ".jpg"
-        elif isfile(video_directory + video_file + ".jpeg"):
-            options['--thumbnail'] = video_directory + video_file + ".jpeg"
+        names.insert(0, options.get('--name'))
+    for name in names:
+        for extension in THUMBNAIL_EXTENSIONS:
+            if name + extension in files:
+                options['--thumbnail'] = join(video_directory, name + extension)
+                break
+        if options.get('--thumbnail'):
+            break
 
     # Display some info after research
     if not options.get('--thumbnail'):
         logger.debug("No thumbnail has been found, continuing")
     else:
-        logger.info("Using " + options.get('--thumbnail') + "as thumbnail")
+        logger.info("Using " + options.get('--thumbnail') + " as thumbnail")
 
     return options
 
 
-# return the nfo as a RawConfigParser object
-def loadNFO(filename):
-    try:
-        logger.info("Loading " + filename + " as NFO")
-        nfo = RawConfigParser()
-        nfo.read(filename, encoding='utf-8')
-        return nfo
-    except Exception as e:
-        logger.critical("Problem loading NFO file " + filename + ": " + str(e))
-        exit(1)
-    return False
+# NFO keys may be written with or without dashes and in any case, as docopt options
+def getOptionName(key):
+    return key.lstrip("-").replace("-", "").lower()
 
 
+# return the [video] section of the nfo as a dict indexed by getOptionName
+def loadNFO(filename):
+    logger.info("Loading " + filename + " as NFO")
+    with trace.span("load nfo", file=filename) as span:
+        try:
+            mtime = stat(filename).st_mtime_ns
+            with _cache_lock:
+                cached = _nfos.get(filename)
+            if cached is not None and cached[0] == mtime:
+                span.set('cached', True)
+                return cached[1]
+            nfo = RawConfigParser()
+            nfo.read(filename, encoding='utf-8')
+        except Exception as e:
+            raise ValueError("Problem loading NFO file " + filename + ": " + str(e))
+        if not nfo.has_section('video'):
+            raise ValueError(filename + " misses section [video], please check syntax of your NFO.")
+        values = dict((getOptionName(key), value) for key, value in nfo.items('video'))
+        with _cache_lock:
+            _nfos[filename] = (mtime, values)
+        return values
+
+
+# Raise ValueError when a NFO can not be used
 def parseNFO(options):
     video_directory = dirname(options.get('--file'))
-    directory_name = basename(video_directory)
-    nfo_txt = False
-    nfo_directory = False
-    nfo_videoname = False
-    nfo_file = False
-    nfo_cli = False
-
-    if isfile(video_directory + "/" + "nfo.txt"):
-        nfo_txt = loadNFO(video_directory + "/" + "nfo.txt")
-    elif isfile(video_directory + "/" + "NFO.txt"):
-        nfo_txt = loadNFO(video_directory + "/" + "NFO.txt")
+    files = getDirectoryIndex(video_directory)
+    directory_name = basename(abspath(video_directory or "."))
+    video_file = splitext(basename(options.get('--file')))[0]
 
-    if isfile(video_directory + "/" + directory_name+ ".txt"):
-        nfo_directory = loadNFO(video_directory + "/" + directory_name+ ".txt")
+    def searchNFO(*names):
+        for name in names:
+            if name in files:
+                return loadNFO(join(video_directory, name))
+        return None
 
+    nfo_txt = searchNFO("nfo.txt", "NFO.txt")
+    nfo_directory = searchNFO(directory_name + ".txt")
+    nfo_videoname = None
     if options.get('--name'):
-        if isfile(video_directory + "/" + options.get('--name')):
-            nfo_videoname = loadNFO(video_directory + "/" + options.get('--name') + ".txt")
-
-    video_file = splitext(basename(options.get('--file')))[0]
-    if isfile(video_directory + "/" + video_file + ".txt"):
-        nfo_file = loadNFO(video_directory + "/" + video_file + ".txt")
-
+        nfo_videoname = searchNFO(options.get('--name') + ".txt")
+    nfo_file = searchNFO(video_file + ".txt")
+    nfo_cli = None
     if options.get('--nfo'):
         if isfile(options.get('--nfo')):
             nfo_cli = loadNFO(options.get('--nfo'))
         else:
-            logger.critical("Given NFO file does not exist, please check your path.")
-            exit(1)
+            raise ValueError("Given NFO file does not exist, please check your path.")
 
-    # If there is no NFO and strict option is enabled, then stop there
-    if options.get('--withNFO'):
-        if not isinstance(nfo_cli, RawConfigParser) and \
-                not isinstance(nfo_file, RawConfigParser) and \
-                not isinstance(nfo_videoname, RawConfigParser) and \
-                not isinstance(nfo_directory, RawConfigParser) and \
-                not isinstance(nfo_txt, RawConfigParser):
-            logger.critical("You have required the strict presence of NFO but none is found, please use a NFO.")
-            exit(1)
-
-    # We need to load NFO in this exact order to keep the priorities
     # options in cli > nfo_cli > nfo_file > nfo_videoname > nfo_directory > nfo_txt
-    for nfo in [nfo_cli, nfo_file, nfo_videoname, nfo_directory, nfo_txt]:
-        if nfo:
-            # We need to check all options and replace it with the nfo value if not defined (None or False)
-            for key, value in options.items():
-                key = key.replace("-", "")
-                try:
-                    # get string options
-                    if value is None and nfo.get('video', key):
-                        options['--' + key] = nfo.get('video', key)
-                    # get boolean options
-                    elif value is False and nfo.getboolean('video', key):
-                        options['--' + key] = nfo.getboolean('video', key)
-                except NoOptionError:
-                    continue
-                except NoSectionError:
-                    logger.critical(nfo + " misses section [video], please check syntax of your NFO.")
-                    exit(1)
+    nfos = [nfo for nfo in [nfo_cli, nfo_file, nfo_videoname, nfo_directory, nfo_txt] if nfo is not None]
+
+    # If there is no NFO and strict option is enabled, then stop there
+    if options.get('--withNFO') and not nfos:
+        raise ValueError("You have required the strict presence of NFO but none is found, please use a NFO.")
+    return fillOptions(options, nfos)
+
+
+# Options not defined on cli (None or False) take the value of the first source defining them.
+# Sources are string values indexed by getOptionName, as read from a NFO or a manifest row
+def fillOptions(options, sources):
+    for key, value in options.items():
+        if value is not None and value is not False:
+            continue
+        name = getOptionName(key)
+        source_value = next((source[name] for source in sources if source.get(name)), None)
+        if source_value is None:
+            continue
+        if value is None:
+            options[key] = source_value
+        elif source_value.lower() in RawConfigParser.BOOLEAN_STATES:
+            options[key] = RawConfigParser.BOOLEAN_STATES[source_value.lower()]
+        else:
+            raise ValueError("Option " + name + " should be a boolean, got " + source_value)
     return options
 
 
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import os
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+import logging
+from os.path import join, splitext
+from stat import S_ISREG
+
+from . import utils
+
+logger = logging.getLogger('Prismedia')
+
+# Seconds the size and modification time of a video should stay the same before it is uploaded
+DEFAULT_STABLE_TIME = 10
+
+# Seconds between two scans of the directory when inotify is not available
+POLL_INTERVAL = 5
+
+# From <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE |
+              IN_DELETE_SELF | IN_MOVE_SELF)
+
+EVENT_HEADER = struct.Struct('iIII')
+
+
+class Inotify(object):
+    """Names of the files changed in a directory, read from inotify through the C library"""
+
+    def __init__(self, directory):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        if libc.inotify_add_watch(self.fd, os.fsencode(directory), WATCH_MASK) < 0:
+            error = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(error, "inotify_add_watch failed")
+
+    def read(self, timeout):
+        """Return the names changed within timeout seconds, or None when the whole directory should be scanned"""
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return []
+            raise
+        names = set()
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED):
+                raise OSError(errno.ENOENT, "watched directory was removed")
+            if mask & IN_Q_OVERFLOW:
+                # Events were lost
+                return None
+            if name:
+                names.add(os.fsdecode(name))
+        return names
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Poller(object):
+    """Same as Inotify, for filesystems without it: the directory is scanned every POLL_INTERVAL seconds"""
+
+    def __init__(self):
+        self._last = 0
+
+    def read(self, timeout):
+        if time.time() - self._last >= POLL_INTERVAL:
+            self._last = time.time()
+            return None
+        time.sleep(timeout)
+        return []
+
+    def close(self):
+        pass
+
+
+class Watcher(object):
+    """Videos of a directory ready to be uploaded.
+
+    A video is ready once its size and modification time, and the NFO and thumbnail
+    files of the directory, did not change for stable_time seconds, so a video still
+    being copied is not picked. A video is given again only if it changes after that.
+    Videos already in the directory when the watch starts are given too.
+    """
+
+    def __init__(self, directory, stable_time=DEFAULT_STABLE_TIME, poll=False):
+        self.directory = directory
+        self.stable_time = stable_time
+        self._pending = {}
+        self._given = {}
+        self._companions = set()
+        self.source = None
+        if not poll:
+            try:
+                self.source = Inotify(directory)
+                logger.info("Prismedia: Watching " + directory + " with inotify")
+            except (OSError, AttributeError) as e:
+                logger.warning("Prismedia: inotify is not available (" + str(e) + "), scanning " + directory +
+                               " every " + str(POLL_INTERVAL) + " seconds instead")
+        if self.source is None:
+            self.source = Poller()
+            logger.info("Prismedia: Watching " + directory + " by scanning it every " + str(POLL_INTERVAL) +
+                        " seconds")
+        self.scan()
+
+    def scan(self):
+        companions = set()
+        for entry in os.scandir(self.directory):
+            # Directories are not videos, whatever their name
+            if not entry.is_file():
+                continue
+            if splitext(entry.name)[1].lower() in utils.VIDEO_EXTENSIONS:
+                self.video_changed(entry.path)
+            else:
+                stat = entry.stat()
+                companions.add((entry.name, stat.st_size, stat.st_mtime_ns))
+        if companions != self._companions:
+            self._companions = companions
+            self.companions_changed()
+
+    def changed(self, name):
+        if splitext(name)[1].lower() in utils.VIDEO_EXTENSIONS:
+            self.video_changed(join(self.directory, name))
+        else:
+            self.companions_changed()
+
+    def companions_changed(self):
+        # NFO and thumbnails change the options of the waiting videos, wait for them too
+        now = time.time()
+        for path, (signature, since) in self._pending.items():
+            self._pending[path] = (signature, now)
+
+    def video_changed(self, path):
+        signature = self.signature(path)
+        if signature is None or self._given.get(path) == signature:
+            self._pending.pop(path, None)
+        elif path not in self._pending or self._pending[path][0] != signature:
+            self._pending[path] = (signature, time.time())
+
+    @staticmethod
+    def signature(path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        if not S_ISREG(stat.st_mode):
+            return None
+        # An empty video is being created, wait for its content
+        if not stat.st_size:
+            return None
+        return stat.st_size, stat.st_mtime_ns
+
+    def wait(self, timeout):
+        """Wait for changes during timeout seconds at most, and return the videos which became ready"""
+        names = self.source.read(timeout)
+        if names is None:
+            self.scan()
+        else:
+            for name in names:
+                self.changed(name)
+
+        ready = []
+        now = time.time()
+        for path, (signature, since) in sorted(self._pending.items()):
+            # Some writes are not notified (eg: mmap), check the video did not change anyway
+            current = self.signature(path)
+            if current != signature:
+                self.video_changed(path)
+            elif now - since >= self.stable_time:
+                del self._pending[path]
+                self._given[path] = signature
+                ready.append(path)
+        return ready
+
+    def close(self):
+        self.source.close()
@@ -4,31 +4,43 @@
 
 import http.client
 import httplib2
-import random
-import time
-import copy
 import json
-from os.path import splitext, basename, exists
+import hashlib
+import mimetypes
+from io import BytesIO
+from os.path import splitext, basename, exists, abspath
+from urllib.parse import urlparse
 import os
 import google.oauth2.credentials
 import datetime
 import pytz
 import logging
+import threading
+import requests
 from tzlocal import get_localzone
 
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
-from googleapiclient.http import MediaFileUpload
+from googleapiclient.http import MediaIoBaseUpload, MediaUploadProgress
 from google_auth_oauthlib.flow import InstalledAppFlow
-
-
+from google.auth.transport.requests import AuthorizedSession, Request
+
+
+from . import auth
+from . import cache
+from . import ledger
+from . import mp4
+from . import progress
+from . import quota
+from . import retry
+from . import sender
+from . import throttle
+from . import thumbnail
+from . import trace
+from . import transport
 from . import utils
 logger = logging.getLogger('Prismedia')
 
-# Explicitly tell the underlying HTTP transport library not to retry, since
-# we are handling retry logic ourselves.
-httplib2.RETRIES = 1
-
 # Maximum number of times to retry before giving up.
 MAX_RETRIES = 10
 
@@ -45,52 +57,272 @@ RETRIABLE_EXCEPTIONS = (
     http.client.BadStatusLine,
 )
 
-RETRIABLE_STATUS_CODES = [500, 502, 503, 504]
+RETRY_POLICY = retry.RetryPolicy("Youtube", RETRIABLE_EXCEPTIONS, max_attempts=MAX_RETRIES)
+
+# Requests creating something are only sent again when they never reached Youtube, or were rate limited
+UNSENT_RETRY_POLICY = retry.RetryPolicy("Youtube", retriable_status_codes=(429,), max_attempts=MAX_RETRIES,
+                                        is_retriable=transport.is_unsent)
+
+# Methods which may be sent again without changing the result, other requests are not retried by default
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
 
 
 CLIENT_SECRETS_FILE = 'youtube_secret.json'
+# Credentials are kept in the credential store, this file is only read to migrate older installations
 CREDENTIALS_PATH = ".youtube_credentials.json"
+CREDENTIALS_KEY = "youtube"
+EXPIRY_FORMAT = '%Y-%m-%dT%H:%M:%S'
+# Resumable sessions of unfinished uploads, to resume them on the next run
+UPLOAD_STATE_PATH = ".youtube_upload_state.json"
 SCOPES = ['https://www.googleapis.com/auth/youtube.upload', 'https://www.googleapis.com/auth/youtube.force-ssl']
 API_SERVICE_NAME = 'youtube'
 API_VERSION = 'v3'
 
+# Size in MB of the chunks sent to Youtube, the upload state is saved after each chunk
+DEFAULT_CHUNK_SIZE = 8
+
+# Quota units charged for each API method, other methods cost DEFAULT_QUOTA_COST
+QUOTA_COSTS = {
+    "youtube.videos.insert": 1600,
+    "youtube.thumbnails.set": 50,
+    "youtube.playlists.insert": 50,
+    "youtube.playlistItems.insert": 50,
+    "youtube.playlists.list": 1,
+}
+DEFAULT_QUOTA_COST = 1
+
+# Playlists given by each page of playlists.list, each page being charged
+PLAYLISTS_PAGE_SIZE = 50
+
+# Pages of playlists reserved for an account whose playlists were never listed
+DEFAULT_PLAYLISTS_PAGES = 4
+
+# Clients are not thread-safe, so each worker thread keeps its own, their connections being pooled
+_clients = threading.local()
+_upload_state_lock = threading.Lock()
+
+
+class YoutubeCredentials(google.oauth2.credentials.Credentials):
+    """Credentials saving every refreshed token, with its expiry, in the credential store.
+
+    google-auth refreshes them before expiry and on 401, refreshes are serialized
+    so concurrent workers do not refresh the same token twice.
+    """
+
+    def refresh(self, request):
+        stale_token = self.token
+        store = auth.get_store()
+        with store.lock:
+            # Another worker may have refreshed the token while we were waiting
+            if self.token != stale_token and self.valid:
+                return
+            logger.debug("Youtube: Refreshing access token.")
+            with trace.span("refresh token", platform="youtube"):
+                super(YoutubeCredentials, self).refresh(request)
+            store.set(CREDENTIALS_KEY, credentials_to_dict(self))
+
+
+class FileUpload(MediaIoBaseUpload):
+    """Resumable media upload giving each chunk to googleapiclient as a sender.FileBody.
+
+    googleapiclient hands streams to http.client, which reads and sends them 8 KB at
+    a time, chunks are sent in large blocks instead.
+    """
+
+    def has_stream(self):
+        return False
+
+    def getbytes(self, begin, length):
+        return sender.FileBody(self._fd, begin, max(0, min(length, self.size() - begin)))
+
+
+class AuthorizedHttp(object):
+    """httplib2 like object given to googleapiclient, sending its requests with the credentials over the transport.
+
+    API calls, uploads and token refreshes reuse the keep-alive connections of the
+    pools shared with Peertube, instead of the connections httplib2 opens for each client.
+    """
+
+    def __init__(self, credentials):
+        self.credentials = credentials
+        self.session = transport.mount(AuthorizedSession(
+            credentials, auth_request=Request(transport.mount(requests.Session()))))
+
+    def request(self, uri, method='GET', body=None, headers=None, redirections=None, connection_type=None):
+        # The timeout of the transport is used instead of the default one of AuthorizedSession
+        response = self.session.request(method, uri, data=body, headers=headers, timeout=None,
+                                        allow_redirects=method in ('GET', 'HEAD'))
+        headers = dict((key.lower(), value) for key, value in response.headers.items())
+        # The content is already decoded by requests
+        headers.pop('content-encoding', None)
+        headers['status'] = str(response.status_code)
+        resp = httplib2.Response(headers)
+        resp.reason = response.reason
+        return resp, response.content
+
+    def close(self):
+        # Connections belong to the shared pools and stay open for other clients
+        pass
+
+
+def credentials_to_dict(credentials):
+    expiry = None
+    if credentials.expiry:
+        expiry = credentials.expiry.strftime(EXPIRY_FORMAT)
+    return {
+        "token": credentials.token,
+        "refresh_token": credentials.refresh_token,
+        "token_uri": credentials.token_uri,
+        "client_id": credentials.client_id,
+        "client_secret": credentials.client_secret,
+        "scopes": list(credentials.scopes or []),
+        "expiry": expiry
+    }
+
+
+def credentials_from_dict(params):
+    expiry = None
+    if params.get("expiry"):
+        # google-auth works with naive UTC datetimes
+        expiry = datetime.datetime.strptime(params["expiry"], EXPIRY_FORMAT)
+    return YoutubeCredentials(
+        params["token"],
+        refresh_token=params["refresh_token"],
+        token_uri=params["token_uri"],
+        client_id=params["client_id"],
+        client_secret=params["client_secret"],
+        scopes=params["scopes"],
+        expiry=expiry
+    )
+
+
+# Import credentials saved by previous versions in their own file
+def migrate_legacy_credentials(store):
+    if not exists(CREDENTIALS_PATH):
+        return
+    with open(CREDENTIALS_PATH, 'r') as f:
+        credential_params = json.load(f)
+    if store.get(CREDENTIALS_KEY) is None:
+        migrated = {
+            "token": credential_params["token"],
+            "refresh_token": credential_params["_refresh_token"],
+            "token_uri": credential_params["_token_uri"],
+            "client_id": credential_params["_client_id"],
+            "client_secret": credential_params["_client_secret"],
+            "scopes": credential_params["_scopes"],
+            "expiry": None
+        }
+        store.set(CREDENTIALS_KEY, migrated)
+        # The store is read again, the old file is only put aside once the credentials are known to be saved
+        if store.get(CREDENTIALS_KEY) != migrated:
+            logger.warning("Youtube: Could not save the credentials of " + CREDENTIALS_PATH + " to " + store.path +
+                           ", keeping " + CREDENTIALS_PATH + ".")
+            return
+        logger.info("Youtube: Credentials moved from " + CREDENTIALS_PATH + " to " + store.path)
+    # Kept as a backup, the file is no longer read
+    os.replace(CREDENTIALS_PATH, CREDENTIALS_PATH + ".bak")
+
 
 # Authorize the request and store authorization credentials.
-def get_authenticated_service():
-    check_authenticated_scopes()
-    flow = InstalledAppFlow.from_client_secrets_file(
-        CLIENT_SECRETS_FILE, SCOPES)
-    if exists(CREDENTIALS_PATH):
-        with open(CREDENTIALS_PATH, 'r') as f:
-            credential_params = json.load(f)
-            credentials = google.oauth2.credentials.Credentials(
-                credential_params["token"],
-                refresh_token=credential_params["_refresh_token"],
-                token_uri=credential_params["_token_uri"],
-                client_id=credential_params["_client_id"],
-                client_secret=credential_params["_client_secret"]
-            )
-    else:
-        credentials = flow.run_console()
-        with open(CREDENTIALS_PATH, 'w') as f:
-            p = copy.deepcopy(vars(credentials))
-            del p["expiry"]
-            json.dump(p, f)
-    return build(API_SERVICE_NAME, API_VERSION, credentials=credentials,  cache_discovery=False)
+def get_credentials():
+    store = auth.get_store()
+    with store.lock:
+        migrate_legacy_credentials(store)
+        check_authenticated_scopes()
+        credential_params = store.get(CREDENTIALS_KEY)
+        if credential_params is not None:
+            credentials = credentials_from_dict(credential_params)
+        else:
+            flow = InstalledAppFlow.from_client_secrets_file(
+                CLIENT_SECRETS_FILE, SCOPES)
+            credentials = credentials_from_dict(credentials_to_dict(flow.run_console()))
+            store.set(CREDENTIALS_KEY, credentials_to_dict(credentials))
+    return credentials
+
+
+def get_authenticated_service(credentials=None):
+    if credentials is None:
+        credentials = get_credentials()
+    return build(API_SERVICE_NAME, API_VERSION, http=AuthorizedHttp(credentials), cache_discovery=False)
+
+
+# Return a client for the current thread, built once from the given credentials
+def get_client(credentials):
+    if getattr(_clients, 'credentials', None) is not credentials:
+        _clients.youtube = get_authenticated_service(credentials)
+        _clients.credentials = credentials
+    return _clients.youtube
+
+
+# Return the credentials, so several uploads may share them
+def get_session():
+    return get_credentials()
 
 
 def check_authenticated_scopes():
-    if exists(CREDENTIALS_PATH):
-        with open(CREDENTIALS_PATH, 'r') as f:
-            credential_params = json.load(f)
-            # Check if all scopes are present
-            if credential_params["_scopes"] != SCOPES:
-                logger.warning("Youtube: Credentials are obsolete, need to re-authenticate.")
-                os.remove(CREDENTIALS_PATH)
+    store = auth.get_store()
+    credential_params = store.get(CREDENTIALS_KEY)
+    # Check if all scopes are present
+    if credential_params is not None and credential_params["scopes"] != SCOPES:
+        logger.warning("Youtube: Credentials are obsolete, need to re-authenticate.")
+        store.delete(CREDENTIALS_KEY)
 
 
-def initialize_upload(youtube, options):
+def initialize_upload(youtube, options, upload_progress=None):
     path = options.get('--file')
+    if upload_progress is None:
+        upload_progress = progress.Progress("Youtube", path)
+
+    # The ledger lookup and the job share the fingerprint of the video, computed once
+    with upload_progress.phase('fingerprint'):
+        uploaded_url = ledger.get_ledger().lookup(path, "youtube")
+        job = None if uploaded_url else ledger.get_ledger().job(path, "youtube")
+    if uploaded_url:
+        logger.info("Youtube: " + path + " was already uploaded at " + uploaded_url +
+                    ", skipping. Use --force to upload it again.")
+        if options.get('--url-only'):
+            logging.getLogger('stdoutlogs').info(uploaded_url)
+        elif options.get('--batch'):
+            logging.getLogger('stdoutlogs').info("Youtube: " + uploaded_url)
+        return uploaded_url
+
+    if job.steps:
+        logger.info("Youtube: Resuming the upload of " + path + " after step " + job.last())
+    job.complete('authenticated')
+
+    # The whole job is checked against the quota left before sending anything
+    with quota.get_counter().reserve(get_project(), get_job_cost(options, job)):
+        return upload_job(youtube, options, path, job, upload_progress)
+
+
+# Return the quota units the remaining steps of job will use at most
+def get_job_cost(options, job):
+    cost = 0
+    if options.get('--playlist') and not job.done('resolved'):
+        cost += get_playlists_cost()
+        if options.get('--playlistCreate'):
+            cost += QUOTA_COSTS["youtube.playlists.insert"]
+    if not job.done('uploaded'):
+        cost += QUOTA_COSTS["youtube.videos.insert"]
+    if options.get('--thumbnail') and not job.done('thumbnail'):
+        cost += QUOTA_COSTS["youtube.thumbnails.set"]
+    if options.get('--playlist') and not job.done('playlist'):
+        cost += QUOTA_COSTS["youtube.playlistItems.insert"]
+    return cost
+
+
+# Return the quota units of listing the playlists of the account once, from the number of playlists cached
+def get_playlists_cost():
+    count = cache.get_cache().count(get_account(), 'playlists')
+    if count is None:
+        pages = DEFAULT_PLAYLISTS_PAGES
+    else:
+        # One more playlist than cached, in case some were created elsewhere
+        pages = count // PLAYLISTS_PAGE_SIZE + 1
+    return pages * QUOTA_COSTS["youtube.playlists.list"]
+
+
+def upload_job(youtube, options, path, job, upload_progress):
     tags = None
     if options.get('--tags'):
         tags = options.get('--tags').split(',')
@@ -137,43 +369,137 @@ def initialize_upload(youtube, options):
         publishAt = tz.localize(publishAt).isoformat()
         body['status']['publishAt'] = str(publishAt)
 
-    if options.get('--playlist'):
+    if job.done('resolved') and job.get('playlist') == options.get('--playlist'):
+        playlist_id = job.get('playlist_id')
+    else:
+        playlist_id = resolve_playlist(youtube, options, upload_progress)
+        job.complete('resolved', playlist=options.get('--playlist'), playlist_id=playlist_id)
+
+    if job.done('uploaded'):
+        video_id = job.get('video_id')
+        logger.info("Youtube: " + path + " was already sent at https://youtu.be/" + video_id +
+                    ", skipping the upload.")
+        if options.get('--url-only'):
+            logging.getLogger('stdoutlogs').info('https://youtu.be/%s' % video_id)
+        elif options.get('--batch'):
+            logging.getLogger('stdoutlogs').info("Youtube: https://youtu.be/%s" % video_id)
+    else:
+        # Call the API's videos.insert method to create and upload the video.
+        chunk_size = int(options.get('--chunk-size') or DEFAULT_CHUNK_SIZE) * 1024 * 1024
+        mimetype = mimetypes.guess_type(path)[0] or 'video/mp4'
+        source = path
+        if options.get('--faststart'):
+            with upload_progress.phase('faststart'):
+                source = mp4.get_faststart_copy(path)
+        with open(source, 'rb') as video:
+            # Chunks are read from the file while they are sent, at the rate allowed for Youtube
+            insert_request = youtube.videos().insert(
+                part=','.join(list(body.keys())),
+                body=body,
+                media_body=FileUpload(throttle.wrap(video, "youtube", upload_progress), mimetype,
+                                      chunksize=chunk_size, resumable=True)
+            )
+            with upload_progress.phase('transfer'):
+                video_id = resumable_upload(insert_request, 'video', 'insert', options,
+                                            identity=get_upload_identity(path, body, source),
+                                            upload_progress=upload_progress)
+        if not video_id:
+            return None
+        # Save the upload before anything else may fail, so a new run does not upload it twice
+        job.complete('uploaded', video_id=video_id)
+
+    # Upload is successful, we are able to set thumbnail
+    if options.get('--thumbnail') and not job.done('thumbnail'):
+        with upload_progress.phase('thumbnail'):
+            set_thumbnail(options, youtube, options.get('--thumbnail'), videoId=video_id)
+        job.complete('thumbnail')
+
+    # If we get a playlist_id, upload is successful and we are able to set playlist
+    if playlist_id and not job.done('playlist'):
+        with upload_progress.phase('playlist'):
+            set_playlist(youtube, playlist_id, video_id)
+        job.complete('playlist')
+
+    ledger.get_ledger().finish(job, path, 'https://youtu.be/%s' % video_id)
+    return 'https://youtu.be/%s' % video_id
+
+
+def resolve_playlist(youtube, options, upload_progress):
+    if not options.get('--playlist'):
+        return ""
+    with upload_progress.phase('lookup'):
         playlist_id = get_playlist_by_name(youtube, options.get('--playlist'))
-        if not playlist_id and options.get('--playlistCreate'):
+    if not playlist_id and options.get('--playlistCreate'):
+        with upload_progress.phase('create'):
             playlist_id = create_playlist(youtube, options.get('--playlist'))
-        elif not playlist_id:
-            logger.warning("Youtube: Playlist `" + options.get('--playlist') + "` is unknown.")
-            logger.warning("Youtube: If you want to create it, set the --playlistCreate option.")
-            playlist_id = ""
-    else:
+        cache.get_cache().add(get_account(), 'playlists', options.get('--playlist'), playlist_id)
+    elif not playlist_id:
+        logger.warning("Youtube: Playlist `" + options.get('--playlist') + "` is unknown.")
+        logger.warning("Youtube: If you want to create it, set the --playlistCreate option.")
         playlist_id = ""
+    return playlist_id
 
-    # Call the API's videos.insert method to create and upload the video.
-    insert_request = youtube.videos().insert(
-        part=','.join(list(body.keys())),
-        body=body,
-        media_body=MediaFileUpload(path, chunksize=-1, resumable=True)
-    )
-    video_id = resumable_upload(insert_request, 'video', 'insert', options)
 
-    # If we get a video_id, upload is successful and we are able to set thumbnail
-    if video_id and options.get('--thumbnail'):
-        set_thumbnail(options, youtube, options.get('--thumbnail'), videoId=video_id)
+# Key of the quota counter, quotas belong to the Google Cloud project of the OAuth client
+def get_project():
+    client_id = (auth.get_store().get(CREDENTIALS_KEY) or {}).get("client_id")
+    return "youtube:" + client_id if client_id else "youtube"
 
-    # If we get a video_id and a playlist_id, upload is successful and we are able to set playlist
-    if video_id and playlist_id != "":
-        set_playlist(youtube, playlist_id, video_id)
 
+# Count the quota units of an API call
+def spend_quota(request):
+    quota.get_counter().spend(get_project(), QUOTA_COSTS.get(request.methodId, DEFAULT_QUOTA_COST))
 
-def get_playlist_by_name(youtube, playlist_name):
-    response = youtube.playlists().list(
+
+def is_quota_exceeded(error):
+    return error.resp.status == 403 and b"quotaExceeded" in (error.content or b"")
+
+
+# Key of the channels and playlists cache, the refresh token changes with the authenticated account
+def get_account():
+    credential_params = auth.get_store().get(CREDENTIALS_KEY) or {}
+    refresh_token = credential_params.get("refresh_token") or ""
+    return "youtube:" + hashlib.sha1(refresh_token.encode('utf-8')).hexdigest()
+
+
+# Send the API request, retrying it on any retriable error when retry is true. By default requests
+# creating something (eg: playlists.insert) are only sent again if they never reached Youtube, as
+# one failing after Youtube committed it would create a duplicate.
+def execute(request, retry=None):
+    uri = urlparse(request.uri)
+    if retry is None:
+        retry = request.method.upper() in IDEMPOTENT_METHODS
+
+    # Every attempt reaching Youtube is charged, failed ones included
+    def attempt():
+        try:
+            response = request.execute()
+        except Exception as e:
+            if not transport.is_unsent(e):
+                spend_quota(request)
+            raise
+        spend_quota(request)
+        return response
+    with trace.span(request.method + " " + uri.path, platform="youtube"):
+        return (RETRY_POLICY if retry else UNSENT_RETRY_POLICY).call(attempt, host=uri.netloc)
+
+
+def get_playlists(youtube):
+    playlists = []
+    request = youtube.playlists().list(
         part='snippet,id',
         mine=True,
-        maxResults=50
-    ).execute()
-    for playlist in response["items"]:
-        if playlist["snippet"]['title'] == playlist_name:
-            return playlist['id']
+        maxResults=PLAYLISTS_PAGE_SIZE
+    )
+    while request is not None:
+        response = execute(request)
+        playlists.extend([playlist["snippet"]['title'], playlist['id']] for playlist in response["items"])
+        request = youtube.playlists().list_next(request, response)
+    return playlists
+
+
+def get_playlist_by_name(youtube, playlist_name):
+    return cache.get_cache().lookup(get_account(), 'playlists', playlist_name, lambda: get_playlists(youtube))
 
 
 def create_playlist(youtube, playlist_name):
@@ -182,10 +508,10 @@ def create_playlist(youtube, playlist_name):
     resources = build_resource({'snippet.title': playlist_name,
                                 'snippet.description': '',
                                 'status.privacyStatus': 'public'})
-    response = youtube.playlists().insert(
+    response = execute(youtube.playlists().insert(
         body=resources,
         part='status,snippet,id'
-    ).execute()
+    ))
     return response["id"]
 
 
@@ -231,9 +557,10 @@ def build_resource(properties):
 
 def set_thumbnail(options, youtube, media_file, **kwargs):
     kwargs = utils.remove_empty_kwargs(**kwargs)
+    image = BytesIO(thumbnail.get_thumbnail(media_file))
     request = youtube.thumbnails().set(
-        media_body=MediaFileUpload(media_file, chunksize=-1,
-                                   resumable=True),
+        media_body=MediaIoBaseUpload(image, 'image/jpeg', chunksize=-1,
+                                     resumable=True),
         **kwargs
     )
 
@@ -248,10 +575,10 @@ def set_playlist(youtube, playlist_id, video_id):
                                'snippet.position': ''}
                               )
     try:
-        youtube.playlistItems().insert(
+        execute(youtube.playlistItems().insert(
             body=resource,
             part='snippet'
-        ).execute()
+        ))
     except Exception as e:
         # Workaround while youtube API is broken, see issue #47 for details
         if e.resp.status != 404 and "Video not found" not in str(e):
@@ -264,20 +591,119 @@ def set_playlist(youtube, playlist_id, video_id):
     logger.info('Youtube: Video is correctly added to the playlist.')
 
 
+# Identify an upload by the file (path, size, mtime), the file its bytes are read from and its metadata.
+# A faststart copy has the layout of its boxes changed, a session started from it can not go on with the original
+def get_upload_identity(path, body, source=None):
+    stat = os.stat(path)
+    identity = {
+        "path": abspath(path),
+        "size": stat.st_size,
+        "mtime": stat.st_mtime,
+        "faststart": source is not None and abspath(source) != abspath(path)
+    }
+    key = json.dumps([identity, body], sort_keys=True).encode('utf-8')
+    identity["key"] = hashlib.sha1(key).hexdigest()
+    return identity
+
+
+def load_upload_state():
+    if not exists(UPLOAD_STATE_PATH):
+        return {}
+    try:
+        with open(UPLOAD_STATE_PATH, 'r') as f:
+            return json.load(f)
+    except ValueError:
+        logger.warning("Youtube: " + UPLOAD_STATE_PATH + " is corrupted, ignoring previous uploads.")
+        return {}
+
+
+def update_upload_state(key, session):
+    with _upload_state_lock:
+        state = load_upload_state()
+        if session is None:
+            state.pop(key, None)
+        else:
+            state[key] = session
+        # Write in a temporary file first so a crash never leaves a truncated state
+        with open(UPLOAD_STATE_PATH + ".tmp", 'w') as f:
+            json.dump(state, f)
+        os.replace(UPLOAD_STATE_PATH + ".tmp", UPLOAD_STATE_PATH)
+
+
+def save_upload_session(identity, request):
+    session = dict(identity)
+    session["uri"] = request.resumable_uri
+    session["progress"] = request.resumable_progress
+    update_upload_state(identity["key"], session)
+
+
+def restore_upload_session(identity, request):
+    session = load_upload_state().get(identity["key"])
+    if not session:
+        return False
+    logger.info('Youtube: Resuming previous upload of %s from byte %d.' % (session["path"], session["progress"]))
+    request.resumable_uri = session["uri"]
+    request.resumable_progress = session["progress"]
+    return True
+
+
+def query_upload_offset(request):
+    """Ask the server for the bytes of the resumable session it received, and go on from there.
+
+    Return the (status, response) of the session as next_chunk would, the response
+    being only given when the upload is already complete.
+    """
+    headers = {"Content-Range": "bytes */%d" % request.resumable.size(), "Content-Length": "0"}
+    resp, content = request.http.request(request.resumable_uri, "PUT", headers=headers)
+    if resp.status in (200, 201):
+        return None, request.postproc(resp, content)
+    if resp.status != 308:
+        raise HttpError(resp, content, uri=request.resumable_uri)
+    # The last byte received is given by the range header, missing when none was
+    received = resp.get("range")
+    request.resumable_progress = int(received.split("-")[1]) + 1 if received else 0
+    if "location" in resp:
+        request.resumable_uri = resp["location"]
+    return MediaUploadProgress(request.resumable_progress, request.resumable.size()), None
+
+
 # This method implements an exponential backoff strategy to resume a
 # failed upload.
-def resumable_upload(request, resource, method, options):
+# When the upload identity is given, the resumable session is saved after each chunk
+# so the upload may be resumed by another run.
+def resumable_upload(request, resource, method, options, identity=None, upload_progress=None):
     response = None
-    error = None
-    retry = 0
     logger_stdout = None
     if options.get('--url-only') or options.get('--batch'):
         logger_stdout = logging.getLogger('stdoutlogs')
+    resumed = identity is not None and restore_upload_session(identity, request)
+    if upload_progress is not None:
+        upload_progress.start(request.resumable.size(), request.resumable_progress)
+    template = 'Youtube: Uploading %s...'
+    logger.info(template % resource)
+
+    def next_chunk():
+        # Only starting the resumable session is charged, not the chunks
+        if request.resumable_uri is None:
+            spend_quota(request)
+        return request.next_chunk()
+
+    def query_offset():
+        return query_upload_offset(request)
+    # A resumed session starts from the bytes the server really received
+    send = query_offset if resumed else next_chunk
     while response is None:
         try:
-            template = 'Youtube: Uploading %s...'
-            logger.info(template % resource)
-            status, response = request.next_chunk()
+            with trace.span("next_chunk", platform="youtube", offset=request.resumable_progress):
+                status, response = RETRY_POLICY.call(send, host=urlparse(request.uri).netloc)
+            send = next_chunk
+            if upload_progress is not None:
+                upload_progress.update(status.resumable_progress if status else request.resumable.size())
+            if identity is not None:
+                if response is None:
+                    save_upload_session(identity, request)
+                else:
+                    update_upload_state(identity["key"], None)
             if response is not None:
                 if method == 'insert' and 'id' in response:
                     logger.info('Youtube : Video was successfully uploaded.')
@@ -297,31 +723,35 @@ def resumable_upload(request, resource, method, options):
                     logger.critical(template % response)
                     exit(1)
         except HttpError as e:
-            if e.resp.status in RETRIABLE_STATUS_CODES:
-                template = 'Youtube : A retriable HTTP error %d occurred:\n%s'
-                error = template % (e.resp.status, e.content)
+            if resumed and e.resp.status in (404, 410):
+                # Resumable sessions expire after some days, start over
+                logger.warning('Youtube: Previous upload session has expired, restarting the upload.')
+                update_upload_state(identity["key"], None)
+                request.resumable_uri = None
+                request.resumable_progress = 0
+                resumed = False
+                send = next_chunk
             else:
                 raise
-        except RETRIABLE_EXCEPTIONS as e:
-            error = 'Youtube : A retriable error occurred: %s' % e
 
-    if error is not None:
-        logger.warning(error)
-        retry += 1
-        if retry > MAX_RETRIES:
-            logger.error('Youtube : No longer attempting to retry.')
 
-        max_sleep = 2 ** retry
-        sleep_seconds = random.random() * max_sleep
-        logger.warning('Youtube : Sleeping %f seconds and then retrying...'
-              % sleep_seconds)
-        time.sleep(sleep_seconds)
-
-
-def run(options):
-    youtube = get_authenticated_service()
+def run(options, session=None):
+    upload_progress = progress.Progress("Youtube", options.get('--file'))
+    with upload_progress.phase('auth'):
+        youtube = get_client(session or get_session())
     try:
-        initialize_upload(youtube, options)
+        return initialize_upload(youtube, options, upload_progress)
+    except quota.QuotaExceeded as e:
+        logger.error("Youtube: Deferring " + options.get('--file') + " to the next quota window: " + str(e))
+        quota.defer(options.get('--file'), e.reset)
     except HttpError as e:
+        if is_quota_exceeded(e):
+            # Other applications may share the project, nothing more can be uploaded until the quota resets
+            quota.get_counter().exhaust(get_project())
+            quota.defer(options.get('--file'), quota.get_window()[1])
         logger.error('Youtube : An HTTP error %d occurred:\n%s' % (e.resp.status,
                                                             e.content))
+    except Exception as e:
+        logger.error('Youtube : ' + str(e))
+    finally:
+        upload_progress.finish()
@@ -0,0 +1,213 @@
+import json
+
+import pytest
+
+from prismedia import cache, pt_upload, yt_upload
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class Fetch(object):
+    """Fetch function returning the items given, counting its calls"""
+
+    def __init__(self, *items):
+        self.items = [list(item) for item in items]
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        return [list(item) for item in self.items]
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cache.time, 'time', clock)
+    return clock
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "cache.json")
+
+
+@pytest.fixture
+def resources(path, clock):
+    return cache.ResourceCache(path, ttl=60)
+
+
+def test_index_is_fetched_once_within_ttl(resources, clock):
+    fetch = Fetch(["Music", 1], ["Travels", 2])
+    assert resources.get_index("account", "playlists", fetch) == [["Music", 1], ["Travels", 2]]
+    clock.now += 59
+    assert resources.lookup("account", "playlists", "Travels", fetch) == 2
+    assert fetch.calls == 1
+
+
+def test_index_is_fetched_again_once_expired(resources, clock):
+    fetch = Fetch(["Music", 1])
+    resources.get_index("account", "playlists", fetch)
+    clock.now += 61
+    fetch.items.append(["Travels", 2])
+    assert resources.lookup("account", "playlists", "Travels", fetch) == 2
+    assert fetch.calls == 2
+
+
+def test_indexes_are_kept_per_account_and_kind(resources):
+    channels = Fetch(["Main", 1])
+    playlists = Fetch(["Main", 7])
+    other = Fetch(["Main", 9])
+    assert resources.lookup("account", "channels", "Main", channels) == 1
+    assert resources.lookup("account", "playlists", "Main", playlists) == 7
+    assert resources.lookup("other", "channels", "Main", other) == 9
+    assert (channels.calls, playlists.calls, other.calls) == (1, 1, 1)
+
+
+def test_missing_name_is_fetched_again_once_per_process(path, resources):
+    fetch = Fetch(["Music", 1])
+    resources.get_index("account", "playlists", fetch)
+    # Created elsewhere after the index was cached by a previous run
+    fetch.items.append(["Travels", 2])
+    resources = cache.ResourceCache(path, ttl=60)
+    assert resources.lookup("account", "playlists", "Travels", fetch) == 2
+    assert resources.lookup("account", "playlists", "Unknown", fetch) is None
+    assert resources.lookup("account", "playlists", "Unknown", fetch) is None
+    assert fetch.calls == 2
+
+
+def test_added_item_is_found_without_fetching(resources):
+    fetch = Fetch(["Music", 1])
+    resources.get_index("account", "playlists", fetch)
+    resources.add("account", "playlists", "Travels", 2)
+    assert resources.lookup("account", "playlists", "Travels", fetch) == 2
+    assert fetch.calls == 1
+
+
+def test_added_item_is_ignored_without_index(resources):
+    resources.add("account", "playlists", "Travels", 2)
+    assert resources.count("account", "playlists") is None
+
+
+def test_index_is_saved(path, resources, clock):
+    resources.get_index("account", "playlists", Fetch(["Music", 1]))
+    resources.add("account", "playlists", "Travels", 2)
+    resources = cache.ResourceCache(path, ttl=60)
+    fetch = Fetch()
+    assert resources.get_index("account", "playlists", fetch) == [["Music", 1], ["Travels", 2]]
+    assert resources.count("account", "playlists") == 2
+    assert fetch.calls == 0
+
+
+def test_clear_invalidates_every_index(path, resources):
+    fetch = Fetch(["Music", 1])
+    resources.get_index("account", "playlists", fetch)
+    resources.clear()
+    assert resources.count("account", "playlists") is None
+    assert cache.ResourceCache(path, ttl=60).count("account", "playlists") is None
+    resources.get_index("account", "playlists", fetch)
+    assert fetch.calls == 2
+
+
+def test_corrupted_file_is_ignored(path, clock, caplog):
+    with open(path, 'w') as f:
+        f.write('{"account": {"playlists": ')
+    resources = cache.ResourceCache(path, ttl=60)
+    assert "is corrupted" in caplog.text
+    fetch = Fetch(["Music", 1])
+    assert resources.lookup("account", "playlists", "Music", fetch) == 1
+    assert fetch.calls == 1
+    with open(path) as f:
+        assert json.load(f)["account"]["playlists"]["items"] == [["Music", 1]]
+
+
+@pytest.fixture
+def shared_cache(path, clock, monkeypatch):
+    resources = cache.ResourceCache(path, ttl=60)
+    monkeypatch.setattr(cache, '_cache', resources)
+    return resources
+
+
+class Response(object):
+    def __init__(self, data):
+        self.content = json.dumps(data)
+
+
+class PeertubeSession(object):
+    """Answer the playlists of the account a page at a time"""
+
+    def __init__(self, count):
+        self.playlists = [{"displayName": "Playlist %d" % number, "id": number} for number in range(count)]
+        self.requests = []
+
+    def get(self, url, params=None):
+        self.requests.append((url, params))
+        start, count = params['start'], params['count']
+        return Response({"total": len(self.playlists), "data": self.playlists[start:start + count]})
+
+
+class Secret(object):
+    def get(self, section, key):
+        return {"peertube_url": "https://peertube.example/", "username": "User"}[key]
+
+
+def test_peertube_playlist_lookup_reads_every_page(shared_cache):
+    page = pt_upload.PLAYLISTS_PAGE_SIZE
+    session = PeertubeSession(page * 2 + 1)
+    assert pt_upload.get_playlist_by_name(session, Secret(), {'--playlist': "Playlist %d" % (page * 2)}) == page * 2
+    assert [params['start'] for url, params in session.requests] == [0, page, page * 2]
+    assert session.requests[0][0] == "https://peertube.example/api/v1/accounts/user/video-playlists"
+
+    # The next videos of the batch find the playlist in the cache
+    assert pt_upload.get_playlist_by_name(session, Secret(), {'--playlist': "Playlist 0"}) == 0
+    assert len(session.requests) == 3
+    assert shared_cache.count("peertube:https://peertube.example:user", 'playlists') == page * 2 + 1
+
+
+class YoutubeRequest(object):
+    def __init__(self, page):
+        self.page = page
+
+
+class YoutubePlaylists(object):
+    def __init__(self, pages):
+        self.pages = pages
+
+    def list(self, part, mine, maxResults):
+        assert maxResults == yt_upload.PLAYLISTS_PAGE_SIZE
+        return YoutubeRequest(0)
+
+    def list_next(self, request, response):
+        if request.page + 1 < len(self.pages):
+            return YoutubeRequest(request.page + 1)
+        return None
+
+
+class Youtube(object):
+    def __init__(self, *pages):
+        self.pages = [[{"snippet": {"title": title}, "id": playlist_id} for title, playlist_id in page]
+                      for page in pages]
+        self.executed = []
+
+    def playlists(self):
+        return YoutubePlaylists(self.pages)
+
+    def execute(self, request):
+        self.executed.append(request.page)
+        return {"items": self.pages[request.page]}
+
+
+def test_youtube_playlist_lookup_reads_every_page(shared_cache, monkeypatch):
+    youtube = Youtube([("Music", "PL1"), ("Travels", "PL2")], [("Gaming", "PL3")])
+    monkeypatch.setattr(yt_upload, 'execute', youtube.execute)
+    monkeypatch.setattr(yt_upload, 'get_account', lambda: "youtube:account")
+    assert yt_upload.get_playlist_by_name(youtube, "Gaming") == "PL3"
+    assert yt_upload.get_playlist_by_name(youtube, "Music") == "PL1"
+    assert youtube.executed == [0, 1]
+    assert yt_upload.get_playlist_by_name(youtube, "Unknown") is None
+    assert youtube.executed == [0, 1]
@@ -0,0 +1,81 @@
+import os
+
+import pytest
+
+from prismedia import ledger
+
+
+@pytest.fixture
+def video(tmp_path):
+    path = tmp_path / "video.mp4"
+    path.write_bytes(os.urandom(3 * ledger.SAMPLE_SIZE) + b"end")
+    return str(path)
+
+
+@pytest.fixture
+def uploads(tmp_path):
+    return ledger.Ledger(str(tmp_path / "ledger.sqlite"))
+
+
+def test_lookup_unknown_video(uploads, video):
+    assert uploads.lookup(video, "peertube") is None
+
+
+def test_lookup_recorded_video(uploads, video):
+    uploads.record(video, "peertube", "https://peertube/videos/1")
+    assert uploads.lookup(video, "peertube") == "https://peertube/videos/1"
+    assert uploads.lookup(video, "youtube") is None
+
+
+def test_lookup_in_full_mode_of_video_recorded_in_fast_mode(uploads, video):
+    uploads.record(video, "youtube", "https://youtu.be/1")
+    uploads.mode = "full"
+    assert uploads.lookup(video, "youtube") == "https://youtu.be/1"
+
+
+def test_lookup_in_fast_mode_of_video_recorded_in_full_mode(uploads, video):
+    uploads.mode = "full"
+    uploads.record(video, "youtube", "https://youtu.be/1")
+    uploads.mode = "fast"
+    assert uploads.lookup(video, "youtube") == "https://youtu.be/1"
+
+
+def test_lookup_forced(uploads, video):
+    uploads.record(video, "youtube", "https://youtu.be/1")
+    uploads.force = True
+    assert uploads.lookup(video, "youtube") is None
+
+
+def test_changed_video_is_not_found(uploads, video):
+    uploads.record(video, "youtube", "https://youtu.be/1")
+    with open(video, 'ab') as f:
+        f.write(b"more")
+    assert uploads.lookup(video, "youtube") is None
+
+
+def test_job_resumes_in_full_mode_after_fast_mode(uploads, video):
+    job = uploads.job(video, "youtube")
+    job.complete("uploaded", video_id="abc")
+    uploads.mode = "full"
+    job = uploads.job(video, "youtube")
+    assert job.done("uploaded")
+    assert job.get("video_id") == "abc"
+
+
+def test_finished_job_is_forgotten(uploads, video):
+    job = uploads.job(video, "youtube")
+    job.complete("uploaded", video_id="abc")
+    uploads.mode = "full"
+    uploads.finish(uploads.job(video, "youtube"), video, "https://youtu.be/abc")
+    uploads.mode = "fast"
+    assert not uploads.job(video, "youtube").steps
+    assert uploads.lookup(video, "youtube") == "https://youtu.be/abc"
+
+
+def test_forced_job_starts_over_in_every_mode(uploads, video):
+    uploads.job(video, "youtube").complete("uploaded", video_id="abc")
+    uploads.mode = "full"
+    uploads.force = True
+    assert not uploads.job(video, "youtube").steps
+    uploads.force = False
+    assert not uploads.job(video, "youtube").steps
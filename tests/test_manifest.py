@@ -0,0 +1,131 @@
+import json
+import logging
+
+import pytest
+from docopt import docopt
+
+from prismedia import manifest, upload
+
+from .test_mp4 import write_video
+
+
+def write_lines(path, *rows):
+    path.write_text("".join((row if isinstance(row, str) else json.dumps(row)) + "\n" for row in rows))
+    return str(path)
+
+
+def test_read_json_lines(tmp_path):
+    path = write_lines(tmp_path / "jobs.jsonl",
+                       {"file": "a.mp4", "name": "Video A", "tags": ["x", "y"], "nsfw": True, "playlist": ""},
+                       "",
+                       "# Comments and blank lines are skipped",
+                       {"file": "b.mp4", "disable-comments": True, "publishAt": "2026-10-18T10:00:00"})
+    # Fields are named like NFO options, whatever their case or dashes
+    assert list(manifest.read(path)) == [
+        (1, {"file": "a.mp4", "name": "Video A", "tags": "x,y", "nsfw": "True"}),
+        (4, {"file": "b.mp4", "disablecomments": "True", "publishat": "2026-10-18T10:00:00"}),
+    ]
+
+
+def test_read_json_lines_reports_invalid_rows(tmp_path):
+    path = write_lines(tmp_path / "jobs.jsonl", {"file": "a.mp4"}, '{"file": "b.mp4"', '["c.mp4"]')
+    rows = list(manifest.read(path))
+    assert rows[0] == (1, {"file": "a.mp4"})
+    assert [number for number, fields in rows[1:]] == [2, 3]
+    assert str(rows[1][1]).startswith("invalid json: ")
+    assert str(rows[2][1]) == "a row should be a json object"
+
+
+def test_read_csv(tmp_path):
+    path = tmp_path / "jobs.csv"
+    path.write_text('file,name,description,nsfw\n'
+                    'a.mp4,Video A,"Two\nlines",\n'
+                    'b.mp4,,,True\n')
+    # Line numbers are the last line of each row, as a row may span several lines
+    assert list(manifest.read(str(path))) == [
+        (3, {"file": "a.mp4", "name": "Video A", "description": "Two\nlines"}),
+        (4, {"file": "b.mp4", "nsfw": "True"}),
+    ]
+
+
+def test_read_csv_ignores_extra_fields(tmp_path):
+    path = tmp_path / "jobs.CSV"
+    path.write_text('file,name\na.mp4,Video A,extra\n')
+    assert list(manifest.read(str(path))) == [(2, {"file": "a.mp4", "name": "Video A"})]
+
+
+@pytest.fixture
+def options(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "videos").mkdir()
+    for name in ("a.mp4", "b.mp4"):
+        write_video(tmp_path / "videos" / name)
+    argv = ["--manifest=jobs.jsonl", "--platform=peertube"]
+    return upload.earlyoptionSchema.validate(docopt(upload.__doc__, argv=argv))
+
+
+def test_validate_manifest(tmp_path, options, caplog):
+    path = write_lines(tmp_path / "jobs.jsonl",
+                       {"file": "videos/a.mp4", "name": "Video A", "privacy": "public"},
+                       {"file": "videos/b.mp4", "category": "nope"},
+                       "not json",
+                       {"file": "videos/b.mp4", "bogus": 1, "other": 2},
+                       {"name": "no file"},
+                       {"file": "videos/missing.mp4"},
+                       {"file": "videos/b.mp4", "description": "B", "nsfw": True})
+    invalid, validated = upload.validateManifest(options, path)
+
+    assert invalid == set([2, 3, 4, 5, 6])
+    assert sorted(validated) == [1, 7]
+    assert validated[1]['--file'] == str(tmp_path / "videos" / "a.mp4")
+    assert validated[1]['--name'] == "Video A"
+    assert validated[7]['--nsfw'] is True
+    errors = dict((record.getMessage().split(": ", 2)[1], record.getMessage().split(": ", 2)[2])
+                  for record in caplog.records if record.levelno == logging.CRITICAL)
+    assert sorted(errors) == [path + " line %d" % number for number in (2, 3, 4, 5, 6)]
+    assert errors[path + " line 3"].startswith("invalid json: ")
+    assert errors[path + " line 4"] == "unknown fields bogus, other"
+    assert errors[path + " line 5"] == "no file given"
+    assert errors[path + " line 6"] == "file is not supported, please use mp4"
+
+
+def test_validate_manifest_keeps_a_bounded_number_of_rows(tmp_path, options, monkeypatch):
+    monkeypatch.setattr(upload, 'MANIFEST_VALIDATED_ROWS', 2)
+    path = write_lines(tmp_path / "jobs.jsonl", *[{"file": "videos/a.mp4"}] * 3)
+    invalid, validated = upload.validateManifest(options, path)
+    assert not invalid
+    assert sorted(validated) == [1, 2]
+
+
+def test_upload_manifest_exits_on_missing_file(tmp_path, options, monkeypatch):
+    uploads = []
+    monkeypatch.setattr(upload, 'uploadBatchVideo', lambda *args: uploads.append(args))
+    options['--manifest'] = str(tmp_path / "missing.jsonl")
+    with pytest.raises(SystemExit) as exit:
+        upload.uploadManifest(options)
+    assert exit.value.code == 1
+    assert uploads == []
+
+
+def test_upload_manifest_uploads_valid_rows_with_their_validated_options(tmp_path, options, monkeypatch, caplog):
+    caplog.set_level(logging.INFO, logger='Prismedia')
+    uploads = []
+
+    def upload_video(video_options, video, sessions, validated=False):
+        uploads.append((video, video_options.get('--name'), validated))
+        return {"peertube": ("https://peertube/" + video_options.get('--name'), 0.1)}
+    monkeypatch.setattr(upload, 'uploadBatchVideo', upload_video)
+    monkeypatch.setattr(upload, 'MANIFEST_VALIDATED_ROWS', 1)
+    options['--manifest'] = write_lines(tmp_path / "jobs.jsonl",
+                                        {"file": "videos/a.mp4", "name": "Video A"},
+                                        {"file": "videos/a.mp4", "name": "Video A", "bogus": 1},
+                                        {"file": "videos/b.mp4", "name": "Video B"})
+    with pytest.raises(SystemExit) as exit:
+        upload.uploadManifest(options)
+
+    # The invalid row is reported at the end
+    assert exit.value.code == 1
+    # Rows beyond MANIFEST_VALIDATED_ROWS are loaded again by their worker
+    assert uploads == [(str(tmp_path / "videos" / "a.mp4"), "Video A", True),
+                       (str(tmp_path / "videos" / "b.mp4"), "Video B", False)]
+    assert "Prismedia: 2 videos uploaded, 0 deferred to the next quota window, 0 failed, 1 invalid" in caplog.text
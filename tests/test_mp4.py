@@ -0,0 +1,185 @@
+import os
+import struct
+import tempfile
+
+import pytest
+
+from prismedia import mp4
+
+CHUNKS = [b"first chunk", b"second chunk", b"third chunk"]
+
+
+def box(box_type, payload=b""):
+    return struct.pack('>I4s', 8 + len(payload), box_type) + payload
+
+
+def large_box(box_type, payload=b""):
+    return struct.pack('>I4sQ', 1, box_type, 16 + len(payload)) + payload
+
+
+def full_box(box_type, payload, version=0):
+    return box(box_type, struct.pack('>I', version << 24) + payload)
+
+
+def chunk_offsets(offsets, box_type):
+    entry = '>%dI' if box_type == b'stco' else '>%dQ'
+    return full_box(box_type, struct.pack('>I', len(offsets)) + struct.pack(entry % len(offsets), *offsets))
+
+
+def movie(offsets, box_type=b'stco'):
+    mvhd = full_box(b'mvhd', struct.pack('>IIII', 0, 0, 1000, 90000) + bytes(80))
+    tkhd = full_box(b'tkhd', bytes(72) + struct.pack('>II', 1280 << 16, 720 << 16))
+    hdlr = full_box(b'hdlr', struct.pack('>I4s', 0, b'vide') + bytes(12))
+    stsd = full_box(b'stsd', struct.pack('>I', 1) + box(b'avc1', bytes(78)))
+    stbl = box(b'stbl', stsd + chunk_offsets(offsets, box_type))
+    trak = box(b'trak', tkhd + box(b'mdia', hdlr + box(b'minf', stbl)))
+    return box(b'moov', mvhd + trak)
+
+
+def write_video(path, box_type=b'stco', mdat_box=box):
+    """Write a video with its movie box after the media data, and return its content"""
+    ftyp = box(b'ftyp', b'isom' + struct.pack('>I', 512) + b'isomiso2')
+    free = box(b'free', b'padding')
+    mdat = mdat_box(b'mdat', b"".join(CHUNKS))
+    offset = len(ftyp) + len(free) + len(mdat) - sum(len(chunk) for chunk in CHUNKS)
+    offsets = []
+    for chunk in CHUNKS:
+        offsets.append(offset)
+        offset += len(chunk)
+    data = ftyp + free + mdat + movie(offsets, box_type)
+    path.write_bytes(data)
+    return data
+
+
+def read_chunks(data):
+    """Return the chunks pointed to by the chunk offsets of the movie box of data"""
+    moov = [box for box in mp4.iter_boxes(data) if box[0] == b'moov'][0]
+    pending = [moov[1:]]
+    while pending:
+        start, end = pending.pop()
+        for box_type, payload, payload_end in mp4.iter_boxes(data, start, end):
+            if box_type in mp4.CONTAINER_BOXES:
+                pending.append((payload, payload_end))
+            elif box_type in (b'stco', b'co64'):
+                entry = '>%dI' if box_type == b'stco' else '>%dQ'
+                count = struct.unpack_from('>I', data, payload + 4)[0]
+                offsets = struct.unpack_from(entry % count, data, payload + 8)
+                return [data[offset:offset + len(chunk)] for offset, chunk in zip(offsets, CHUNKS)]
+
+
+@pytest.mark.parametrize("box_type", [b'stco', b'co64'])
+@pytest.mark.parametrize("mdat_box", [box, large_box])
+def test_faststart_moves_movie_box_and_patches_chunk_offsets(tmp_path, box_type, mdat_box):
+    path = tmp_path / "video.mp4"
+    data = write_video(path, box_type, mdat_box)
+    assert read_chunks(data) == CHUNKS
+    facts = mp4.probe(str(path))
+    assert not facts['faststart']
+
+    copy = tmp_path / "copy.mp4"
+    mp4.write_faststart(str(path), str(copy), facts)
+    copied = copy.read_bytes()
+    assert len(copied) == len(data)
+    assert [box[0] for box in mp4.probe(str(copy))['boxes']] == ['ftyp', 'free', 'moov', 'mdat']
+    assert read_chunks(copied) == CHUNKS
+
+
+def test_faststart_rewrites_64_bits_movie_box_size(tmp_path):
+    path = tmp_path / "video.mp4"
+    data = write_video(path)
+    moov = data.index(b'moov') - 4
+    # The same movie box, with a 64 bits size
+    path.write_bytes(data[:moov] + large_box(b'moov', data[moov + 8:]))
+
+    copy = tmp_path / "copy.mp4"
+    mp4.write_faststart(str(path), str(copy), mp4.probe(str(path)))
+    copied = copy.read_bytes()
+    assert len(copied) == len(data)
+    assert read_chunks(copied) == CHUNKS
+
+
+def test_faststart_rejects_chunk_offset_outside_of_boxes(tmp_path):
+    path = tmp_path / "video.mp4"
+    data = write_video(path)
+    offsets = struct.pack('>3I', *[len(data) + 10] * 3)
+    stco = data.index(b'stco') + 12
+    path.write_bytes(data[:stco] + offsets + data[stco + len(offsets):])
+
+    with pytest.raises(mp4.MP4Error):
+        mp4.write_faststart(str(path), str(tmp_path / "copy.mp4"), mp4.probe(str(path)))
+
+
+def test_probe_reads_movie_box(tmp_path):
+    path = tmp_path / "video.mp4"
+    data = write_video(path)
+    facts = mp4.probe(str(path))
+    assert facts['size'] == len(data)
+    assert facts['brand'] == 'isom'
+    assert [box[0] for box in facts['boxes']] == ['ftyp', 'free', 'mdat', 'moov']
+    assert facts['duration'] == 90.0
+    assert facts['bitrate'] == int(len(data) * 8 / 90.0)
+    assert (facts['width'], facts['height']) == (1280, 720)
+    assert facts['video_codec'] == 'avc1'
+    assert 'audio_codec' not in facts
+
+
+def test_probe_reads_64_bits_box_sizes(tmp_path):
+    path = tmp_path / "video.mp4"
+    data = write_video(path, mdat_box=large_box)
+    mdat = [box for box in mp4.probe(str(path))['boxes'] if box[0] == 'mdat'][0]
+    assert mdat[2] == 16 + sum(len(chunk) for chunk in CHUNKS)
+    assert mdat[1] + mdat[2] < len(data)
+
+
+def test_probe_reads_last_box_extending_to_end_of_file(tmp_path):
+    path = tmp_path / "video.mp4"
+    data = write_video(path)
+    moov = data.index(b'moov') - 4
+    mdat = box(b'mdat', b"".join(CHUNKS))
+    # Media data last, with a size of 0
+    path.write_bytes(data[:data.index(b'free') - 4] + data[moov:] + struct.pack('>I4s', 0, b'mdat') + mdat[8:])
+    facts = mp4.probe(str(path))
+    assert facts['faststart']
+    assert facts['boxes'][-1][2] == len(mdat)
+
+
+@pytest.mark.parametrize("data, error", [
+    (b"not a video at all", "no ftyp box"),
+    (box(b'ftyp', b'isom') + box(b'mdat', b'data'), "no moov box"),
+    (box(b'ftyp', b'isom') + box(b'moov'), "no mdat box"),
+    (box(b'ftyp', b'isom') + struct.pack('>I4s', 100, b'mdat'), "invalid size"),
+    (box(b'ftyp', b'isom') + b'moo', "truncated box header"),
+    (box(b'ftyp', b'isom') + box(b'mdat') + box(b'moov', box(b'trak', struct.pack('>I4s', 4, b'tkhd'))),
+     "invalid size for box"),
+    (box(b'ftyp', b'isom') + box(b'mdat') + box(b'moov', box(b'mvhd')), "movie box is corrupted"),
+])
+def test_probe_rejects_invalid_files(tmp_path, data, error):
+    path = tmp_path / "video.mp4"
+    path.write_bytes(data)
+    with pytest.raises(mp4.MP4Error, match=error):
+        mp4.probe(str(path))
+
+
+def test_get_facts_probes_again_modified_file(tmp_path):
+    path = tmp_path / "video.mp4"
+    write_video(path)
+    facts = mp4.get_facts(str(path))
+    assert mp4.get_facts(str(path)) is facts
+    write_video(path, b'co64')
+    assert mp4.get_facts(str(path)) is not facts
+
+
+def test_faststart_copy(tmp_path, monkeypatch):
+    monkeypatch.setattr(tempfile, 'tempdir', str(tmp_path / "tmp"))
+    path = tmp_path / "video.mp4"
+    write_video(path)
+    copy = mp4.get_faststart_copy(str(path))
+    assert copy != str(path)
+    assert copy.startswith(str(tmp_path / "tmp" / mp4.FASTSTART_DIRECTORY))
+    assert mp4.get_facts(copy)['faststart']
+    assert mp4.get_faststart_copy(str(path)) == copy
+    # A video already laid out for streaming is uploaded as is
+    assert mp4.get_faststart_copy(copy) == copy
+    mp4.remove_faststart_copy(str(path))
+    assert not os.path.exists(copy)
+    assert os.listdir(str(tmp_path / "tmp")) == []
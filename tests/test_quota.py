@@ -0,0 +1,154 @@
+import datetime
+import threading
+
+import pytest
+
+from prismedia import quota
+
+UTC = datetime.timezone.utc
+
+
+def timestamp(*date):
+    return datetime.datetime(*date, tzinfo=UTC).timestamp()
+
+
+@pytest.fixture(params=["zoneinfo", "pytz"])
+def timezone(request, monkeypatch):
+    if request.param == "pytz":
+        pytz = pytest.importorskip("pytz")
+        monkeypatch.setattr(quota, '_timezone', pytz.timezone(quota.QUOTA_TIMEZONE))
+    else:
+        zoneinfo = pytest.importorskip("zoneinfo")
+        monkeypatch.setattr(quota, '_timezone', zoneinfo.ZoneInfo(quota.QUOTA_TIMEZONE))
+
+
+@pytest.mark.parametrize("now, day, reset", [
+    # 23:30 and 00:30 Pacific standard time
+    (timestamp(2026, 1, 15, 7, 30), "2026-01-14", timestamp(2026, 1, 15, 8)),
+    (timestamp(2026, 1, 15, 8, 30), "2026-01-15", timestamp(2026, 1, 16, 8)),
+    # The window starts exactly at midnight
+    (timestamp(2026, 1, 15, 8), "2026-01-15", timestamp(2026, 1, 16, 8)),
+    # Clocks go forward at 2:00 on March 8th 2026, the day lasts 23 hours and ends at midnight daylight time
+    (timestamp(2026, 3, 8, 9), "2026-03-08", timestamp(2026, 3, 9, 7)),
+    (timestamp(2026, 3, 9, 6, 30), "2026-03-08", timestamp(2026, 3, 9, 7)),
+    # Clocks go back at 2:00 on November 1st 2026, the day lasts 25 hours and ends at midnight standard time
+    (timestamp(2026, 11, 1, 7, 30), "2026-11-01", timestamp(2026, 11, 2, 8)),
+    (timestamp(2026, 11, 2, 7, 30), "2026-11-01", timestamp(2026, 11, 2, 8)),
+    (timestamp(2026, 11, 2, 8), "2026-11-02", timestamp(2026, 11, 3, 8)),
+])
+def test_window(timezone, now, day, reset):
+    assert quota.get_window(now) == (day, reset)
+
+
+class Clock(object):
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock(timestamp(2026, 3, 8, 20))
+    monkeypatch.setattr(quota.time, 'time', clock)
+    return clock
+
+
+@pytest.fixture
+def counter(tmp_path, clock):
+    return quota.QuotaCounter(str(tmp_path / "quota.json"), limit=2000)
+
+
+def get_used(counter, project="project"):
+    return counter._used(counter._load(), project, quota.get_window()[0])
+
+
+def test_spend_adds_to_the_counter_of_the_project(counter):
+    counter.spend("project", 1600)
+    counter.spend("project", 50)
+    counter.spend("other", 1)
+    assert get_used(counter) == 1650
+    assert get_used(counter, "other") == 1
+
+
+def test_counter_starts_from_zero_in_the_next_window(counter, clock):
+    counter.spend("project", 1600)
+    clock.now = quota.get_window()[1]
+    assert get_used(counter) == 0
+    counter.spend("project", 50)
+    assert get_used(counter) == 50
+
+
+def test_counter_is_shared_through_the_file(counter):
+    counter.spend("project", 1600)
+    other_run = quota.QuotaCounter(counter.path, limit=2000)
+    other_run.spend("project", 50)
+    assert get_used(counter) == 1650
+
+
+def test_reserve_raises_when_too_few_units_are_left(counter):
+    counter.spend("project", 1000)
+    with pytest.raises(quota.QuotaExceeded) as error:
+        with counter.reserve("project", 1600):
+            pass
+    assert (error.value.cost, error.value.remaining) == (1600, 1000)
+    # Quotas reset at midnight Pacific daylight time
+    assert error.value.reset == timestamp(2026, 3, 9, 7)
+    # Another project has its own quota
+    with counter.reserve("other", 1600):
+        pass
+
+
+def test_reservations_are_taken_from_the_units_left(counter):
+    with counter.reserve("project", 1600):
+        with pytest.raises(quota.QuotaExceeded) as error:
+            with counter.reserve("project", 1600):
+                pass
+        assert error.value.remaining == 400
+    with counter.reserve("project", 1600):
+        pass
+
+
+def test_calls_use_the_reservation_of_their_job(counter):
+    with counter.reserve("project", 1650) as reservation:
+        counter.spend("project", 1600)
+        assert reservation.left == 50
+        # A job running in another thread only has the units left by this reservation
+        errors = []
+
+        def other_job():
+            try:
+                with counter.reserve("project", 400):
+                    pass
+            except quota.QuotaExceeded as e:
+                errors.append(e)
+        thread = threading.Thread(target=other_job)
+        thread.start()
+        thread.join()
+        assert [error.remaining for error in errors] == [350]
+    # The units the job did not use are released
+    assert counter._reserved["project"] == 0
+    with counter.reserve("project", 400):
+        pass
+
+
+def test_exhaust_uses_the_whole_quota(counter):
+    counter.spend("project", 100)
+    counter.exhaust("project")
+    assert get_used(counter) == 2000
+    with pytest.raises(quota.QuotaExceeded) as error:
+        with counter.reserve("project", 1):
+            pass
+    assert error.value.remaining == 0
+    counter.exhaust("project")
+    assert get_used(counter) == 2000
+
+
+def test_corrupted_file_counts_from_zero(counter, caplog):
+    with open(counter.path, 'w') as f:
+        f.write('{"project": ')
+    assert get_used(counter) == 0
+    assert "is corrupted" in caplog.text
+    counter.spend("project", 50)
+    assert get_used(counter) == 50
@@ -0,0 +1,141 @@
+import pytest
+
+from prismedia import retry
+
+
+class Response(object):
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+@pytest.fixture(autouse=True)
+def sleeps(monkeypatch):
+    slept = []
+    monkeypatch.setattr(retry.time, 'sleep', slept.append)
+    monkeypatch.setattr(retry, '_breakers', {})
+    return slept
+
+
+def make_calls(*outcomes):
+    outcomes = list(outcomes)
+    calls = []
+
+    def func():
+        calls.append(None)
+        outcome = outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+    return func, calls
+
+
+def test_delay_is_bounded():
+    policy = retry.RetryPolicy("Test", base_delay=1, max_delay=10)
+    for attempt in range(1, 10):
+        assert 0 <= policy.delay(attempt) <= min(10, 2 ** attempt)
+
+
+def test_delay_honours_retry_after():
+    policy = retry.RetryPolicy("Test")
+    assert policy.delay(1, retry_after=30) >= 30
+
+
+def test_retry_after_in_seconds():
+    assert retry.get_retry_after(Response(429, {'Retry-After': '12'})) == 12
+    assert retry.get_retry_after(Response(429)) is None
+
+
+def test_retriable_status_is_retried(sleeps):
+    func, calls = make_calls(Response(503), Response(502), Response(200))
+    result = retry.RetryPolicy("Test").call(func)
+    assert result.status_code == 200
+    assert len(calls) == 3
+    assert len(sleeps) == 2
+
+
+def test_errors_accepted_by_is_retriable_are_retried():
+    policy = retry.RetryPolicy("Test", retriable_status_codes=(), is_retriable=lambda e: "refused" in str(e))
+    func, calls = make_calls(IOError("connection refused"), Response(200))
+    assert policy.call(func).status_code == 200
+    func, calls = make_calls(IOError("connection reset"), Response(200))
+    with pytest.raises(IOError):
+        policy.call(func)
+    assert len(calls) == 1
+
+
+def test_refused_connection_is_unsent():
+    requests = pytest.importorskip("requests")
+    from prismedia import transport
+    with pytest.raises(requests.ConnectionError) as error:
+        requests.get("http://127.0.0.1:1/", timeout=5)
+    assert transport.is_unsent(error.value)
+    assert not transport.is_unsent(requests.ConnectionError("Connection aborted."))
+    assert not transport.is_unsent(requests.ReadTimeout())
+
+
+def test_other_status_is_returned():
+    func, calls = make_calls(Response(404))
+    assert retry.RetryPolicy("Test").call(func).status_code == 404
+    assert len(calls) == 1
+
+
+def test_retriable_exception_is_retried():
+    func, calls = make_calls(IOError("reset"), Response(200))
+    assert retry.RetryPolicy("Test", (IOError,)).call(func).status_code == 200
+    assert len(calls) == 2
+
+
+def test_other_exception_is_raised():
+    func, calls = make_calls(ValueError("bad"))
+    with pytest.raises(ValueError):
+        retry.RetryPolicy("Test", (IOError,)).call(func)
+    assert len(calls) == 1
+
+
+def test_last_response_is_returned_after_max_attempts():
+    func, calls = make_calls(*[Response(500)] * 3)
+    assert retry.RetryPolicy("Test", max_attempts=3).call(func).status_code == 500
+    assert len(calls) == 3
+
+
+def test_last_error_is_raised_after_max_attempts():
+    func, calls = make_calls(*[IOError("reset")] * 3)
+    with pytest.raises(IOError):
+        retry.RetryPolicy("Test", (IOError,), max_attempts=3).call(func)
+    assert len(calls) == 3
+
+
+def test_on_retry_is_called_before_each_new_attempt():
+    func, calls = make_calls(Response(500), Response(500), Response(200))
+    retried = []
+    retry.RetryPolicy("Test").call(func, on_retry=lambda: retried.append(len(calls)))
+    assert retried == [1, 2]
+
+
+def test_circuit_opens_after_threshold(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(retry.time, 'time', lambda: now[0])
+    breaker = retry.CircuitBreaker("host", threshold=3, cooldown=60)
+    for i in range(2):
+        breaker.record_failure()
+    assert breaker.wait_time() == 0
+    breaker.record_failure()
+    assert breaker.wait_time() == 60
+    now[0] += 61
+    assert breaker.wait_time() == 0
+    # A single failure after the cooldown opens it again
+    breaker.record_failure()
+    assert breaker.wait_time() == 60
+    breaker.record_success()
+    assert breaker.wait_time() == 0
+
+
+def test_open_circuit_gives_up_when_wait_exceeds_budget():
+    breaker = retry.get_breaker("down.example")
+    breaker.threshold = 1
+    breaker.record_failure()
+    func, calls = make_calls(Response(200))
+    with pytest.raises(retry.CircuitOpenError):
+        retry.RetryPolicy("Test", budget=10).call(func, host="down.example")
+    assert not calls
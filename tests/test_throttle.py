@@ -0,0 +1,107 @@
+import io
+
+import pytest
+
+from prismedia import sender, throttle
+
+
+class Clock(object):
+    """Stand-in for time.time and time.sleep, sleeping moves the clock forward"""
+
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(throttle.time, 'time', clock.time)
+    monkeypatch.setattr(throttle.time, 'sleep', clock.sleep)
+    return clock
+
+
+@pytest.mark.parametrize("rate, expected", [
+    ("500", 500), ("500K", 500000), ("2M", 2000000), ("1.5m", 1500000), ("1G", 1000000000), ("2MB", 2000000),
+])
+def test_parse_rate(rate, expected):
+    assert throttle.parse_rate(rate) == expected
+
+
+@pytest.mark.parametrize("rate", ["", "fast", "0", "-1M", "2T"])
+def test_parse_invalid_rate(rate):
+    with pytest.raises(ValueError):
+        throttle.parse_rate(rate)
+
+
+def test_bucket_lets_burst_through(clock):
+    bucket = throttle.TokenBucket("test", 1000000)
+    assert bucket.consume(bucket.burst) == 0
+    assert clock.slept == []
+
+
+def test_bucket_keeps_rate(clock):
+    bucket = throttle.TokenBucket("test", 1000000)
+    start = clock.now
+    for i in range(100):
+        bucket.consume(throttle.BLOCK_SIZE)
+    # Every byte beyond the burst waits for its token
+    assert clock.now - start == pytest.approx((100 * throttle.BLOCK_SIZE - bucket.burst) / 1000000.0)
+    # Each wait is at most one block long, bytes are not sent in bursts
+    assert max(clock.slept) <= throttle.BLOCK_SIZE / 1000000.0 + 1e-9
+
+
+def test_bucket_holds_no_more_than_burst_after_idle_time(clock):
+    bucket = throttle.TokenBucket("test", 1000000)
+    bucket.consume(bucket.burst)
+    clock.now += 3600
+    assert bucket.consume(bucket.burst) == 0
+    assert bucket.consume(throttle.BLOCK_SIZE) == pytest.approx(throttle.BLOCK_SIZE / 1000000.0)
+
+
+def test_bucket_adds_short_waits_to_next_one(clock):
+    bucket = throttle.TokenBucket("test", 1000000)
+    bucket.consume(bucket.burst)
+    assert bucket.consume(1000) == 0
+    assert bucket.consume(throttle.BLOCK_SIZE) == pytest.approx((1000 + throttle.BLOCK_SIZE) / 1000000.0)
+
+
+def test_throttled_file_reads_through_every_bucket(clock):
+    data = bytes(bytearray(range(256))) * 1024
+    buckets = [throttle.TokenBucket("platform", 100000), throttle.TokenBucket("all uploads", 1000000)]
+    f = throttle.ThrottledFile(io.BytesIO(data), buckets)
+    assert f.read(100000) == data[:100000]
+    assert f.read() == data[100000:]
+    assert f.read(10) == b''
+    # The slowest bucket sets the pace
+    assert clock.now - 1000.0 >= (len(data) - buckets[0].burst) / 100000.0
+
+
+def test_throttled_body_is_read_while_sent(clock):
+    reads = []
+
+    class File(io.BytesIO):
+        def read(self, size=-1):
+            reads.append(size)
+            return super(File, self).read(size)
+
+    f = throttle.ThrottledFile(File(b"x" * 10 * throttle.BLOCK_SIZE), [throttle.TokenBucket("test", 1000000)])
+    body = sender.FileBody(f, throttle.BLOCK_SIZE, 5 * throttle.BLOCK_SIZE)
+    assert not body.can_sendfile()
+    blocks = iter(body)
+    assert reads == []
+    assert len(next(blocks)) == throttle.BLOCK_SIZE
+    assert reads == [throttle.BLOCK_SIZE]
+    assert sum(len(block) for block in blocks) == 4 * throttle.BLOCK_SIZE
+
+
+def test_wrap_without_limits_returns_file():
+    f = io.BytesIO(b"video")
+    assert throttle.wrap(f, "nowhere") is f
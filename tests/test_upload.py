@@ -0,0 +1,149 @@
+import logging
+import threading
+
+import pytest
+from docopt import docopt
+
+from prismedia import quota, upload
+
+from .test_mp4 import write_video
+
+VIDEOS = ["a.mp4", "b.mp4", "c.mp4"]
+
+
+class Platform(object):
+    """Stand-in for a platform module, answering with the url given for each video"""
+
+    def __init__(self, name, urls=None, deferred=None):
+        self.name = name
+        self.urls = urls or {}
+        self.deferred = deferred or {}
+        self.sessions = 0
+        self.uploads = []
+        self._lock = threading.Lock()
+
+    def get_session(self):
+        with self._lock:
+            self.sessions += 1
+        return "session of " + self.name
+
+    def run(self, options, session=None):
+        path = options.get('--file')
+        assert session == "session of " + self.name
+        with self._lock:
+            self.uploads.append(path)
+        if path in self.deferred:
+            quota.defer(path, self.deferred[path])
+            return None
+        return self.urls.get(path, "https://" + self.name + "/" + path)
+
+
+@pytest.fixture
+def videos(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    for name in VIDEOS:
+        write_video(tmp_path / name)
+    return [str(tmp_path / name) for name in VIDEOS]
+
+
+@pytest.fixture
+def platforms(monkeypatch):
+    platforms = {"peertube": Platform("peertube"), "youtube": Platform("youtube")}
+    monkeypatch.setattr(upload, 'getPlatformModule', platforms.get)
+    return platforms
+
+
+def get_options(*argv):
+    return upload.earlyoptionSchema.validate(docopt(upload.__doc__, argv=list(argv)))
+
+
+def get_summary(caplog):
+    return [record.getMessage() for record in caplog.records if "videos uploaded" in record.getMessage()]
+
+
+def test_batch_uploads_every_video_to_every_platform(tmp_path, videos, platforms, caplog):
+    caplog.set_level(logging.INFO, logger='Prismedia')
+    upload.uploadBatch(get_options("--dir=" + str(tmp_path), "--platform=peertube,youtube", "--workers=3"))
+
+    for platform in platforms.values():
+        assert sorted(platform.uploads) == videos
+        # Workers share the session of each platform
+        assert platform.sessions == 1
+    assert get_summary(caplog) == ["Prismedia: 3 videos uploaded, 0 deferred to the next quota window, 0 failed"]
+
+
+def test_batch_exits_when_a_video_fails(tmp_path, videos, platforms, caplog):
+    caplog.set_level(logging.INFO, logger='Prismedia')
+    platforms["youtube"].urls[videos[1]] = None
+    with pytest.raises(SystemExit) as exit:
+        upload.uploadBatch(get_options("--dir=" + str(tmp_path), "--platform=peertube,youtube"))
+
+    assert exit.value.code == 1
+    assert sorted(platforms["peertube"].uploads) == videos
+    assert sorted(platforms["youtube"].uploads) == videos
+    assert get_summary(caplog) == ["Prismedia: 2 videos uploaded, 0 deferred to the next quota window, 1 failed"]
+
+
+def test_batch_exits_when_a_video_is_deferred(tmp_path, videos, platforms, caplog):
+    caplog.set_level(logging.INFO, logger='Prismedia')
+    platforms["youtube"].deferred[videos[2]] = 1000
+    with pytest.raises(SystemExit) as exit:
+        upload.uploadBatch(get_options("--dir=" + str(tmp_path), "--platform=youtube"))
+
+    assert exit.value.code == 1
+    assert get_summary(caplog) == ["Prismedia: 2 videos uploaded, 1 deferred to the next quota window, 0 failed"]
+    assert quota.pop_deferred(videos[2]) is None
+
+
+def test_batch_skips_invalid_video(tmp_path, videos, platforms, caplog):
+    caplog.set_level(logging.INFO, logger='Prismedia')
+    (tmp_path / VIDEOS[0]).write_bytes(b"not a video")
+    with pytest.raises(SystemExit):
+        upload.uploadBatch(get_options("--dir=" + str(tmp_path), "--platform=peertube"))
+
+    assert sorted(platforms["peertube"].uploads) == videos[1:]
+    assert get_summary(caplog) == ["Prismedia: 2 videos uploaded, 0 deferred to the next quota window, 1 failed"]
+
+
+def test_batch_exits_without_video(tmp_path, platforms):
+    with pytest.raises(SystemExit) as exit:
+        upload.uploadBatch(get_options("--dir=" + str(tmp_path), "--platform=peertube"))
+    assert exit.value.code == 1
+    assert platforms["peertube"].uploads == []
+
+
+@pytest.mark.parametrize("result, reset, summary, line", [
+    ({"peertube": ("https://peertube/1", 1.0), "youtube": ("https://youtu.be/1", 2.0)}, None, "uploaded",
+     "OK video.mp4 peertube: https://peertube/1 (1.0s), youtube: https://youtu.be/1 (2.0s)"),
+    ({"peertube": ("https://peertube/1", 1.0), "youtube": (None, 2.0)}, None, "failed",
+     "FAILED video.mp4 peertube: https://peertube/1 (1.0s), youtube: failed (2.0s)"),
+    ({"peertube": ("https://peertube/1", 1.0), "youtube": (None, 2.0)}, 0, "deferred",
+     "DEFERRED video.mp4 peertube: https://peertube/1 (1.0s), youtube: deferred until "),
+    ({"peertube": (None, 1.0), "youtube": (None, 2.0)}, 0, "failed",
+     "FAILED video.mp4 peertube: failed (1.0s), youtube: deferred until "),
+    ({}, None, "failed", "FAILED video.mp4 not uploaded"),
+])
+def test_log_summary(caplog, result, reset, summary, line):
+    caplog.set_level(logging.INFO, logger='Prismedia')
+    assert upload.logSummary({}, "video.mp4", result, reset) == summary
+    assert caplog.records[-1].getMessage().startswith("Prismedia: " + line)
+
+
+def test_log_summary_on_stdout_in_batch_mode(caplog):
+    caplog.set_level(logging.INFO, logger='stdoutlogs')
+    upload.logSummary({'--batch': True}, "video.mp4", {"peertube": ("https://peertube/1", 1.0)})
+    assert caplog.records[-1].name == 'stdoutlogs'
+    assert caplog.records[-1].getMessage() == "Summary: OK video.mp4 peertube: https://peertube/1 (1.0s)"
+
+
+def test_batch_sessions_authenticate_once_per_platform(platforms):
+    sessions = upload.BatchSessions()
+    threads = [threading.Thread(target=sessions.get, args=(platform,))
+               for platform in ("peertube", "youtube") * 4]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sessions.get("peertube") == "session of peertube"
+    assert platforms["peertube"].sessions == 1
+    assert platforms["youtube"].sessions == 1